@@ -1,21 +1,115 @@
+import contextvars
+import hashlib
+import re
+import sys
+import threading
+from contextlib import contextmanager
 from enum import Enum
 
+import attr
 import django
 from box import Box
+from django.core.exceptions import FieldDoesNotExist
 from collections.abc import KeysView
 
 
-class Registry:
+@attr.s
+class Context(object):
     """
-    Holds global resources
+    Resources of a single export/import job e.g. exporter, importer, xlwriter, xlreader. It's passed explicitly to
+    Exporter, Importer and the sheets/formatters they create. Parser (config) is read-only once parsed, hence can be
+    shared by many contexts.
+    Activating a context makes it available to cross-cutting helpers (instrumentation, profiling) of the calling
+    thread / asyncio task.
+    """
+    parser = attr.ib(default=None)
+    exporter = attr.ib(default=None, repr=False)
+    importer = attr.ib(default=None, repr=False)
+    options = attr.ib(default=None)
+    xlwriter = attr.ib(default=None, repr=False)
+    xlreader = attr.ib(default=None, repr=False)
+    instrumentation = attr.ib(default=None, repr=False)
+    profiler = attr.ib(default=None, repr=False)
+    progress = attr.ib(default=None, repr=False)  # callable(stage, sheet_nm, done, total) invoked after each sheet
+
+    @contextmanager
+    def activate(self):
+        """ Makes this context current for the calling thread / asyncio task """
+        token = _current_context.set(self)
+        try:
+            yield self
+        finally:
+            _current_context.reset(token)
+
+    def report_progress(self, stage, sheet_nm, done, total):
+        if self.progress:
+            self.progress(stage, sheet_nm, done, total)
+
+
+_current_context = contextvars.ContextVar('django_excel_transformer_context', default=Context())
+
+
+class SheetIndex(object):
+    """
+    Sheets of an export/import job by sheet name and by exact model, maintained as sheets are registered. A model
+    exported as multiple (e.g. filtered) sheets resolves to the sheet marked with `reference_sheet: true` in config,
+    otherwise such lookup is ambiguous.
     """
-    parser = None
-    exporter = None
-    importer = None
-    config = None
-    options = None
-    xlwriter = None
-    xlreader = None
+
+    def __init__(self):
+        self._sheets = {}  # sheet name -> sheet
+        self._models = {}  # model name -> [sheet names] in registration order
+        self._preferred = {}  # model name -> sheet name marked as reference_sheet
+        self._lock = threading.Lock()  # sheets can be registered from parallel workers
+
+    @staticmethod
+    def model_key(model) -> str:
+        """ Model class or its (dotted) name e.g. 'panopticum.models.ComponentModel' -> 'componentmodel' """
+        return model.rsplit('.', 1)[-1].lower() if isinstance(model, str) else model._meta.model_name
+
+    def register(self, sheet_nm, model, sheet, preferred=False):
+        key = self.model_key(model)
+        with self._lock:
+            self._sheets[sheet_nm] = sheet
+            names = self._models.setdefault(key, [])
+            if sheet_nm not in names:
+                names.append(sheet_nm)
+            if preferred:
+                self._preferred[key] = sheet_nm
+
+    def get(self, sheet_nm):
+        """ Sheet by name, None if not registered """
+        with self._lock:
+            return self._sheets.get(sheet_nm)
+
+    def get_by_model(self, model, sheet_nm=None):
+        """
+        :param model: model class or name
+        :param sheet_nm: selects one of the sheets of model explicitly
+        :return: sheet, None if model has no registered sheet
+        :raises: ValueError if model has multiple sheets and none of them is preferred
+        """
+        key = self.model_key(model)
+        with self._lock:
+            names = self._models.get(key, [])
+            if sheet_nm is not None:
+                return self._sheets[sheet_nm] if sheet_nm in names else None
+            if key in self._preferred:
+                return self._sheets[self._preferred[key]]
+            if len(names) > 1:
+                raise ValueError(f'multiple sheets {names} for model [{key}]. Mark one of them with '
+                                 f'`reference_sheet: true` in config.')
+            return self._sheets[names[0]] if names else None
+
+    def items(self):
+        """ (sheet name, sheet) in registration order """
+        with self._lock:
+            return list(self._sheets.items())
+
+
+def current_context() -> Context:
+    """ Context activated for calling thread / asyncio task, else empty context """
+    return _current_context.get()
 
 
 class DBDataMistmatchError(Exception):
@@ -104,6 +198,76 @@ def lower(data):
         return data
 
 
+METADATA_SHEET = '_det_metadata'  # hidden sheet with export fingerprints, see XlsWriter.add_metadata
+MAX_SHEET_ROWS = 1048575  # excel row limit (1048576) less header row
+MAX_SHEET_NAME = 31  # excel sheet name length limit
+
+
+def shard_name(sheet_nm, number: int) -> str:
+    """
+    Name of n-th (1 based) sheet holding rows of a sheet split across several sheets, see ExportableSheet.shards
+    e.g. ('Components', 1) -> 'Components', ('Components', 2) -> 'Components_2'
+    """
+    if number == 1:
+        return sheet_nm
+    suffix = f'_{number}'
+    return sheet_nm[:MAX_SHEET_NAME - len(suffix)] + suffix
+
+
+def m2m_labels(value) -> list:
+    """ Splits many to many excel value (e.g. '* lang1\\n* lang2') into reference labels """
+    return [re.sub(r'^\* ', '', i) for i in value.rsplit('\n')] if value else []
+
+
+INDEX_SEPARATOR = ' - '  # separates index key values (and reference fields) in excel cells and reports
+
+
+def index_key(values) -> tuple:
+    """
+    Composite index key of a record as tuple of its index column values. Text values are interned, so that equal
+    values of excel records, DB records and reference lookups share a single string.
+    """
+    return tuple(sys.intern(v) if isinstance(v, str) else v for v in values)
+
+
+def index_label(key: tuple) -> str:
+    """ Display form of index key as used in excel cells and reports e.g. ('comp', '1.0') -> 'comp - 1.0' """
+    return INDEX_SEPARATOR.join(str(v) for v in key)
+
+
+def cell_value(value):
+    """ Value as kept by excel i.e. None for empty string, see row_hash and values_equal """
+    return None if isinstance(value, str) and value == '' else value
+
+
+def values_equal(db_value, xl_value) -> bool:
+    """
+    DB value equals excel value converted to type of DB value. None and empty string are same, as for row_hash.
+    """
+    db_value, xl_value = cell_value(db_value), cell_value(xl_value)
+    if db_value is None or xl_value is None:
+        return db_value is None and xl_value is None
+    return db_value == type(db_value)(xl_value)
+
+
+def row_hash(values) -> str:
+    """
+    Stable (across processes) content hash of rendered row values as exported to excel.
+    None and empty string are same as excel doesn't keep empty strings (see cell_value). List values (e.g. many to many
+    labels) are order insensitive.
+    :param values: iterable of column values
+    :return: hex digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for v in values:
+        if isinstance(v, (list, tuple)):
+            v = '\n'.join(sorted(str(i) for i in v))
+        v = cell_value(v)
+        h.update(('' if v is None else str(v)).encode('utf-8'))
+        h.update(b'\x1f')
+    return h.hexdigest()
+
+
 def get_model_fields(model: object) -> object:
     # if not lower_case:
     model_fields = {f.name: f for f in model._meta.fields + model._meta.many_to_many} if model else None
@@ -133,6 +297,28 @@ def get_model(model_name: str):
     return model[0]
 
 
+def select_related_paths(model, refs) -> list:
+    """
+    Relations traversed by dotted reference paths which can be joined in the same query
+    e.g. ['category.name', 'name'] -> ['category']
+    """
+    related = set()
+    for ref in refs:
+        path, m = [], model
+        for i in ref.split('.')[:-1]:
+            try:
+                f = m._meta.get_field(i)
+            except FieldDoesNotExist:  # e.g. property
+                break
+            if not f.concrete or not (f.many_to_one or f.one_to_one):
+                break
+            path.append(i)
+            m = f.related_model
+        if path:
+            related.add('__'.join(path))
+    return sorted(related)
+
+
 
 class Issue(Enum):
     EQUAL = 'equal'
@@ -10,7 +10,7 @@ from enum import Enum
 import attr
 from openpyxl.worksheet.table import TableStyleInfo
 
-from ..common import lower, Registry
+from ..common import lower, MAX_SHEET_ROWS
 
 
 class FormatType(Enum):
@@ -44,11 +44,12 @@ class ColRef(object):
         return self.name
 
     @classmethod
-    def from_registry(cls, ref_data):
+    def from_context(cls, ref_data, context):
         """
         Receives ref_data as provided by Parser and will convert to ColRef type.
-        It needs to access Registry -> Ref sheet Exporter -> TableFormatter -> ColFormatter
+        It needs to access context -> Ref sheet Exporter -> TableFormatter -> ColFormatter
         :param ref_data: reference data if exists
+        :param context: job Context whose exporter has already exported referenced sheet
         :return: ColRef instance
         """
         if ref_data is None or len(ref_data) > 1:
@@ -56,11 +57,15 @@ class ColRef(object):
                          f'datavalidation. Ignoring!')
             return None
 
-        es = Registry.exporter.get_sheet_by_model(ref_data[0][0])
+        es = context.exporter.get_sheet_by_model(ref_data[0][0])
         if not es:
             logging.error(
                 f'Reference [{" - ".join(ref_data[0])}] either doesnt exist or isnt exported yet, hence no reference available. Ignoring!')
             return None
+        if es.shard_count > 1:
+            logging.info(f'Reference [{" - ".join(ref_data[0])}] spans sheets {es.shard_names()}, excel expects single '
+                         f'range for datavalidation. Ignoring!')
+            return None
 
         col_format = es.get_formatting().get_column(lower(ref_data[0][1]))
         if not col_format:
@@ -69,7 +74,7 @@ class ColRef(object):
 
         return ColRef(name=es.sheet_name,
                       startcell=f'${col_format.column_number}$2',
-                      endcell=f'${col_format.column_number}${len(es.dbdata) + 1}')
+                      endcell=f'${col_format.column_number}${es.row_count + 1}')
 
 
 @attr.s
@@ -81,7 +86,13 @@ class ColFormat(Formatter):
     column_number = attr.ib(validator=attr.validators.instance_of(str))
 
     @classmethod
-    def from_dict(cls, name: str, col_data=None):
+    def from_dict(cls, name: str, col_data=None, context=None, column_number='A'):
+        """
+        :param name: column name
+        :param col_data: column config as provided by Parser, its read-only as config is shared across jobs
+        :param context: job Context, needed to resolve references
+        :param column_number: excel column letter
+        """
         if col_data is None:
             col_data = Box(default_box=True)
         formatters = Box(default_box=True, width=ColFormat.DEFAULT_WIDTH, wrap=ColFormat.DEFAULT_WRAP,
@@ -98,9 +109,9 @@ class ColFormat(Formatter):
 
         tmp_ref = col_data.get('references', None)
         if tmp_ref:
-            formatters.reference = ColRef.from_registry(tmp_ref) if tmp_ref else None
+            formatters.reference = ColRef.from_context(tmp_ref, context) if tmp_ref else None
         return cls(name=name, type=FormatType.COLUMN, formatters=formatters,
-                   column_number=col_data.get('column_number', 'A'))
+                   column_number=column_number)
 
     def update_excel_val(self, excel_val: dict):
         self.excel_val = excel_val
@@ -122,7 +133,7 @@ class TableFormat(Formatter):
     sheet_position = attr.ib(default=-1)
 
     @classmethod
-    def from_dict(cls, name: str, t_fmting=None, c_fmting=None):
+    def from_dict(cls, name: str, t_fmting=None, c_fmting=None, context=None):
         if t_fmting is None:
             t_fmting = Box(default_box=True)
         if c_fmting is None:
@@ -154,6 +165,7 @@ class TableFormat(Formatter):
         formatters.locked = t_fmting.get('read_only', TableFormat.DEFAULT_READONLY)
         formatters.alignment = get_sheet_alignment(t_fmting.get('alignment', Box(default_box=True)))
         formatters.freeze_panes = t_fmting.get('freeze_panes', TableFormat.DEFAULT_FREEZE_PANE)
+        formatters.max_rows = t_fmting.get('max_rows', MAX_SHEET_ROWS)  # rows per sheet, see ExportableSheet.shards
 
         sheet_props = WorksheetProperties()
         if 'tab_color' in t_fmting:
@@ -168,9 +180,8 @@ class TableFormat(Formatter):
         for col_nm, col_data in c_fmting.items():  # handle columns
             column_number = chr(64 + count) if count <= 26 else \
                 chr(64 + int(count / 26)) + chr(64 + (int(count % 26) if int(count % 26) != 0 else 1))
-            col_data['column_number'] = column_number
             count += 1
-            col_obj = ColFormat.from_dict(col_nm, col_data)
+            col_obj = ColFormat.from_dict(col_nm, col_data, context, column_number)
             obj.reg_col(col_obj)
             # if col_obj.formatters.locked:
             #     obj.formatters.locked = True
@@ -1,37 +1,217 @@
+import itertools
 import logging
 import os
+import warnings
+from datetime import datetime
+from typing import Union
 
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.comments import Comment
 from openpyxl.styles import Alignment, Protection
-from openpyxl.utils import quote_sheetname
+from openpyxl.utils import quote_sheetname, get_column_letter
 from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.worksheet.protection import SheetProtection
-from openpyxl.worksheet.table import TableStyleInfo
+from openpyxl.worksheet.filters import AutoFilter
+from openpyxl.worksheet.table import TableStyleInfo, Table, TableColumn
 from openpyxl.cell import Cell
 
 from .excel_format import TableFormat
+from ..common import METADATA_SHEET, MAX_SHEET_ROWS, shard_name
+from ..instrumentation import span
 from box import Box
 
 
-class XlsWriter(object):
-    def __init__(self, filename, overwrite=False):
-        if os.path.isfile(filename) and overwrite is False:
+ENGINES = ('openpyxl', 'xlsxwriter', 'spreadsheetml')
+
+
+def create_writer(filename, overwrite=False, write_only=False, metadata=False, engine='openpyxl'):
+    """
+    Creates writer of given engine, see BaseXlsWriter for arguments
+    :param engine: openpyxl (default, see XlsWriter), xlsxwriter (see XlsxWriterEngine) or spreadsheetml (see
+                   SpreadsheetMLWriterEngine)
+    :return: BaseXlsWriter
+    """
+    if engine == 'openpyxl':
+        return XlsWriter(filename, overwrite, write_only, metadata)
+    elif engine == 'xlsxwriter':
+        from .xlsxwriter_engine import XlsxWriterEngine  # optional dependency
+        return XlsxWriterEngine(filename, overwrite, write_only, metadata)
+    elif engine == 'spreadsheetml':
+        from .spreadsheetml_engine import SpreadsheetMLWriterEngine
+        return SpreadsheetMLWriterEngine(filename, overwrite, write_only, metadata)
+    raise ValueError(f'Unsupported excel writer engine [{engine}], supported engines are {ENGINES}')
+
+
+class BaseXlsWriter(object):
+    """
+    Writer engine interface used by Exporter -- update_sheet() per exported sheet, add_metadata() if metadata is
+    enabled and final() once all sheets are written. Engines must produce equivalent workbooks, see export.parity.
+    """
+    METADATA_VERSION = 1
+    METADATA_MAX_ROWS = MAX_SHEET_ROWS  # rows of metadata sheet besides header, rest continue in next metadata sheet
+
+    def __init__(self, filename, overwrite=False, write_only=False, metadata=False):
+        """
+        :param filename: excel file path or binary file-like object (e.g. BytesIO, HttpResponse, socket file)
+        :param overwrite: overwrite excel file if exists
+        :param write_only: rows are streamed to temporary files instead of being held in memory. Workbook is
+                           written only once in final().
+        :param metadata: write hidden metadata sheet (config hash, export time, per sheet row count and row hashes)
+                         in final(). Importer uses it to find rows untouched since export.
+        """
+        self._is_path = isinstance(filename, (str, os.PathLike))
+        if self._is_path and os.path.isfile(filename) and overwrite is False:
             raise FileExistsError(f'[{filename}] file already exists without overwrite flag')
         self._filename = filename
-        self._wb = openpyxl.Workbook()
-        self._wb.save(filename)  # Can raise PermissionError
+        self.write_only = write_only
         self._sheet_pos = Box(default_box=True)  # maintain sheet position
+        self.shards = {}  # sheet name -> names of further sheets holding its rows, see add_shards
+        self.metadata = {} if metadata else None  # sheet name -> (row count, {index key -> row hash})
+
+    def add_metadata(self, sheet_nm, row_count, row_hashes: dict):
+        """
+        Registers fingerprints of exported sheet for metadata sheet
+        :param sheet_nm: sheet name
+        :param row_count: number of exported rows
+        :param row_hashes: dict(index key -> row hash)
+        """
+        self.metadata[sheet_nm] = (row_count, row_hashes)
 
-    def final(self):
-        # We will rearrange the sheets as per their position.
+    def add_shards(self, sheet_nm, shard_names: list):
+        """
+        Registers sheets holding rest of rows of sheet_nm (see ExportableSheet.shards), so that final() keeps them
+        right after sheet_nm irrespective of their own position
+        :param sheet_nm: first sheet, already written
+        :param shard_names: further sheets, already written
+        """
+        for nm in shard_names:
+            self._sheet_pos.pop(nm, None)
+        self.shards[sheet_nm] = list(shard_names)
+
+    def _arranged(self, sheet_names) -> list:
+        """
+        Sheet names in final order i.e. each sheet moved to its position (in order of writing) and shards following
+        their first sheet
+        :param sheet_names: sheet names in current workbook order
+        """
+        order = list(sheet_names)
         for nm, pos in self._sheet_pos.items():
-            sheet = self._wb[nm]
-            if pos != -1:
-                self._wb.move_sheet(sheet, pos - self._wb.index(sheet))
+            order.remove(nm)
+            order.insert(pos if pos != -1 else len(order), nm)
+        for nm, shard_names in self.shards.items():
+            order = [o for o in order if o not in shard_names]
+            idx = order.index(nm) + 1
+            order[idx:idx] = shard_names
+        return order
+
+    def _metadata_sheets(self, config_hash):
+        """
+        (sheet name, rows including header) of metadata sheets. Row hashes of big exports don't fit into a single
+        sheet, rows beyond METADATA_MAX_ROWS continue in numbered sheets (see common.shard_name). Rows of a sheet must
+        be consumed before next sheet is generated.
+        """
+        rows = self._metadata_rows(config_hash)
+        first = next(rows)
+        for number in itertools.count(1):
+            yield shard_name(METADATA_SHEET, number), itertools.chain(
+                [['type', 'sheet', 'key', 'value'], first], itertools.islice(rows, self.METADATA_MAX_ROWS - 1))
+            first = next(rows, None)
+            if first is None:
+                return
+
+    def _metadata_rows(self, config_hash):
+        """ rows of metadata sheet(s) without header """
+        yield ['format_version', None, None, BaseXlsWriter.METADATA_VERSION]
+        yield ['config_hash', None, None, config_hash]
+        yield ['exported_at', None, None, datetime.now().isoformat(timespec='seconds')]
+        for sheet_nm, (row_count, row_hashes) in self.metadata.items():
+            yield ['row_count', sheet_nm, None, row_count]
+            for idx, h in row_hashes.items():
+                yield ['row_hash', sheet_nm, idx, h]
+
+    @staticmethod
+    def _data_validation(cr, column_letter, row_count) -> DataValidation:
+        """ list validation of column cells against referenced sheet's cells, see Formatter reference """
+        dv = DataValidation(type="list",
+                            formula1="{0}!{1}:{2}".format(quote_sheetname(cr.sheet_name), cr.startcell, cr.endcell))
+        dv.add('{0}2:{0}{1}'.format(column_letter, row_count + 1))
+        return dv
+
+    @staticmethod
+    def _table(sheet_nm, columns, row_count, tf: TableFormat) -> Table:
+        """ table spanning header and data rows. Columns are named explicitly since write_only sheets cannot be read """
+        table_ref = f'A1:{get_column_letter(len(columns))}{row_count + 1}'
+        return Table(ref=table_ref, displayName=sheet_nm.replace(" ", ""),
+                     tableStyleInfo=tf.formatters.table_style_info,
+                     tableColumns=[TableColumn(id=i, name=str(col)) for i, col in enumerate(columns, 1)],
+                     autoFilter=AutoFilter(ref=table_ref))
+
+    @staticmethod
+    def _protection(tf: TableFormat, col_lock) -> Union[SheetProtection, None]:
+        """
+        :param col_lock: some column is locked
+        :return: protection of sheet, None if it isn't protected
+        """
+        if tf.formatters.locked:
+            return SheetProtection(sheet=True)
+        elif col_lock:
+            return SheetProtection(sheet=True, selectLockedCells=False, selectUnlockedCells=False, objects=True,
+                                   scenarios=True, formatCells=True, formatRows=True, formatColumns=True,
+                                   insertColumns=True, insertRows=True, insertHyperlinks=True, deleteColumns=True,
+                                   deleteRows=True, sort=True, autoFilter=True, pivotTables=True, password=None)
+        return None
+
+    def update_sheet(self, sheet_nm, columns, data, tf: TableFormat):
+        """
+        Writes sheet with header row of columns and data rows formatted as per tf
+        :param sheet_nm: sheet name
+        :param columns: column names
+        :param data: rows of values
+        :param tf: TableFormat
+        """
+        raise NotImplementedError
+
+    def final(self, config_hash=None):
+        """
+        Arranges sheets as per their position, writes metadata sheet if enabled and saves workbook
+        :param config_hash: config hash (see Parser.config_hash) recorded in metadata sheet
+        """
+        raise NotImplementedError
+
+
+class XlsWriter(BaseXlsWriter):
+    """
+    Default engine, writes workbook with openpyxl
+    """
+
+    def __init__(self, filename, overwrite=False, write_only=False, metadata=False):
+        super().__init__(filename, overwrite, write_only, metadata)
+        self._wb = openpyxl.Workbook(write_only=write_only)
+        if self._is_path:
+            if write_only:
+                open(filename, 'wb').close()  # Can raise PermissionError
             else:
-                self._wb.move_sheet(sheet, len(self._sheet_pos))
+                self._wb.save(filename)  # Can raise PermissionError
+
+    def _write_metadata(self, config_hash):
+        for sheet_nm, rows in self._metadata_sheets(config_hash):
+            sheet = self._wb.create_sheet(title=sheet_nm)
+            sheet.sheet_state = 'hidden'
+            for row in rows:
+                sheet.append(row)
 
-        self._wb.save(self._filename)
+    def final(self, config_hash=None):
+        with span('final') as s:
+            # We will rearrange the sheets as per their position.
+            for idx, nm in enumerate(self._arranged(self._wb.sheetnames)):
+                self._wb.move_sheet(nm, idx - self._wb.index(self._wb[nm]))
+            s.rows = len(self._sheet_pos)
+            if self.metadata is not None:
+                self._write_metadata(config_hash)
+
+            with span('save'):
+                self._wb.save(self._filename)
 
     def _get_sheet_by_name(self, ws_name: str, read: bool = False, ws_details: TableFormat = None):
         """
@@ -53,6 +233,8 @@ class XlsWriter(object):
                 try:
                     sheet = self._wb['Sheet']  # default sheet
                     sheet.title = ws_name
+                    if ws_details.formatters.sheet_props is not None:
+                        sheet.sheet_properties = ws_details.formatters.sheet_props
                     return sheet
                 except KeyError:
                     pass
@@ -67,6 +249,8 @@ class XlsWriter(object):
     def update_sheet(self, sheet_nm, columns, data, tf):
         """
         Create or Update excel sheet with db data and cf.
+        Worksheet and column settings are applied before rows are written so that rows can be streamed (write_only).
+        Workbook is saved in final().
         :param sheet_nm: sheet name
         :param columns: column names
         :param data: Database data that needs to be exported
@@ -77,54 +261,53 @@ class XlsWriter(object):
         if not columns or not data:
             logging.error(f'[{"columns" if not columns else "data"}] required but received None')
 
-        sheet = self._get_sheet_by_name(ws_name=sheet_nm, read=False, ws_details=tf)
-        col_lock = False
-        sheet.append(columns)
-        if len(data) <= 0:
-            logging.error(f'No values to insert for [{sheet_nm}]')
-            sheet["$1$1"].comment = 'No data available for insert'
-        else:
+        with span('write', sheet_nm) as s:
+            sheet = self._get_sheet_by_name(ws_name=sheet_nm, read=False, ws_details=tf)
+            if len(data) <= 0:
+                logging.error(f'No values to insert for [{sheet_nm}]')
+                header = [WriteOnlyCell(sheet, value=col) for col in columns]
+                if header:
+                    header[0].comment = Comment('No data available for insert', 'django-excel-transformer')
+                sheet.append(header)
+                return
+
+            col_lock = False
+            with span('style', sheet_nm):
+                cfs = [tf.get_column(col, default=True) for col in columns]
+                styles = []  # per column (alignment, protection) applied to every cell of the column
+                for cf in cfs:
+                    sheet.column_dimensions[cf.column_number].width = cf.formatters.width
+                    cr = cf.formatters.get('reference', None)
+                    if cr and cf.formatters.get('dv', True):
+                        sheet.data_validations.append(self._data_validation(cr, cf.column_number, len(data)))
+                    if tf.formatters.alignment.wrapText is True:
+                        locked = bool(cf.formatters.locked or tf.formatters.locked)
+                        col_lock = col_lock or locked
+                        styles.append((Alignment(wrapText=True), Protection(locked=locked)))
+                    else:
+                        styles.append(None)
+
+                # Other Worksheet level settings
+                sheet.alignment = tf.formatters.alignment
+                sheet.freeze_panes = tf.formatters.freeze_panes
+                with warnings.catch_warnings():
+                    warnings.filterwarnings('ignore', message='In write-only mode you must add table columns')
+                    sheet.add_table(self._table(sheet_nm, columns, len(data), tf))
+                protection = self._protection(tf, col_lock)
+                if protection is not None:
+                    sheet.protection = protection
+
+            def cell(value, style, comment=None):
+                if style is None and comment is None:
+                    return value
+                c = WriteOnlyCell(sheet, value=value)
+                if style:
+                    c.alignment, c.protection = style
+                if comment:
+                    c.comment = comment
+                return c
+
+            sheet.append([cell(col, styles[i], cfs[i].formatters.comment or None) for i, col in enumerate(columns)])
             for d in data:
-                sheet.append(d)
-            for col in columns:
-                cf = tf.get_column(col, default=True)
-
-                sheet.column_dimensions[cf.column_number].width = cf.formatters.width
-                if cf.formatters.comment:
-                    sheet[f'${cf.column_number}$1'].comment = cf.formatters.comment
-                cr = cf.formatters.get('reference', None)
-                if cr and cf.formatters.get('dv', True):
-                    dv = DataValidation(type="list",
-                                        formula1="{0}!{1}:{2}".format(quote_sheetname(cr.sheet_name),
-                                                                      cr.startcell,
-                                                                      cr.endcell))
-                    dv.add('{0}2:{0}{1}'.format(cf.column_number, len(data) + 1))
-                    sheet.add_data_validation(dv)
-                if tf.formatters.alignment.wrapText is True:
-                    for cell in sheet[cf.column_number]:
-                        cell.alignment = Alignment(wrapText=True)
-                        if cf.formatters.locked or tf.formatters.locked:
-                            col_lock = True
-                            cell.protection = Protection(locked=True)
-                        else:
-                            cell.protection = Protection(locked=False)
-
-            # Other Worksheet level settings
-            sheet.alignment = tf.formatters.alignment
-            sheet.freeze_panes = tf.formatters.freeze_panes
-            sheet.add_table(openpyxl.worksheet.table.Table(ref="%s" % sheet.dimensions,
-                                                           displayName=sheet_nm.replace(" ", ""),
-                                                           tableStyleInfo=tf.formatters.table_style_info))
-            if tf.formatters.locked:
-                sheet.protection.sheet = True
-            elif col_lock:
-                sheet.protection = SheetProtection(sheet=True, selectLockedCells=False,
-                                                   selectUnlockedCells=False, objects=True, scenarios=True,
-                                                   formatCells=True, formatRows=True, formatColumns=True,
-                                                   insertColumns=True, insertRows=True, insertHyperlinks=True,
-                                                   deleteColumns=True, deleteRows=True, sort=True, autoFilter=True,
-                                                   pivotTables=True,
-                                                   password=None)
-
-        self._wb.save(self._filename)
-        return
+                sheet.append([cell(v, styles[i]) for i, v in enumerate(d)])
+            s.rows = len(data)
@@ -1,12 +1,149 @@
 import logging
+import operator
+from typing import Union
+
 import attr
 
 from box import Box
-from ..common import Registry, getdictvalue, lower
+from ..common import Context, SheetIndex, getdictvalue, m2m_labels, row_hash, select_related_paths, index_label, \
+    INDEX_SEPARATOR, shard_name
+from ..instrumentation import span
 from .excel_format import TableFormat
+from django.db import OperationalError, connections
 from django.db.models import Q
 
 
+COLLECTION_LOOKUPS = ('in', 'range')  # lookups getting all values of a filter item at once
+PAGE_BY = ('pk', 'index_key')  # keyset of paginated export reads, see ExportableSheet.pages
+PAGE_RETRIES = 3  # attempts to read a page, each one resumes after last fetched key
+
+
+def filter_q(criteria) -> Union[Q, None]:
+    """
+    Builds Q object from INCLUDE/EXCLUDE section of config filters. Items of "or" are OR-ed, items of "and" are AND-ed
+    with them. Item's lookup (e.g. `category__name`, `version__gte`) is applied to each of its values, except collection
+    lookups (e.g. `life_status__in`, `version__range`) which get all values in a single condition.
+    :return: Q, None if criteria has no items
+    """
+    query = None
+    for op, combine in (('or', operator.or_), ('and', operator.and_)):
+        for item in criteria.get(op) or []:
+            name, values = item.get('name'), item.get('values')
+            if name.rsplit('__', 1)[-1] in COLLECTION_LOOKUPS:
+                terms = [Q(**{name: values})]
+            else:
+                terms = [Q(**{name: v}) for v in values]
+            for term in terms:
+                query = term if query is None else combine(query, term)
+    return query
+
+
+def keyset_q(fields, values, lookup='gt', last_lookup=None) -> Q:
+    """
+    Rows after (or before) values in lexicographic order of fields e.g. `a > 1 OR (a = 1 AND b > 2)`
+    :param fields: keyset fields
+    :param values: keyset values, one per field
+    :param lookup: strict lookup of fields, gt or lt
+    :param last_lookup: lookup of last field (e.g. lte), defaults to lookup
+    """
+    query = Q(**{f'{fields[-1]}__{last_lookup or lookup}': values[-1]})
+    for field, value in zip(reversed(fields[:-1]), reversed(values[:-1])):
+        query = Q(**{f'{field}__{lookup}': value}) | (Q(**{field: value}) & query)
+    return query
+
+
+class LabelCache(object):
+    """
+    Rendered reference labels (e.g. `component.name - version`) keyed by (model, key field, key value, references).
+    It lives as long as the export, so labels of a referenced table are rendered once for all sheets and rows, and
+    equal labels share a single string object.
+    """
+    BATCH_SIZE = 500  # keeps `IN` clause below DB parameter limits (e.g. sqlite)
+
+    def __init__(self):
+        self._labels = {}
+        self._strings = {}
+
+    @staticmethod
+    def render(obj, refs) -> str:
+        value = ""
+        for ref in refs:
+            attr_obj = obj
+            for i in ref.split('.'):
+                attr_obj = getattr(attr_obj, i)
+            value = value + INDEX_SEPARATOR + str(attr_obj) if value else str(attr_obj)
+        return value
+
+    def _put(self, key, label):
+        self._labels[key] = self._strings.setdefault(label, label)
+
+    def get(self, obj, refs) -> str:
+        """ Label of model instance """
+        if obj is None:
+            return None
+        key = (obj._meta.label, 'pk', obj.pk, refs)
+        if key not in self._labels:
+            self._put(key, self.render(obj, refs))
+        return self._labels[key]
+
+    def load(self, fk, values, refs):
+        """
+        Renders labels of all objects referenced by foreign key values in bulk.
+        :param fk: ForeignKey field
+        :param values: foreign key column values (i.e. `<field>_id`)
+        :param refs: tuple of reference paths
+        """
+        model, key_field = fk.related_model, fk.target_field.attname
+        missing = [v for v in set(values)
+                   if v is not None and (model._meta.label, key_field, v, refs) not in self._labels]
+        if refs == ('pk',) and key_field == model._meta.pk.attname:
+            for v in missing:
+                self._put((model._meta.label, key_field, v, refs), str(v))
+            return
+        related = select_related_paths(model, refs)
+        for i in range(0, len(missing), LabelCache.BATCH_SIZE):
+            qs = model._default_manager.filter(**{f'{key_field}__in': missing[i:i + LabelCache.BATCH_SIZE]})
+            for obj in qs.select_related(*related):
+                self._put((model._meta.label, key_field, getattr(obj, key_field), refs), self.render(obj, refs))
+
+    def load_m2m(self, field, owners, refs) -> dict:
+        """
+        Labels of objects related via many to many field for all owner objects, read with a single query on the
+        through table joined to the columns needed by references.
+        :param field: ManyToManyField
+        :param owners: queryset of owner objects
+        :param refs: tuple of reference paths
+        :return: dict(owner pk -> [labels])
+        """
+        through, related_model = field.remote_field.through, field.related_model
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        source_attname = through._meta.get_field(source).attname
+        # same order as `getattr(owner, field).all()`
+        ordering = [f'-{target}__{o[1:]}' if o.startswith('-') else f'{target}__{o}'
+                    for o in related_model._meta.ordering if isinstance(o, str)] or [f'{target}__pk']
+        qs = through._default_manager.filter(**{f'{source}__in': owners.values('pk')}) \
+            .select_related(target, *[f'{target}__{p}' for p in select_related_paths(related_model, refs)]) \
+            .order_by(source_attname, *ordering)
+        values = {}
+        for row in qs:
+            values.setdefault(getattr(row, source_attname), []).append(self.get(getattr(row, target), refs))
+        return values
+
+    def label(self, fk, value, refs, default=None) -> str:
+        """
+        Label of object referenced by foreign key value, see load()
+        :param default: callable returning referenced object, used if label isn't loaded
+        """
+        if value is None:
+            return None
+        key = (fk.related_model._meta.label, fk.target_field.attname, value, refs)
+        if key not in self._labels:
+            if default is None:
+                return None
+            self._put(key, self.render(default(), refs))
+        return self._labels[key]
+
+
 @attr.s
 class ExportableSheet(object):
     name = attr.ib()
@@ -14,17 +151,23 @@ class ExportableSheet(object):
     data = attr.ib()
     filters = attr.ib()
     formatting = attr.ib()
+    index_keys = attr.ib()
 
     # Use below information for exporting to Excel file
     columns = attr.ib()
     dbdata = attr.ib(default=None)
+    row_count = attr.ib(default=0)  # number of exported rows, remains available after dbdata is released
+    context = attr.ib(default=None, repr=False, eq=False)
+    page_size = attr.ib(default=0)  # rows per query, 0 reads all rows with single query. See pages()
+    page_by = attr.ib(default='pk', validator=attr.validators.in_(PAGE_BY))
+    last_key = attr.ib(default=None)  # keyset values of last fetched row while paging
 
     @property
     def sheet_name(self):
         return self.name
 
     @classmethod
-    def from_sheetdata(cls, sheetdata: Box):
+    def from_sheetdata(cls, sheetdata: Box, context: Context):
         if not sheetdata:
             raise ValueError('Sheet_details missing')
 
@@ -33,44 +176,97 @@ class ExportableSheet(object):
         data = getdictvalue(getdictvalue(sheetdata, 'dataset', None), 'data', None)
         model = getdictvalue(getdictvalue(sheetdata, 'dataset', None), 'model', None)
         formatting = getdictvalue(sheetdata, 'formatting', Box(default_box=True))
+        index_keys = getdictvalue(getdictvalue(sheetdata, 'dataset', None), 'index_key', None) or []
 
         missing_fields = [k for k, v in {'name': sheet_nm, 'model': model, 'data': data}.items() if not v]
         if missing_fields:
             raise ValueError(f'{ ",".join(missing_fields) } missing')
 
-        obj = cls(name=sheet_nm, model=model, data=data, filters=filters, columns=list(data.keys()),
-                  formatting=TableFormat.from_dict(model._meta.model_name, formatting, data))
+        exporter = context.exporter if context else None
+        obj = cls(name=sheet_nm, model=model, data=data, filters=filters, index_keys=index_keys,
+                  columns=list(data.keys()),
+                  formatting=TableFormat.from_dict(model._meta.model_name, formatting, data, context),
+                  context=context, page_size=exporter.page_size if exporter else 0,
+                  page_by=exporter.page_by if exporter else 'pk')
         obj._fetch_data()
         return obj
 
     def get_formatting(self):
         return self.formatting
 
+    @property
+    def shard_count(self) -> int:
+        """ Number of sheets holding exported rows, more than one if row_count exceeds max_rows of sheet formatting """
+        return max(1, -(-self.row_count // self.formatting.formatters.max_rows))
+
+    def shard_names(self) -> list:
+        """ Names of sheets holding exported rows, see common.shard_name """
+        return [shard_name(self.sheet_name, n) for n in range(1, self.shard_count + 1)]
+
+    def shards(self):
+        """
+        Splits exported rows across sheets of at most max_rows rows, first sheet keeps sheet name
+        :return: generator of (sheet name, rows)
+        """
+        if self.shard_count == 1:
+            yield self.sheet_name, self.dbdata
+            return
+        max_rows = self.formatting.formatters.max_rows
+        for n, shard_nm in enumerate(self.shard_names()):
+            yield shard_nm, self.dbdata[n * max_rows:(n + 1) * max_rows]
+
+    def row_hashes(self) -> dict:
+        """
+        Fingerprints of exported rows, computed same as ImportableSheet does for excel rows.
+        :return: dict(index key -> row_hash)
+        """
+        m2m_fields = {f.name for f in self.model._meta.many_to_many}
+        hash_cols = [(i, c) for i, c in enumerate(self.columns) if c != 'id']  # "id" column isn't imported
+        key_cols = [i for i, c in hash_cols if c in self.index_keys]
+        hashes = {}
+        for row in self.dbdata:
+            if any(row[i] is None for i in key_cols):
+                continue
+            idx = index_label(str(row[i]).strip() for i in key_cols)
+            hashes[idx] = row_hash([m2m_labels(row[i]) if c in m2m_fields else row[i] for i, c in hash_cols])
+        return hashes
+
+    def queryset(self):
+        """
+        Exported rows as lazy queryset i.e. single SQL statement with filters, only exported columns and stable
+        ordering (model's ordering, otherwise pk). References are rendered via LabelCache, so no joins are needed.
+        """
+        dbobjs = self.model.objects.all()
+        if self.filters:
+            if "EXCLUDE" in self.filters:
+                query = filter_q(self.filters.get("EXCLUDE"))
+                dbobjs = dbobjs.exclude(query) if query is not None else dbobjs
+            elif "INCLUDE" in self.filters:
+                query = filter_q(self.filters.get("INCLUDE"))
+                dbobjs = dbobjs.filter(query) if query is not None else dbobjs
+        columns = [f.name for f in self.model._meta.concrete_fields if f.name in self.data]
+        dbobjs = dbobjs.only(*columns)
+        return dbobjs if dbobjs.ordered else dbobjs.order_by('pk')
+
     def _fetch_data(self):
-        def fetch_data(o, data):
-            def get_ref_data(o, refs):
-                if not o:
-                    return None
-                value = ""
-                for ref in refs:
-                    obj = o
-                    for i in ref.split('.'):
-                        obj = getattr(obj, i)
-                    value = value + ' - ' + str(obj) if value else str(obj)
-                return value
+        labels = self.context.exporter.labels if self.context and self.context.exporter else LabelCache()
+        m2m_fields = {f.name for f in self.model._meta.many_to_many}
+        fkey_fields = {f.name: f for f in self.model._meta.fields if f.many_to_one}
+
+        def get_refs(config):
+            # Check if references is provided by user if not then we use 'pk'
+            return ('pk',) if not config.references else tuple(ref for _, ref in config.references)
 
+        m2m_values = {}  # field -> owner pk -> labels, see LabelCache.load_m2m
+
+        def fetch_data(o, data):
             vals = []
-            m2m_fields = [f.name for f in o._meta.many_to_many]
-            fkey_fields = [f.name for f in o._meta.fields if f.many_to_one]
             for field, config in data.items():
                 if field in m2m_fields:
-                    # Check if references is provided by user if not then we use 'pk'
-                    ref_fields = ['pk'] if not config.references else [ref for _, ref in config.references]
-                    ref_objs = getattr(o, field).all()
-                    vals.append('\n'.join(['* ' + get_ref_data(ref_obj, ref_fields) for ref_obj in ref_objs]))
+                    vals.append('\n'.join(['* ' + label for label in m2m_values[field].get(o.pk, [])]))
                 elif field in fkey_fields:
-                    ref_fields = ['pk'] if not config.references else [ref for _, ref in config.references]
-                    vals.append(get_ref_data(getattr(o, field), ref_fields))
+                    vals.append(labels.label(fkey_fields[field], getattr(o, fkey_fields[field].attname),
+                                             get_refs(config), lambda: getattr(o, field)))
                 else:
                     vals.append(getattr(o, field))
 
@@ -78,58 +274,123 @@ class ExportableSheet(object):
 
         logging.debug(f'Fetching data for [{self.name}]')
         self.dbdata = []
-        dbobjs = None
-        if self.filters:
-            def build_query(criteria):
-                queries = None
-                if criteria.get("or"):
-                    for item in criteria.get("or"):
-                        for v in item.get("values"):
-                            queries = Q(**{item.get("name"): v}) if not queries else queries | Q(**{item.get("name"): v})
-                if criteria.get("and"):
-                    for item in criteria.get("and"):
-                        for v in item.get("values"):
-                            queries = Q(**{item.get("name"): v}) if not queries else queries & Q(**{item.get("name"): v})
-                return queries
+        for owners, dbobjs in self.pages():
+            with span('render', self.name, self.context) as s:  # includes reference lookups
+                for field, config in self.data.items():
+                    if field in fkey_fields:
+                        fk = fkey_fields[field]
+                        labels.load(fk, [getattr(o, fk.attname) for o in dbobjs], get_refs(config))
+                    elif field in m2m_fields:
+                        m2m_values[field] = labels.load_m2m(self.model._meta.get_field(field), owners,
+                                                            get_refs(config))
+                self.dbdata.extend([fetch_data(o, self.data) for o in dbobjs])
+                s.rows = len(dbobjs)
+        self.row_count = len(self.dbdata)
 
-            if "EXCLUDE" in self.filters:
-                dbobjs = self.model.objects.exclude(build_query(self.filters.get("EXCLUDE")))
-            elif "INCLUDE" in self.filters:
-                dbobjs = self.model.objects.filter(build_query(self.filters.get("INCLUDE")))
+    def keyset(self) -> list:
+        """
+        Fields ordering paginated reads: pk, or index key columns followed by pk (tie breaker) if page_by is index_key.
+        Falls back to pk if an index key column is nullable (NULL never compares greater), many to many or not exported.
+        """
+        if self.page_by == 'index_key':
+            fields = [self.model._meta.get_field(k) for k in self.index_keys]
+            if fields and all(f.concrete and not f.many_to_many and not f.null and f.name in self.data for f in fields):
+                return [f.attname for f in fields] + ['pk']
+            logging.warning(f'Sheet [{self.name}]: index key {self.index_keys} has nullable, many to many or not '
+                            f'exported columns. Paging by pk.')
+        return ['pk']
 
-        if not dbobjs:
-            dbobjs = self.model.objects.only(*self.data.keys())
+    def pages(self):
+        """
+        Reads exported rows. If page_size is set, rows are read in keyset pages i.e.
+        `WHERE key > last ORDER BY key LIMIT page_size`, so that no long running query (or open cursor) is held on DB
+        and rows come in stable order of keyset (instead of model ordering). A page failing with OperationalError (e.g.
+        dropped connection, statement timeout) is read again on a new connection, resuming after last_key.
+        :return: generator of (owners i.e. queryset of page rows, model objects of page)
+        """
+        queryset = self.queryset()
+        if not self.page_size:
+            yield queryset, self._read_page(queryset)
+            return
 
-        self.dbdata.extend([fetch_data(o, self.data) for o in dbobjs])
+        keys = self.keyset()
+        queryset = queryset.order_by(*keys)
+        self.last_key = None
+        while True:
+            page = queryset if self.last_key is None else queryset.filter(keyset_q(keys, self.last_key))
+            dbobjs = self._read_page(page[:self.page_size])
+            if not dbobjs:
+                return
+            last_key = tuple(getattr(dbobjs[-1], k) for k in keys)
+            owners = page.filter(keyset_q(keys, last_key, 'lt', 'lte'))
+            self.last_key = last_key
+            yield owners, dbobjs
+            if len(dbobjs) < self.page_size:
+                return
+
+    def _read_page(self, queryset) -> list:
+        for attempt in range(1, PAGE_RETRIES + 1):
+            with span('fetch', self.name, self.context) as s:
+                try:
+                    dbobjs = list(queryset)
+                except OperationalError as e:
+                    connection = connections[queryset.db]
+                    if not self.page_size or attempt == PAGE_RETRIES or connection.in_atomic_block:
+                        raise
+                    logging.warning(f'Sheet [{self.name}]: reading page after {self.last_key} failed (attempt '
+                                    f'{attempt}/{PAGE_RETRIES}), retrying. Exception: {e}')
+                    connection.close()  # reconnects on next query
+                    continue
+                s.rows = len(dbobjs)
+            return dbobjs
 
 
 class Exporter(object):
-    def __init__(self):
-        self.sheets = Box(default_box=True)  # Maintains exportable sheets
-        pass
+    def __init__(self, context: Context, page_size=0, page_by='pk'):
+        """
+        :param context: job Context providing parser and xlwriter. Exporter registers itself as context.exporter
+        :param page_size: rows per DB query, 0 reads every sheet with single query. See ExportableSheet.pages
+        :param page_by: keyset of pages, pk or index_key. See ExportableSheet.keyset
+        """
+        if page_by not in PAGE_BY:
+            raise ValueError(f'Unsupported page_by [{page_by}], supported values are {PAGE_BY}')
+        self.context = context
+        self.page_size = page_size
+        self.page_by = page_by
+        self.context.exporter = self
+        self.sheets = SheetIndex()  # Maintains exportable sheets
+        self.labels = LabelCache()  # reference labels shared by all sheets
 
     def export(self):
-        for sheet_nm in Registry.parser.get_sheet_names(export_sequence=True):
-            sheet = Registry.parser.get_sheet(sheet_nm)
-            es = ExportableSheet.from_sheetdata(sheet)
-            self.sheets[sheet_nm] = es
-            logging.info(f'Exporting sheet [{sheet_nm}]')
-            Registry.xlwriter.update_sheet(sheet_nm, es.columns, es.dbdata, es.formatting)
-        Registry.xlwriter.final()
+        parser, xlwriter = self.context.parser, self.context.xlwriter
+        with span('export', context=self.context):
+            sheet_names = parser.get_sheet_names(export_sequence=True)
+            for cnt, sheet_nm in enumerate(sheet_names, 1):
+                with span('export_sheet', sheet_nm, self.context):
+                    sheet = parser.get_sheet(sheet_nm)
+                    es = ExportableSheet.from_sheetdata(sheet, self.context)
+                    self.sheets.register(sheet_nm, es.model, es, preferred=bool(sheet.get('reference_sheet')))
+                    logging.info(f'Exporting sheet [{sheet_nm}]')
+                    for shard_nm, rows in es.shards():
+                        xlwriter.update_sheet(shard_nm, es.columns, rows, es.formatting)
+                    if es.shard_count > 1:
+                        logging.info(f'Sheet [{sheet_nm}] has {es.row_count} rows, split into {es.shard_names()}')
+                        xlwriter.add_shards(sheet_nm, es.shard_names()[1:])
+                    if xlwriter.metadata is not None:
+                        xlwriter.add_metadata(sheet_nm, es.row_count, es.row_hashes())
+                    if xlwriter.write_only:
+                        es.dbdata = None  # rows are already streamed out, only row_count is needed further
+                self.context.report_progress('export', sheet_nm, cnt, len(sheet_names))
+            xlwriter.final(config_hash=parser.config_hash)
 
     def get_sheet(self, sheet_nm) -> ExportableSheet:
-        return getdictvalue(self.sheets, sheet_nm, None)
+        return self.sheets.get(sheet_nm)
 
-    def get_sheet_by_model(self, model_nm) -> ExportableSheet:
+    def get_sheet_by_model(self, model_nm, sheet_nm=None) -> ExportableSheet:
         """
-        Returns Exportable sheet by model name
-        :param model_nm:
+        Returns Exportable sheet by exact model name, see SheetIndex.get_by_model
+        :param model_nm: model name or class
+        :param sheet_nm: selects one of the sheets if model is exported as multiple sheets
         :return: Exportable Sheet
         """
-        matching_sheets = [v for _, v in Registry.exporter.sheets.items() if lower(model_nm) in lower(v.model.__name__)]
-        if len(matching_sheets) > 1:
-            raise ValueError(f'multiple sheets for model [{model_nm}]. Try providing full qualified name.')
-        elif not matching_sheets:
-            return None
-        else:
-            return matching_sheets[0]
+        return self.sheets.get_by_model(model_nm, sheet_nm)
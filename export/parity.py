@@ -0,0 +1,109 @@
+import openpyxl
+from openpyxl.utils import column_index_from_string
+
+WIDTH_TOLERANCE = 1 / 7  # one pixel of Calibri 11, engines round column widths to pixels differently
+PROTECTION_FLAGS = ('sheet', 'objects', 'scenarios', 'formatCells', 'formatRows', 'formatColumns', 'insertColumns',
+                    'insertRows', 'insertHyperlinks', 'deleteColumns', 'deleteRows', 'selectLockedCells',
+                    'selectUnlockedCells', 'sort', 'autoFilter', 'pivotTables')
+
+
+class WorkbookParityError(AssertionError):
+    """
+    Raised when workbooks written by different engines aren't equivalent
+    """
+    def __init__(self, differences: list):
+        self.differences = differences
+
+    def __str__(self):
+        return "Workbooks differ! " + "; ".join(self.differences)
+
+
+def _column_widths(ws) -> dict:
+    widths = {}
+    for letter, dim in ws.column_dimensions.items():
+        first = dim.min or column_index_from_string(letter)
+        for col in range(first, (dim.max or first) + 1):
+            widths[col] = dim.width
+    return widths
+
+
+def _tables(ws) -> dict:
+    return {t.displayName: (t.ref, t.autoFilter.ref if t.autoFilter else None,
+                            [c.name for c in t.tableColumns],
+                            (t.tableStyleInfo.name or None, bool(t.tableStyleInfo.showFirstColumn),
+                             bool(t.tableStyleInfo.showLastColumn), bool(t.tableStyleInfo.showRowStripes),
+                             bool(t.tableStyleInfo.showColumnStripes)) if t.tableStyleInfo else None)
+            for t in ws.tables.values()}
+
+
+def _data_validations(ws) -> list:
+    return sorted((str(dv.sqref), dv.type, dv.formula1, bool(dv.allow_blank), bool(dv.showErrorMessage),
+                   bool(dv.showInputMessage)) for dv in ws.data_validations.dataValidation)
+
+
+def _cell(c) -> tuple:
+    comment = (c.comment.text, c.comment.author, c.comment.width, c.comment.height) if c.comment else None
+    if c.value is None and not c.has_style and comment is None:
+        return None
+    return (c.value, c.number_format, bool(c.alignment.wrap_text), bool(c.protection.locked), comment)
+
+
+def _sheet_differences(nm, expected, actual) -> list:
+    diffs = []
+
+    def check(what, e, a):
+        if e != a:
+            diffs.append(f'[{nm}] {what}: {e} != {a}')
+
+    check('state', expected.sheet_state, actual.sheet_state)
+    check('tab color', expected.sheet_properties.tabColor.rgb[-6:] if expected.sheet_properties.tabColor else None,
+          actual.sheet_properties.tabColor.rgb[-6:] if actual.sheet_properties.tabColor else None)
+    check('freeze panes', expected.freeze_panes, actual.freeze_panes)
+    check('protection', [getattr(expected.protection, f) for f in PROTECTION_FLAGS],
+          [getattr(actual.protection, f) for f in PROTECTION_FLAGS])
+    check('tables', _tables(expected), _tables(actual))
+    check('data validations', _data_validations(expected), _data_validations(actual))
+    e_widths, a_widths = _column_widths(expected), _column_widths(actual)
+    for col in sorted(e_widths.keys() | a_widths.keys()):
+        e, a = e_widths.get(col), a_widths.get(col)
+        if e is None or a is None or abs(e - a) > WIDTH_TOLERANCE:
+            check(f'column [{col}] width', e, a)
+    e_rows = [[_cell(c) for c in row] for row in expected.iter_rows()]
+    a_rows = [[_cell(c) for c in row] for row in actual.iter_rows()]
+    for row_num in range(max(len(e_rows), len(a_rows))):
+        e_row = e_rows[row_num] if row_num < len(e_rows) else []
+        a_row = a_rows[row_num] if row_num < len(a_rows) else []
+        for col in range(max(len(e_row), len(a_row))):
+            check(f'cell [{row_num + 1}, {col + 1}]', e_row[col] if col < len(e_row) else None,
+                  a_row[col] if col < len(a_row) else None)
+    return diffs
+
+
+def workbook_differences(expected, actual, ignore_sheets=()) -> list:
+    """
+    Compares workbooks as far as export is concerned i.e. sheet order and visibility, cell values, number formats,
+    wrap & protection of cells, comments, column widths, tables, data validations, freeze panes, sheet protection and
+    tab color.
+    :param expected: excel file path or binary file-like object e.g. exported with openpyxl engine
+    :param actual: excel file path or binary file-like object e.g. exported with xlsxwriter engine
+    :param ignore_sheets: sheets not compared except their order e.g. metadata sheet holding export time
+    :return: list of differences, empty if workbooks are equivalent
+    """
+    e_wb, a_wb = openpyxl.load_workbook(expected), openpyxl.load_workbook(actual)
+    if e_wb.sheetnames != a_wb.sheetnames:
+        return [f'sheets: {e_wb.sheetnames} != {a_wb.sheetnames}']
+    diffs = []
+    for nm in e_wb.sheetnames:
+        if nm not in ignore_sheets:
+            diffs.extend(_sheet_differences(nm, e_wb[nm], a_wb[nm]))
+    return diffs
+
+
+def assert_workbooks_equivalent(expected, actual, ignore_sheets=()):
+    """
+    Raises WorkbookParityError if workbooks differ, see workbook_differences. Useful to check that writer engines
+    (see excel_writter.create_writer) produce equivalent exports, e.g. in test suites of projects using this library.
+    """
+    diffs = workbook_differences(expected, actual, ignore_sheets)
+    if diffs:
+        raise WorkbookParityError(diffs)
@@ -0,0 +1,293 @@
+import itertools
+import logging
+import types
+import zipfile
+from xml.sax.saxutils import escape
+
+from openpyxl.cell.cell import TIME_FORMATS, ILLEGAL_CHARACTERS_RE
+from openpyxl.comments.comment_sheet import CommentRecord, CommentSheet
+from openpyxl.compat.numbers import NUMERIC_TYPES
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.utils.datetime import to_excel
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.worksheet.datavalidation import DataValidationList
+from openpyxl.worksheet.page import PageMargins
+from openpyxl.worksheet.views import SheetView
+from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.writer.theme import theme_xml
+from openpyxl.xml.functions import tostring
+
+from .excel_format import TableFormat
+from .excel_writter import BaseXlsWriter
+from ..instrumentation import span
+
+SHEET_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+ATTR_ENTITIES = {'"': '&quot;'}
+WORKSHEET_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+
+
+class SpreadsheetMLWriterEngine(BaseXlsWriter):
+    """
+    Writes SpreadsheetML parts of xlsx package directly. Sheet XML is compressed into the zip as rows are written, hence
+    memory doesn't grow with row count and bytes reach an unseekable target (e.g. ChunkSink) while export is still
+    running. Parts listing all sheets (workbook, styles, content types) are written in final().
+    Strings are written inline instead of a shared strings table. Sheets, tables, column widths, comments, data
+    validations and protection are same as with XlsWriter, see export.parity. Always streams, hence write_only is set.
+    """
+    BATCH_ROWS = 1000  # rows compressed per write
+    DEFAULT_FONT = '<font><sz val="11"/><color theme="1"/><name val="Calibri"/><family val="2"/>' \
+                   '<scheme val="minor"/></font>'  # same as openpyxl
+
+    def __init__(self, filename, overwrite=False, write_only=True, metadata=False):
+        super().__init__(filename, overwrite, True, metadata)
+        self._zip = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED)  # Can raise PermissionError
+        self._sheet_order = []  # sheet names in order openpyxl would hold them before final()
+        self._parts = {}  # sheet name -> (sheet part number, state)
+        self._overrides = []  # (part name, content type) of written parts
+        self._tables = self._comments = 0
+        self._xfs = {(None, None): 0}  # (locked, num_format) -> cell format index, see _format
+        self._xf_keys = [(None, None)]  # cell format index -> (locked, num_format)
+
+    def _format(self, locked=None, num_format=None) -> int:
+        """
+        Index of cell format, see styles.xml written by final()
+        :param locked: None for unstyled cell, otherwise wrapped text cell with given protection (see XlsWriter)
+        :param num_format: number format of date/time values, same as openpyxl assigns
+        """
+        key = (locked, num_format)
+        if key not in self._xfs:
+            self._xfs[key] = len(self._xf_keys)
+            self._xf_keys.append(key)
+        return self._xfs[key]
+
+    def _cell(self, ref, value, style) -> str:
+        """ XML of cell at ref, same value conversion as openpyxl. Empty string if cell isn't written at all. """
+        if value is None or value == '':  # openpyxl doesn't write empty strings either
+            return f'<c r="{ref}" s="{style}"/>' if style else ''
+        num_format = TIME_FORMATS.get(type(value))
+        if num_format:
+            return f'<c r="{ref}" s="{self._format(self._xf_keys[style][0], num_format)}"><v>{to_excel(value)}</v></c>'
+        s = f' s="{style}"' if style else ''
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{s} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, NUMERIC_TYPES):
+            return f'<c r="{ref}"{s}><v>{value}</v></c>'
+        if not isinstance(value, str):
+            raise ValueError(f'Cannot convert {value!r} to Excel')
+        if ILLEGAL_CHARACTERS_RE.search(value):
+            raise IllegalCharacterError(f'{value} cannot be used in worksheets.')
+        if value.startswith('=') and len(value) > 1:  # formula, same as openpyxl
+            return f'<c r="{ref}"{s}><f>{escape(value[1:])}</f><v></v></c>'
+        space = ' xml:space="preserve"' if value.strip() != value else ''
+        return f'<c r="{ref}"{s} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+    def _add_sheet(self, sheet_nm, tf: TableFormat, state='visible') -> int:
+        """ Registers sheet and tracks its position same as XlsWriter._get_sheet_by_name, returns its part number """
+        if tf is not None:
+            self._sheet_pos[sheet_nm] = tf.sheet_position
+            if self._sheet_order or self.write_only:
+                self._sheet_order.insert(tf.sheet_position - 1 if tf.sheet_position != -1 else -1, sheet_nm)
+        number = len(self._parts) + 1
+        self._parts[sheet_nm] = (number, state)
+        return number
+
+    def _write_sheet(self, number, rows, column_count, sheet_props=None, widths=None, freeze_panes=None,
+                     protection=None, data_validations=(), comments=(), table=None, row_count=None):
+        """
+        Writes sheet part and its relationships, tables and comments
+        :param rows: iterable of rows, each an iterable of (value, cell format index)
+        :param column_count: number of columns
+        :param widths: dict(column number -> width)
+        :param comments: CommentRecord of header cells
+        :param table: Table or None
+        :param row_count: number of rows (including header) for dimension of sheet, None if not known upfront
+        """
+        letters = [get_column_letter(i) for i in range(1, max(column_count, 1) + 1)]
+        part = f'xl/worksheets/sheet{number}.xml'
+        rels, parts = [], []  # (type, target) of sheet relationships, (path, xml, content type) of sheet parts
+        view = types.SimpleNamespace(sheet_view=SheetView())
+        Worksheet.freeze_panes.fset(view, freeze_panes)  # same panes and selections as openpyxl sets
+        # size isn't known upfront and a sheet of few rows can exceed 2 GiB of XML (32767 characters per cell)
+        with self._zip.open(part, 'w', force_zip64=True) as f:
+            head = [XML_DECLARATION, f'<worksheet xmlns="{SHEET_MAIN_NS}" xmlns:r="{REL_NS}">']
+            if sheet_props is not None:
+                head.append(tostring(sheet_props.to_tree()).decode())
+            if row_count is not None:
+                head.append(f'<dimension ref="A1:{letters[-1]}{row_count}"/>')
+            head.append(f'<sheetViews>{tostring(view.sheet_view.to_tree()).decode()}</sheetViews>')
+            head.append('<sheetFormatPr baseColWidth="8" defaultRowHeight="15"/>')
+            if widths:
+                head.append('<cols>' + ''.join(f'<col min="{i}" max="{i}" width="{w}" customWidth="1"/>'
+                                               for i, w in sorted(widths.items())) + '</cols>')
+            head.append('<sheetData>')
+            f.write(''.join(head).encode('utf-8'))
+
+            batch = []
+            for row_num, row in enumerate(rows, 1):
+                cells = ''.join(self._cell(f'{letters[col]}{row_num}', value, style)
+                                for col, (value, style) in enumerate(row))
+                batch.append(f'<row r="{row_num}">{cells}</row>')
+                if len(batch) >= self.BATCH_ROWS:
+                    f.write(''.join(batch).encode('utf-8'))
+                    batch.clear()
+
+            tail = batch + ['</sheetData>']
+            if protection is not None:
+                tail.append(tostring(protection.to_tree()).decode())
+            if data_validations:
+                tail.append(tostring(DataValidationList(dataValidation=list(data_validations)).to_tree()).decode())
+            tail.append(tostring(PageMargins().to_tree()).decode())
+            if comments:
+                self._comments += 1
+                cs = CommentSheet.from_comments(list(comments))
+                cs._id = self._comments
+                vml = f'xl/drawings/commentsDrawing{cs._id}.vml'
+                parts += [(cs.path, tostring(cs.to_tree()), cs.mime_type), ('/' + vml, cs.write_shapes(), None)]
+                rels += [(f'{REL_NS}/comments', cs.path), (f'{REL_NS}/vmlDrawing', '/' + vml)]
+                tail.append(f'<legacyDrawing r:id="rId{len(rels)}"/>')
+            if table is not None:
+                self._tables += 1
+                table.id = self._tables
+                parts.append((table.path, tostring(table.to_tree()), table.mime_type))
+                rels.append((f'{REL_NS}/table', table.path))
+                tail.append(f'<tableParts count="1"><tablePart r:id="rId{len(rels)}"/></tableParts>')
+            tail.append('</worksheet>')
+            f.write(''.join(tail).encode('utf-8'))
+
+        # parts of sheet can be written only once sheet part is complete
+        self._overrides.append(('/' + part, WORKSHEET_CONTENT_TYPE))
+        for path, xml, content_type in parts:
+            self._zip.writestr(path[1:], xml)
+            if content_type:
+                self._overrides.append((path, content_type))
+        if rels:
+            self._zip.writestr(f'xl/worksheets/_rels/sheet{number}.xml.rels', self._relationships(rels))
+
+    @staticmethod
+    def _relationships(rels) -> str:
+        """ :param rels: (type, target) of relationships with ids rId1, rId2 ... """
+        return XML_DECLARATION + f'<Relationships xmlns="{PKG_REL_NS}">' + ''.join(
+            f'<Relationship Id="rId{i}" Type="{t}" Target="{escape(target)}"/>'
+            for i, (t, target) in enumerate(rels, 1)) + '</Relationships>'
+
+    def update_sheet(self, sheet_nm, columns, data, tf: TableFormat):
+        logging.debug(f'Creating/Updating name [{sheet_nm}]')
+        if not columns or not data:
+            logging.error(f'[{"columns" if not columns else "data"}] required but received None')
+
+        with span('write', sheet_nm) as s:
+            number = self._add_sheet(sheet_nm, tf)
+            if len(data) <= 0:
+                logging.error(f'No values to insert for [{sheet_nm}]')
+                comments = []
+                if columns:
+                    comment = CommentRecord(ref='A1', author='django-excel-transformer')
+                    comment.text.t = 'No data available for insert'
+                    comments.append(comment)
+                self._write_sheet(number, [[(col, 0) for col in columns]], len(columns),
+                                  sheet_props=tf.formatters.sheet_props, comments=comments, row_count=1)
+                return
+
+            col_lock = False
+            with span('style', sheet_nm):
+                cfs = [tf.get_column(col, default=True) for col in columns]
+                styles, dvs, comments = [], [], []  # per column cell format index, data validations, header comments
+                for i, cf in enumerate(cfs):
+                    cr = cf.formatters.get('reference', None)
+                    if cr and cf.formatters.get('dv', True):
+                        dvs.append(self._data_validation(cr, cf.column_number, len(data)))
+                    if tf.formatters.alignment.wrapText is True:
+                        locked = bool(cf.formatters.locked or tf.formatters.locked)
+                        col_lock = col_lock or locked
+                        styles.append(self._format(locked))
+                    else:
+                        styles.append(0)
+                    comment = cf.formatters.comment or None
+                    if comment:
+                        record = CommentRecord(ref=f'{get_column_letter(i + 1)}1', author=comment.author,
+                                               height=comment.height, width=comment.width)
+                        record.text.t = comment.text
+                        comments.append(record)
+
+            rows = itertools.chain([zip(columns, styles)], (zip(d, styles) for d in data))
+            self._write_sheet(number, rows, len(columns), sheet_props=tf.formatters.sheet_props,
+                              widths={column_index_from_string(cf.column_number): cf.formatters.width for cf in cfs},
+                              freeze_panes=tf.formatters.freeze_panes,
+                              protection=self._protection(tf, col_lock), data_validations=dvs, comments=comments,
+                              table=self._table(sheet_nm, columns, len(data), tf), row_count=len(data) + 1)
+            s.rows = len(data)
+
+    def _styles(self) -> str:
+        """ styles.xml with cell formats registered by _format """
+        num_formats = {}  # format code -> id
+        xfs = []
+        for locked, num_format in self._xf_keys:
+            num_fmt_id = 0
+            if num_format:
+                num_fmt_id = BUILTIN_FORMATS_REVERSE.get(num_format)
+                if num_fmt_id is None:
+                    num_fmt_id = num_formats.setdefault(num_format, 164 + len(num_formats))
+            attrs = f'numFmtId="{num_fmt_id}" fontId="0" fillId="0" borderId="0" xfId="0"'
+            if num_fmt_id:
+                attrs += ' applyNumberFormat="1"'
+            if locked is None:
+                xfs.append(f'<xf {attrs}/>')
+            else:
+                xfs.append(f'<xf {attrs} applyAlignment="1" applyProtection="1"><alignment wrapText="1"/>'
+                           f'<protection locked="{int(locked)}"/></xf>')
+        styles = [XML_DECLARATION, f'<styleSheet xmlns="{SHEET_MAIN_NS}">']
+        if num_formats:
+            styles.append(f'<numFmts count="{len(num_formats)}">' + ''.join(
+                f'<numFmt numFmtId="{i}" formatCode="{escape(code, ATTR_ENTITIES)}"/>'
+                for code, i in num_formats.items()) + '</numFmts>')
+        styles.append(f'<fonts count="1">{self.DEFAULT_FONT}</fonts>'
+                      '<fills count="2"><fill><patternFill/></fill><fill><patternFill patternType="gray125"/></fill>'
+                      '</fills><borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+                      '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>')
+        styles.append(f'<cellXfs count="{len(xfs)}">' + ''.join(xfs) + '</cellXfs>')
+        styles.append('<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+                      '<tableStyles count="0" defaultTableStyle="TableStyleMedium9" '
+                      'defaultPivotStyle="PivotStyleLight16"/></styleSheet>')
+        return ''.join(styles)
+
+    def final(self, config_hash=None):
+        with span('final') as s:
+            s.rows = len(self._sheet_pos)
+            order = self._arranged(self._sheet_order)
+            if self.metadata is not None:
+                for sheet_nm, rows in self._metadata_sheets(config_hash):
+                    number = self._add_sheet(sheet_nm, None, state='hidden')
+                    self._write_sheet(number, ([(v, 0) for v in row] for row in rows), 4)
+                    order.append(sheet_nm)
+
+            with span('save'):
+                sheets = ''.join(
+                    f'<sheet name="{escape(nm, ATTR_ENTITIES)}" sheetId="{self._parts[nm][0]}" '
+                    + (f'state="{self._parts[nm][1]}" ' if self._parts[nm][1] != 'visible' else '')
+                    + f'r:id="rId{self._parts[nm][0]}"/>' for nm in order)
+                self._zip.writestr('xl/workbook.xml', XML_DECLARATION + (
+                    f'<workbook xmlns="{SHEET_MAIN_NS}" xmlns:r="{REL_NS}"><workbookPr/>'
+                    f'<bookViews><workbookView activeTab="0"/></bookViews><sheets>{sheets}</sheets></workbook>'))
+                numbers = sorted(number for number, _ in self._parts.values())
+                self._zip.writestr('xl/_rels/workbook.xml.rels', self._relationships(
+                    [(f'{REL_NS}/worksheet', f'/xl/worksheets/sheet{n}.xml') for n in numbers]
+                    + [(f'{REL_NS}/styles', '/xl/styles.xml'), (f'{REL_NS}/theme', '/xl/theme/theme1.xml')]))
+                self._zip.writestr('xl/styles.xml', self._styles())
+                self._zip.writestr('xl/theme/theme1.xml', theme_xml)
+                self._zip.writestr('_rels/.rels', self._relationships(
+                    [(f'{REL_NS}/officeDocument', '/xl/workbook.xml')]))
+                overrides = self._overrides + [
+                    ('/xl/workbook.xml', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml'),
+                    ('/xl/styles.xml', 'application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml'),
+                    ('/xl/theme/theme1.xml', 'application/vnd.openxmlformats-officedocument.theme+xml')]
+                self._zip.writestr('[Content_Types].xml', XML_DECLARATION + (
+                    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                    '<Default Extension="xml" ContentType="application/xml"/>'
+                    '<Default Extension="vml" ContentType="application/vnd.openxmlformats-officedocument.vmlDrawing"/>'
+                    + ''.join(f'<Override PartName="{p}" ContentType="{t}"/>' for p, t in overrides) + '</Types>'))
+                self._zip.close()
@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+
+from django.db import connections
+
+from ..common import Context
+from .exporter import Exporter
+from .spreadsheetml_engine import SpreadsheetMLWriterEngine
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class ChunkSink(object):
+    """
+    Unseekable binary file-like object handing over written bytes as chunks to a consumer thread.
+    Bounded queue ensures producer doesn't run ahead of consumer (e.g. slow browser download).
+    """
+    POLL_TIMEOUT = 1
+
+    def __init__(self, chunk_size=64 * 1024, max_chunks=16):
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = bytearray()
+        self.cancelled = False
+        self.error = None
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put(item, timeout=ChunkSink.POLL_TIMEOUT)
+                return
+            except queue.Full:
+                if self.cancelled:
+                    raise IOError('Export cancelled by consumer')
+
+    def write(self, data):
+        if self.cancelled:
+            raise IOError('Export cancelled by consumer')
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer and not self.cancelled:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        self._put(None)
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self.cancelled = True
+        if self.error:
+            raise self.error
+
+
+def export_to(sink, context: Context):
+    """
+    Exports workbook into a binary file-like sink. Sheets are compressed into sink as their rows are written (see
+    SpreadsheetMLWriterEngine), so bytes reach sink while export runs and the full workbook is never held in memory.
+    :param sink: binary file-like object, need not be seekable e.g. BytesIO, HttpResponse, ChunkSink
+    :param context: job Context with parsed parser
+    """
+    context.xlwriter = SpreadsheetMLWriterEngine(sink)
+    with context.activate():
+        Exporter(context).export()
+
+
+def iter_export(context: Context, chunk_size=64 * 1024):
+    """
+    Generates workbook bytes as export progresses, first chunk follows the first rows of the first sheet. Export runs in
+    a background thread and starts once the first chunk is requested.
+    :param context: job Context with parsed parser
+    :param chunk_size: approx size of yielded chunks
+    :return: generator of bytes
+    """
+    sink = ChunkSink(chunk_size=chunk_size)
+
+    def produce():
+        try:
+            export_to(sink, context)
+        except Exception as e:
+            logging.error(f'Streaming export failed. Exception: {e}')
+            sink.error = e
+        finally:
+            connections.close_all()
+            if not sink.cancelled:
+                sink.close()
+
+    def generate():
+        threading.Thread(target=produce, name='det-export', daemon=True).start()
+        yield from sink
+
+    return generate()
+
+
+def export_response(context: Context, filename='export.xlsx', chunk_size=64 * 1024):
+    """
+    Django view helper returning exported workbook as browser download.
+    e.g. `return export_response(Context(parser=parser), 'panopticum.xlsx')` from a view, parser being parsed once.
+    :param context: job Context with parsed parser
+    :param filename: download file name
+    :param chunk_size: approx size of streamed chunks
+    :return: StreamingHttpResponse
+    """
+    from django.http import StreamingHttpResponse
+
+    response = StreamingHttpResponse(iter_export(context, chunk_size), content_type=XLSX_CONTENT_TYPE)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
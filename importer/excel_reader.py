@@ -1,24 +1,135 @@
+import itertools
 import logging
-import openpyxl
+from collections.abc import Mapping
 
 from box import Box
 from openpyxl.worksheet.worksheet import Worksheet
-from .validator import Validator
+from .validator import Validator, XlSheetError
+from .xl_engine import ENGINES
+from ..common import METADATA_SHEET, index_key, shard_name
+from ..instrumentation import span
+
+
+class XlRow(Mapping):
+    """
+    Read-only row of XlSheet i.e. just sheet and row offset instead of dict of cell values. Supports dict and attribute
+    access same as row Box of iter_xldata.
+    """
+    __slots__ = ('_sheet', '_offset')
+
+    def __init__(self, sheet, offset: int):
+        self._sheet = sheet
+        self._offset = offset
+
+    def __getitem__(self, title):
+        return self._sheet.columns[title][self._offset]
+
+    def __getattr__(self, title):
+        try:
+            return self[title]
+        except KeyError:
+            raise AttributeError(title)
+
+    def __iter__(self):
+        return iter(self._sheet.columns)
+
+    def __len__(self):
+        return len(self._sheet.columns)
+
+    def __repr__(self):
+        return f'<XlRow {self._sheet.name}[{self._offset}] {dict(self)}>'
+
+    def to_json(self) -> str:
+        return Box(self.items()).to_json()
+
+
+class XlSheet(object):
+    """
+    Columnar in-memory sheet: one list of cell values per column plus index key -> row offset. Rows don't carry their
+    own dict, see XlRow.
+    """
+
+    def __init__(self, name, titles):
+        self.name = name
+        self.columns = {title: [] for title in titles}  # title -> cell values, in column order
+        self.offsets = {}  # index key -> row offset, last row wins for duplicate index
+
+    def append(self, idx: tuple, values) -> int:
+        offset = self.row_count
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+        self.offsets[idx] = offset
+        return offset
+
+    @property
+    def row_count(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def row(self, offset: int) -> XlRow:
+        return XlRow(self, offset)
+
+    def get(self, idx: tuple, default=None) -> XlRow:
+        offset = self.offsets.get(idx)
+        return default if offset is None else self.row(offset)
+
+    def items(self):
+        """ (index key, XlRow) in row order """
+        for idx, offset in self.offsets.items():
+            yield idx, self.row(offset)
+
+    def __len__(self):
+        return len(self.offsets)
 
 
 class XlsReader:
-    def __init__(self, filename):
-        self._wb = openpyxl.load_workbook(filename, data_only=True)
+    ENGINES = tuple(ENGINES)
+
+    def __init__(self, filename, read_only=False, engine='openpyxl'):
+        """
+        :param filename: excel file path or binary file-like object
+        :param read_only: rows are streamed from the file instead of loading whole workbook in memory. Call close()
+                          once done.
+        :param engine: openpyxl (default) or spreadsheetml -- faster, reads cell values straight from sheet XML and
+                       always streams, see xl_engine.SpreadsheetMLEngine
+        """
+        if engine not in ENGINES:
+            raise ValueError(f'Unsupported excel reader engine [{engine}], supported engines are {self.ENGINES}')
+        with span('load_workbook') as s:
+            self._engine = ENGINES[engine](filename, read_only=read_only)
+            s.rows = len(self._engine.sheetnames)
+        self.read_only = self._engine.read_only
         self.validator = Validator()
 
+    def close(self):
+        self._engine.close()
+
+    def get_metadata(self):
+        """
+        Export metadata written by XlsWriter, None if workbook doesn't have it. Metadata split across several sheets
+        (see BaseXlsWriter._metadata_sheets) is read as a single sheet.
+        :return: dict with config_hash, exported_at, row_counts(sheet -> count), row_hashes(sheet -> index -> hash)
+        """
+        if METADATA_SHEET not in self._engine.sheetnames:
+            return None
+        metadata = dict(row_counts={}, row_hashes={})
+        rows = itertools.chain.from_iterable(itertools.islice(self._engine.iter_rows(sheet_nm), 1, None)
+                                             for sheet_nm in self.shard_names(METADATA_SHEET))
+        for row in rows:
+            row_type, sheet_nm, key, value = (tuple(row) + (None,) * 4)[:4]
+            if row_type == 'row_hash':
+                metadata['row_hashes'].setdefault(sheet_nm, {})[key] = value
+            elif row_type == 'row_count':
+                metadata['row_counts'][sheet_nm] = value
+            elif row_type:
+                metadata[row_type] = value
+        return metadata
+
     def get_xl_table(self, ws: Worksheet):
         xl_table = Box(default_box=True)
         xl_table.headers = []
         xl_table.rows = []
 
-        for row in ws.iter_rows():
-            if row[0].value is None or str(row[0].value).strip() == "":
-                break
+        for row in self._iter_xl_table(ws):
             if xl_table.headers:
                 xl_table.rows.append(row)
             else:
@@ -26,25 +137,108 @@ class XlsReader:
 
         return xl_table
 
-    def get_xldata(self, sheet_nm, index_keys) -> Box:
-        table = self.get_xl_table(self._wb[sheet_nm])
+    @staticmethod
+    def _iter_xl_table(ws: Worksheet):
+        """ Yields header row and then data rows till first row with empty first cell """
+        for row in ws.iter_rows():
+            if not row or row[0].value is None or str(row[0].value).strip() == "":
+                break
+            yield row
 
-        self.validator.xl_index_keys(table.headers, index_keys)
+    @staticmethod
+    def _iter_xl_values(rows):
+        """ Same as _iter_xl_table but over tuples of cell values e.g. engine rows """
+        for row in rows:
+            if not row or row[0] is None or str(row[0]).strip() == "":
+                break
+            yield row
 
-        logging.debug("Loading sheet [%s]", sheet_nm)
+    def get_xldata(self, sheet_nm, index_keys, fields=None) -> Box:
+        with span('read', sheet_nm) as s:
+            datadict = self._get_xldata(sheet_nm, index_keys, fields)
+            s.rows = len(datadict)
+        return datadict
+
+    def _get_xldata(self, sheet_nm, index_keys, fields=None) -> Box:
         datadict = Box(default_box=True)
-        idx = None
-
-        for row in table.rows:
-            idx = ""
-            xl_row = {}
-            for col_num, col_title in enumerate(table.headers):
-                col_title = col_title.value.strip()
-                if col_title != "id":  # not interested in "id" column
-                    if col_title in index_keys:
-                        idx = row[col_num].value.strip() if idx is "" else idx + ' - ' + row[
-                            col_num].value.strip()
-                    xl_row[col_title] = row[col_num].value
+        for idx, xl_row in self.iter_xldata(sheet_nm, index_keys, fields):
             datadict[idx] = xl_row
-            # logging.debug(f"xlsrow {datadict[idx]}")
         return datadict
+
+    def compile_header(self, sheet_nm, header, index_keys, fields=None) -> tuple:
+        """
+        Validates header row once and maps columns to positions
+        :param header: header row values
+        :param index_keys: index columns, required
+        :param fields: config fields of sheet, optional
+        :return: tuple(column titles, column positions, index column positions), "id" column is skipped
+        :raises: XlSheetError
+        """
+        titles = [t.strip() if isinstance(t, str) else t for t in header]
+        self.validator.validate_all(sheet_nm, titles, index_keys, fields)
+        columns = [(pos, title) for pos, title in enumerate(titles) if title != "id"]  # not interested in "id"
+        return ([title for _, title in columns], [pos for pos, _ in columns],
+                [pos for pos, title in columns if title in index_keys])  # index follows column order
+
+    def iter_xldata(self, sheet_nm, index_keys, fields=None):
+        """
+        Streams sheet rows, so that callers don't need whole sheet in memory (see read_only)
+        :param fields: config fields of sheet, columns not part of it are reported
+        :return: generator of (index key tuple, row Box)
+        :raises: XlSheetError if header or an index value is invalid
+        """
+        titles, rows = self._compiled_rows(sheet_nm, index_keys, fields)
+        for idx, values in rows:
+            yield idx, Box(zip(titles, values), default_box=True)
+
+    def get_xlsheet(self, sheet_nm, index_keys, fields=None) -> XlSheet:
+        """
+        Loads sheet in columnar form, see XlSheet. Arguments same as iter_xldata.
+        :raises: XlSheetError if header or an index value is invalid
+        """
+        titles, rows = self._compiled_rows(sheet_nm, index_keys, fields)
+        xl_sheet = XlSheet(sheet_nm, titles)
+        for idx, values in rows:
+            xl_sheet.append(idx, values)
+        return xl_sheet
+
+    def shard_names(self, sheet_nm) -> list:
+        """ Sheets holding rows of sheet i.e. sheet itself followed by its shards, see ExportableSheet.shards """
+        sheetnames = set(self._engine.sheetnames)
+        names = [sheet_nm]
+        while shard_name(sheet_nm, len(names) + 1) in sheetnames:
+            names.append(shard_name(sheet_nm, len(names) + 1))
+        return names
+
+    def _compiled_rows(self, sheet_nm, index_keys, fields=None) -> tuple:
+        """
+        Validates header rows (eagerly) and rows (lazily). Shards of sheet are read as a single sheet, their header must
+        be same as of sheet.
+        :return: tuple(column titles, generator of (index key tuple, cell values in title order))
+        """
+        rows = self._iter_xl_values(self._engine.iter_rows(sheet_nm))
+        header = next(rows, ())
+        titles, positions, index_positions = self.compile_header(sheet_nm, header, index_keys, fields)
+        width = len(header)
+        index_titles = [header[pos].strip() for pos in index_positions]
+        shards = [(sheet_nm, rows)]
+        for shard_nm in self.shard_names(sheet_nm)[1:]:
+            shard_rows = self._iter_xl_values(self._engine.iter_rows(shard_nm))
+            shard_header = next(shard_rows, ())
+            if tuple(shard_header) != tuple(header):
+                raise XlSheetError(shard_nm, f'columns {list(shard_header)} differ from sheet [{sheet_nm}] columns '
+                                             f'{list(header)}')
+            shards.append((shard_nm, shard_rows))
+
+        def compiled_rows():
+            for shard_nm, shard_rows in shards:
+                logging.debug("Loading sheet [%s]", shard_nm)
+                for row_num, row in enumerate(shard_rows, 2):
+                    if len(row) < width:  # read_only rows can be shorter
+                        row = row + (None,) * (width - len(row))
+                    index_values = [row[pos] for pos in index_positions]
+                    if not all(isinstance(v, str) for v in index_values):
+                        self.validator.xl_record(shard_nm, row_num, dict(zip(index_titles, index_values)))
+                    yield index_key(v.strip() for v in index_values), [row[pos] for pos in positions]
+
+        return titles, compiled_rows()
@@ -1,5 +1,7 @@
+import itertools
 import logging
 import re, json
+import threading
 from typing import Union
 
 import pandas as pd
@@ -7,9 +9,17 @@ from enum import Enum, IntEnum
 from django.conf import settings
 from datetime import datetime
 from box import Box, BoxList
+from django.core.exceptions import FieldError, FieldDoesNotExist
+from django.db import transaction
 from django.db.models import TextField, CharField, Model
 
-from ..common import nm, Registry, getdictvalue
+from ..common import nm, Context, SheetIndex, getdictvalue, index_key, index_label, INDEX_SEPARATOR, row_hash, \
+    m2m_labels, select_related_paths, values_equal
+from ..instrumentation import span
+from .excel_reader import XlRow
+from .merge import merge_join, UnsortedInputError
+from .scheduler import DagExecutor
+from .store import MemoryRecordStore, SpillRecordStore
 import attr
 
 
@@ -44,11 +54,12 @@ class Record:
     2. MISSING record -> DB record not available in XL. `xl_record` not filled, `db_record` filled
     3. UPDATE record -> Change between XL & DB record. `xl_record` filled, `db_record` filled
     4. NO CHANGE record -> Same XL & DB record. `xl_record` filled, `db_record` blank
+    `xl_record` is XlRow (i.e. row offset into columnar sheet) unless records are spilled to disk.
 
     IMP: For each reference record we will have in-memory Record provided dependent tables are loaded first.
     """
 
-    xl_record: Box = None
+    xl_record: Union[XlRow, Box] = None
     db_record: Model = None
     refobjs: Box = None
     status: Status = Status.PENDING
@@ -69,7 +80,9 @@ class Record:
         elif field == 'xl_record':
             return self.xl_record.to_json() if self.xl_record else None
         elif field == 'db_record':
-            db_data = {i: v for i, v in vars(self.db_record).items() if i != '_state'} if self.db_record else None
+            # skip django internals e.g. _state, _django_version of unpickled (spilled) records
+            db_data = {i: v for i, v in vars(self.db_record).items() if not i.startswith('_')} \
+                if self.db_record else None
             return json.dumps(db_data, sort_keys=True, default=str) if db_data else None
         elif field == 'mismatches':
             json_str = '{"mismatches": ['
@@ -111,15 +124,18 @@ class ImportableSheet:
     model: Model
     config_data: Box
     index_keys: BoxList
-    records: Box
+    records: Union[MemoryRecordStore, SpillRecordStore]  # index -> Record
     total_db_records: int
     total_xl_records: int
     report: Report
     status: Status
     read_only: bool
+    context: Context = attr.ib(default=None, repr=False, eq=False)
+    untouched_records: int = None  # records unchanged in excel since export, known only if excel has metadata
+    db_changed_records: int = None  # untouched records whose DB record changed after export
 
     @classmethod
-    def from_sheetdata(cls, sheetdata: Box):
+    def from_sheetdata(cls, sheetdata: Box, context: Context):
         if not sheetdata:
             raise ValueError('Sheet_details missing')
 
@@ -130,16 +146,23 @@ class ImportableSheet:
         index_keys = getdictvalue(getdictvalue(sheetdata, 'dataset', None), 'index_key', None)
         read_only = getdictvalue(getdictvalue(sheetdata, 'formatting', False), 'read_only', False)
         obj = cls(name=sheet_nm, model=model, config_data=data, config_filters=filters,
-                  index_keys=index_keys, records=Box(), total_db_records=0, total_xl_records=0, report=Report(),
+                  index_keys=index_keys, records=context.importer.create_record_store(sheet_nm)
+                  if context and context.importer else MemoryRecordStore(),
+                  total_db_records=0, total_xl_records=0, report=Report(),
                   status=Status.NO_CHANGE,
-                  read_only=read_only)
+                  read_only=read_only, context=context)
         return obj
 
     def load_xl(self):
-        xl_data = Registry.xlreader.get_xldata(self.name, self.index_keys)
-        for idx, record in xl_data.items():
-            self.records[idx] = Record(xl_record=record, status=Status.XL)
-        self.total_xl_records = len(self.records)
+        with span('read', self.name, self.context) as s:
+            reader = self.context.xlreader
+            if self.records.in_memory:
+                xl_rows = reader.get_xlsheet(self.name, self.index_keys, self.config_data.keys()).items()
+            else:  # spilled records are pickled one by one, hence rows carry their own values
+                xl_rows = reader.iter_xldata(self.name, self.index_keys, self.config_data.keys())
+            for idx, record in xl_rows:
+                self.records[idx] = Record(xl_record=record, status=Status.XL)
+            s.rows = self.total_xl_records = len(self.records)
 
     def compare(self, xl_record, db_record):
         """ Compares xl record vs db record.
@@ -160,15 +183,15 @@ class ImportableSheet:
             for f, value in xl_record.items():
                 references = self.config_data[f].references  # TODO: HG: This can throw key error
                 if references:
-                    ref_model = ""
                     if f in m2m_fields:
                         values = [re.sub('^\* ', '', i) for i in value.rsplit('\n')]
                     else:
                         values = [value]
 
+                    ref_model = references[0][0]  # only $model starting refs are supported, see Parser
+                    ref_fields = tuple(ref_field for _, ref_field in references)
                     for v in values:
-                        refs = Box()
-                        if len(references) != len(v.split(' - ')):
+                        if v.count(INDEX_SEPARATOR) < len(references) - 1:  # values may contain separator too
                             # we have invalid configuration for this reference and exported data doesn't honor this config.
                             # We cannot proceed with further checking of this record.
                             mismatches.append(
@@ -176,42 +199,30 @@ class ImportableSheet:
                                          message=f'Configuration mismatch for field [{f}] and xls data. Cannot get importer.',
                                          extra_info=None))
                             continue
-                        for idx, ref in enumerate(references):
-                            # We can have multiple references
-                            # e.g. compdependency.component_version => [(componentversion,component.name),(componentversion,version)]
-                            ref_model = ref[
-                                0]  # We are good to use the ref[0] and keep overwriting it becoz now we only support $model starting refs. TODO: below logic needs to be re-written to support model names in reference in config.yaml
-                            ref_field = ref[1]
-                            refs[ref_field] = v.split(' - ')[
-                                idx]  # ref values can be combination of multiple fields separated by ' - '
-
-                        # IMP: Ideally we should pass values and search for record but as of now
-                        # we have reference fields are same as reference model's index
-                        # e.g. ref field ['name - version'] will be defined as ref model's index as well
-                        #   hence it is easy to find the ref record from ref model's importable_sheet's
+
+                        # Reference values are same as reference model's index e.g. ref field ['name - version'] is
+                        # defined as ref model's index as well, hence ref record is found by its label. Models which
+                        # aren't imported as sheets are resolved against DB.
                         try:
-                            # TODO: HG: Refactor need - pull out ref object checker in separate function
-                            ref_importer = Registry.importer.get_sheet(ref_model)
-                            if not ref_importer:
-                                if self.config_data[f].formatting.read_only:
+                            ref_importer = self.context.importer.get_sheet_by_model(ref_model)
+                            resolver = self.context.importer.references
+                            if ref_importer:
+                                ref_obj = resolver.record(ref_importer, ref_fields, v)
+                            else:
+                                ref_obj = resolver.db_record(self.model._meta.get_field(f).related_model,
+                                                             ref_fields, v)
+                                if not ref_obj and self.config_data[f].formatting.read_only:
                                     logging.info(f'Skipping comparison for field [{f}] with value [{value}], '
                                                  f'as its marked as read_only in config.'
-                                                 f' Cannot get importer for its model [{ref_model}]')
-                                else:
-                                    mismatches.append(
-                                        Mismatch(field=f, type=nm(type(value)), status=Status.CANNOT_COMPARE,
-                                                 message=f'Cannot get importer for model [{ref_model}]',
-                                                 extra_info=None))
-                                    # To solve this issue - add ref_model in config.yml and mark it read_only
-                            else:
-                                ref_obj = ref_importer.get_record_from_dict(refs)
-                                refobjs.setdefault(f, []).append(ref_obj)
-                                if not ref_obj or ref_obj.status == Status.MISMATCH:
-                                    mismatches.append(Mismatch(field=f, type=nm(type(value)), status=Status.MISMATCH,
-                                                               message=f'no referenced record found; record wont be '
-                                                                       f'create/updated in DB' if not ref_obj else
-                                                               'referenced record has MISMATCH',
-                                                               extra_info=Box(reference_record=ref_obj)))
+                                                 f' Cannot find [{v}] in model [{ref_model}]')
+                                    continue
+                            refobjs.setdefault(f, []).append(ref_obj)
+                            if not ref_obj or ref_obj.status == Status.MISMATCH:
+                                mismatches.append(Mismatch(field=f, type=nm(type(value)), status=Status.MISMATCH,
+                                                           message=f'no referenced record found; record wont be '
+                                                                   f'create/updated in DB' if not ref_obj else
+                                                           'referenced record has MISMATCH',
+                                                           extra_info=Box(reference_record=ref_obj)))
                         except KeyError as e:
                             msg = f"{nm(self.model)}.{f}'s value {value} - record not available in reference model" \
                                   f" {ref_model}. Exception: {e}"
@@ -222,7 +233,7 @@ class ImportableSheet:
                     mismatches.append(Mismatch(field=f, type=nm(type(value)), status=Status.XL,
                                                message=f'field: "{f}" doesnt exist in DB',
                                                extra_info=None))
-                elif db_record and getattr(db_record, f) != type(getattr(db_record, f))(value):
+                elif db_record and not values_equal(getattr(db_record, f), value):
                     mismatches.append(Mismatch(field=f, type=nm(type(value)), status=Status.MISMATCH,
                                                message=f'values differ, dbvalue: "{getattr(db_record, f)}" and xlsvalue: "{value}"',
                                                extra_info=None))
@@ -230,6 +241,59 @@ class ImportableSheet:
             # We will fill in the refobjs which aren't part of xls but in DB
         return (refobjs, mismatches)
 
+    @property
+    def hash_columns(self) -> list:
+        return [f for f in self.config_data.keys() if f != 'id']  # excel reader skips "id" column
+
+    def _ref_fields(self, f) -> tuple:
+        references = self.config_data[f].references
+        return tuple(ref_field for _, ref_field in references) if references else ('pk',)
+
+    def xl_row_hash(self, xl_record) -> Union[str, None]:
+        """ row_hash of excel record, None if record has columns not part of config """
+        if xl_record.keys() - set(self.hash_columns):
+            return None
+        m2m_fields = {f.name for f in self.model._meta.many_to_many}
+        values = []
+        for f in self.hash_columns:
+            value = xl_record[f] if f in xl_record else None
+            if f in m2m_fields:
+                value = m2m_labels(value)
+            values.append(value)
+        return row_hash(values)
+
+    def db_row_hasher(self):
+        """
+        row_hash of DB records rendered same as exporter does. Reference labels are looked up from label maps, so
+        it needs one query per reference field instead of one per record.
+        :return: callable(dbobj) -> row hash
+        """
+        resolver = self.context.importer.references
+        ref_values = {}  # field -> pk -> rendered value
+        for f in self.hash_columns:
+            try:
+                field = self.model._meta.get_field(f)
+            except FieldDoesNotExist:  # e.g. property
+                continue
+            if not (field.many_to_one or field.many_to_many):
+                continue
+            pk_labels = resolver.db_pk_labels(field.related_model, self._ref_fields(f))
+            if field.many_to_one and field.target_field.primary_key:
+                # label of FK column value, no need to keep per record values
+                ref_values[f] = lambda o, pk_labels=pk_labels, attname=field.attname: pk_labels.get(getattr(o, attname))
+                continue
+            values = {}
+            for pk, ref_pk in self.model._default_manager.values_list('pk', f'{f}__pk'):
+                if field.many_to_many:
+                    values.setdefault(pk, [])
+                    if ref_pk is not None:
+                        values[pk].append(pk_labels.get(ref_pk))
+                else:
+                    values[pk] = pk_labels.get(ref_pk) if ref_pk is not None else None
+            ref_values[f] = lambda o, values=values: values.get(o.pk)
+
+        return lambda o: row_hash([ref_values[f](o) if f in ref_values else getattr(o, f) for f in self.hash_columns])
+
     def load_n_compare(self):
         """
            Main function that callers should invoke to importer XLS data into DB.
@@ -239,36 +303,110 @@ class ImportableSheet:
         """
 
         # 1. Read xls table and keep them inside records[idx].xl_record
+        # 2. skip unchanged records i.e. same row hash of xl and db record
         # 3. compare results and keep them inside records.compare_status
-        self.load_xl()
-        dbobjs = self.model.objects.all()
-        self.total_db_records = len(dbobjs)
-        for dbobj in dbobjs:
-            idx = self.get_db_index(dbobj)
-            record = self.records.setdefault(idx, Record(db_record=dbobj, status=Status.DB))
-            record.db_record = dbobj
-            (record.refobjs, record.mismatches) = self.compare(record.xl_record, record.db_record)
-            if not record.mismatches:
-                record.status = Status.NO_CHANGE  # Nothing to insert in DB all well
+        merge = bool(self.context.importer and self.context.importer.options.merge_join)
+        with span('load_n_compare', self.name, self.context) as s:
+            self.load_xl()
+            with span('db_fetch', self.name, self.context) as fs:
+                # references making up the index are joined, get_db_index() doesn't query per record
+                lookups = self.db_index_lookups()
+                dbobjs = self.model.objects.select_related(*select_related_paths(self.model, lookups))
+                if merge:
+                    dbobjs = dbobjs.order_by(*[lookup.replace('.', '__') for lookup in lookups])
+                if self.records.in_memory:
+                    dbobjs = list(dbobjs)
+                    fs.rows = self.total_db_records = len(dbobjs)
+                else:  # stream DB records as well
+                    dbobjs = dbobjs.iterator(chunk_size=SpillRecordStore.BATCH_SIZE)
+            with span('row_hash', self.name, self.context):
+                db_hash = self.db_row_hasher()
+            export_hashes = self.context.importer.get_export_hashes(self.name)
+            if export_hashes is not None:
+                self.untouched_records = self.db_changed_records = 0
+            unchanged = db_cnt = 0
+            db_rows = ((self.get_db_index(dbobj), dbobj) for dbobj in dbobjs)
+            if merge:
+                pairs = self._merge_db_rows(db_rows)
             else:
-                self.status = Status.MISMATCH  # Importable sheet status is either NO_CHANGE or MISMATCH
-
-        for record in [r for _,r in self.records.items() if r.status == Status.XL]:
-            (record.refobjs, record.mismatches) = self.compare(record.xl_record, None)  #Helps fill in the refobjs
-        self._generate_compare_report()
+                pairs = ((idx, self.records.get(idx), dbobj) for idx, dbobj in db_rows)
+            for idx, record, dbobj in pairs:
+                if dbobj is None:  # excel only record, compared below
+                    continue
+                db_cnt += 1
+                if record is None:
+                    record = Record(db_record=dbobj, status=Status.DB)
+                record.db_record = dbobj
+                xl_hash = self.xl_row_hash(record.xl_record) if record.xl_record and (db_hash or export_hashes) \
+                    else None
+                dbobj_hash = db_hash(dbobj) if db_hash and xl_hash else None
+                if export_hashes and xl_hash and export_hashes.get(index_label(idx)) == xl_hash:
+                    self.untouched_records += 1
+                    if dbobj_hash and dbobj_hash != xl_hash:
+                        self.db_changed_records += 1
+                if dbobj_hash and dbobj_hash == xl_hash:
+                    (record.refobjs, record.mismatches) = (Box(), BoxList())
+                    record.status = Status.NO_CHANGE
+                    unchanged += 1
+                else:
+                    (record.refobjs, record.mismatches) = self.compare(record.xl_record, record.db_record)
+                    if not record.mismatches:
+                        record.status = Status.NO_CHANGE  # Nothing to insert in DB all well
+                    else:
+                        self.status = Status.MISMATCH  # Importable sheet status is either NO_CHANGE or MISMATCH
+                self.records[idx] = record  # store may keep a copy
+            self.total_db_records = db_cnt
+
+            for idx, record in self.records.items():
+                if record.status == Status.XL:
+                    (record.refobjs, record.mismatches) = self.compare(record.xl_record, None)  #Helps fill in the refobjs
+                    self.records[idx] = record
+            self._generate_compare_report()
+            s.rows = len(self.records)
+        logging.debug(f'[{unchanged}] unchanged records of sheet [{self.name}] skipped comparison')
+        if self.db_changed_records:
+            logging.warning(f'[{self.db_changed_records}] records of sheet [{self.name}] are untouched in excel but '
+                            f'changed in DB after export. Their excel values are stale.')
         logging.info(f'import_data() completed for sheet [{self.name}], model [{nm(self.model)}]')
 
+    def _merge_db_rows(self, db_rows):
+        """
+        Pairs excel records with DB rows in a single pass over both sorted by index. Remaining DB rows fall back to
+        index lookups if DB ordering differs from python string ordering (e.g. DB collation or non text index fields).
+        :param db_rows: iterable of (index, dbobj) ordered by db_index_lookups()
+        :return: generator of (index, Record or None, dbobj or None)
+        """
+        db_rows = iter(db_rows)
+        try:
+            yield from merge_join(self.records.sorted_items(), db_rows)
+        except UnsortedInputError as e:
+            if e.side != 'right':
+                raise
+            logging.warning(f'DB records of sheet [{self.name}] are not in index order ({e}). Falling back to index '
+                            f'lookups for remaining records.')
+            for idx, dbobj in itertools.chain([e.item], db_rows):
+                yield idx, self.records.get(idx), dbobj
+
     def _generate_compare_report(self):
         """
         This is an interim report containing compare results.
         In dbupdate function, compare status changes.
         """
+        if not self.records.in_memory:  # report rows are spilled along with records
+            self.report = Report(issue_cnt=0)
+            for i, r in self.records.items():
+                self.records.add_report_row(index_label(i), r.status.value, r.to_json("mismatches"), r.to_json("xl_record"),
+                                            r.to_json("db_record"))
+                if r.status != Status.NO_CHANGE:
+                    self.report.issue_cnt += 1
+            return
+
         report = self.report = Report(keys=BoxList(), statuses=BoxList(), mismatches=BoxList(), xl_records=BoxList(),
                                       db_records=BoxList(), db_update_status=BoxList(), list_idx=Box(), issue_cnt=0)
 
         for cnt, (i, r) in enumerate(self.records.items()):
-            report.list_idx[i] = cnt
-            report.keys.append(i)
+            report.list_idx[index_label(i)] = cnt
+            report.keys.append(index_label(i))
             report.statuses.append(r.status)
             report.mismatches.append(r.to_json("mismatches"))
             report.xl_records.append(r.to_json("xl_record"))
@@ -283,32 +421,45 @@ class ImportableSheet:
         """
         pass
 
-    def get_db_index(self, dbobj) -> str:
-        """ Traverses references if index key has a reference """
+    def get_db_index(self, dbobj) -> tuple:
+        """
+        Index key of DB record, see index_key(). Traverses references if index key has a reference, such value is
+        reference label same as in excel cell e.g. 'Databases - SQL'.
+        """
         try:
-            idx = ""
+            values = []
             for attr in self.index_keys:
                 references = getdictvalue(getdictvalue(self.config_data, attr, None), 'references', None)
                 if references:
+                    labels = []
                     for (ref_model, ref_field) in references:
-                        # TODO: Handle if ref_field has multi-level fields. e.g. component.name
-                        value = ""
                         obj = getattr(dbobj, attr)
                         for i in ref_field.split('.'):
                             obj = getattr(obj, i)
-                        idx = str(obj) if not idx else idx + ' - ' + str(obj)
+                        labels.append(str(obj))
+                    values.append(INDEX_SEPARATOR.join(labels))
                 else:
-                    value = getattr(dbobj, attr)
-                    idx = value if not idx else idx + ' - ' + value
-            return idx
+                    values.append(str(getattr(dbobj, attr)))
+            return index_key(values)
         except Exception as e:
             logging.critical(
                 f"Couldn't get db index for table {nm(self.model)} with object [{dbobj}]. Exception: [{e}]")
             raise e
 
-    def get_index(self, obj) -> str:
+    def db_index_lookups(self) -> list:
+        """ Dotted field paths making up get_db_index() in the same order e.g. ['category.name', 'name'] """
+        lookups = []
+        for attr in self.index_keys:
+            references = getdictvalue(getdictvalue(self.config_data, attr, None), 'references', None)
+            if references:
+                lookups.extend(f'{attr}.{ref_field}' for (ref_model, ref_field) in references)
+            else:
+                lookups.append(attr)
+        return lookups
+
+    def get_index(self, obj) -> tuple:
         """ Useful for cases where references need not be traversed """
-        return ' - '.join([getattr(obj, attr) for attr in self.index_keys])
+        return index_key(getattr(obj, attr) for attr in self.index_keys)
 
     def get_record_idx(self, idx):
         return self.records.get(idx, None)
@@ -318,7 +469,7 @@ class ImportableSheet:
         dd = Box()
         for k, v in datadict.items():
             k = k.split('.')[0]
-            dd[k] = dd.get(k) + ' - ' + v if k in dd else v  # append v to existing dd[k] if k already part of dd
+            dd[k] = dd.get(k) + INDEX_SEPARATOR + v if k in dd else v  # append v to existing dd[k] if k already part of dd
 
         if not set(self.index_keys) - dd.keys():  # IMP: multi-level reference fields excel field name is always same
             return self.get_record_idx(self.get_index(dd))
@@ -372,36 +523,49 @@ class ImportableSheet:
         db_records = BoxList()
         mismatches = BoxList()
 
-        for cnt, k in enumerate(self.report.keys):
-            if lod in (LOD.ALL_FULL, LOD.ALL_MID) or (lod == LOD.MISMATCH and report.statuses[cnt] != Status.NO_CHANGE):
+        if self.records.in_memory:
+            report_rows = zip(report.keys, report.statuses, report.mismatches, report.xl_records, report.db_records)
+        else:
+            report_rows = ((k, Status(status), m, xl, db) for k, status, m, xl, db in self.records.report_rows())
+        for k, status, mismatch, xl_record, db_record in report_rows:
+            if lod in (LOD.ALL_FULL, LOD.ALL_MID) or (lod == LOD.MISMATCH and status != Status.NO_CHANGE):
                 keys.append(k)
-                statuses.append(report.statuses[cnt])
-                mismatches.append(report.mismatches[cnt])
-                xl_records.append(report.xl_records[cnt] if lod == LOD.ALL_FULL or (
-                        lod == LOD.MISMATCH and report.statuses[cnt] != Status.NO_CHANGE) else '-')
-                db_records.append(report.db_records[cnt] if lod == LOD.ALL_FULL or (
-                        lod == LOD.MISMATCH and report.statuses[cnt] != Status.NO_CHANGE) else '-')
+                statuses.append(status)
+                mismatches.append(mismatch)
+                xl_records.append(xl_record if lod == LOD.ALL_FULL or (
+                        lod == LOD.MISMATCH and status != Status.NO_CHANGE) else '-')
+                db_records.append(db_record if lod == LOD.ALL_FULL or (
+                        lod == LOD.MISMATCH and status != Status.NO_CHANGE) else '-')
 
         html_text = f'<p>Total xl_records: {self.total_xl_records}</p><p>Total DB records: {self.total_db_records}</p>'\
                     f'<p>Number of Issues: {report.issue_cnt}</p>'
+        if self.untouched_records is not None:
+            html_text += f'<p>Untouched since export: {self.untouched_records}</p>' \
+                         f'<p>Changed in DB after export: {self.db_changed_records}</p>'
         if lod != LOD.SUMMARY:
             data = dict({f'key{self.index_keys}': keys, 'status': statuses, 'db_update': None,
                          'mismatch': mismatches})
-            if report.xl_records:
+            if len(self.records):
                 data['xl_record'] = xl_records
-            if report.db_records:
                 data['db_record'] = db_records
             html_text += pd.DataFrame(data).to_html()
         html_text += '</p>'
         return html_text
 
     def update_db(self, force_update=False):
+        with span('update_db', self.name, self.context) as s:
+            s.rows = self._update_db(force_update)
+
+    def _update_db(self, force_update=False) -> int:
+        """ Returns number of records created/updated in DB """
         # Lets filter out all FKEYs and M2Ms
         m2m_fields = [f.name for f in self.model._meta.many_to_many]
         fkey_fields = [f.name for f in self.model._meta.fields if f.many_to_one]
         concrete_fields = [f.name for f in self.model._meta.concrete_fields if not f.many_to_one]
 
         err_records = BoxList()
+        db_updated = 0
+        m2m = M2MSynchronizer(self.model)
 
         for i, r in self.records.items():  # TODO: HG: Db update record counter should be returned and updated in the logs
             if r.status == Status.NO_CHANGE:
@@ -415,7 +579,7 @@ class ImportableSheet:
                     if not refobj or None in refobj:
                         v = ','.join([re.sub('^\* ', '', i) for i in r.xl_record[f].rsplit('\n')])
                         logging.error(
-                            f" {nm(self.model)} - Wont update record [{i}] since "
+                            f" {nm(self.model)} - Wont update record [{index_label(i)}] since "
                             f"[{f}={v}] has missing "
                             f"reference object. Ensure reference record exists either in DB or XLS")
                         invalid_ref = True
@@ -437,16 +601,17 @@ class ImportableSheet:
                         if not force_update and f in r.refobjs and True in [ref.status != Status.NO_CHANGE for ref in r.refobjs[f]]:
                             v = ','.join([re.sub('^\* ', '', i) for i in r.xl_record[f].rsplit('\n')])
                             logging.error(
-                                f" {nm(self.model)} - Wont update record [{i}] since "
+                                f" {nm(self.model)} - Wont update record [{index_label(i)}] since "
                                 f"[{f}={v}] has a change. Use --force_update to update reference and this record.")
                             logging.info(f'Mismatch Reference Object - {r.refobjs[f]}')
                             invalid_ref = True
                             break
-                        elif f in [*fkey_fields, *r.refobjs] and (force_update or r.status == Status.XL):
+                        elif f in fkey_fields and (force_update or r.status == Status.XL):
                             datadict[f + '_id'] = r.refobjs[f][0].db_record.pk
+                        # many to many fields are set via M2MSynchronizer once record exists
                     else:
                         v = ','.join([re.sub('^\* ', '', i) for i in r.xl_record[f].rsplit('\n')])
-                        logging.error(f" {nm(self.model)} - Wont update record [{i}] since [{f}={v}] "
+                        logging.error(f" {nm(self.model)} - Wont update record [{index_label(i)}] since [{f}={v}] "
                                       f"is invalid (its neither concrete neither has reference)")
                         invalid_ref = True
                         break
@@ -463,10 +628,12 @@ class ImportableSheet:
                     r.db_record = dbobj
                     if r.refobjs:
                         for f in r.refobjs.keys() & m2m_fields:
-                            getattr(dbobj, f).set([ro.db_record for ro in r.refobjs[f]]) # set will add all the records
+                            m2m.set(dbobj, f, [ro.db_record for ro in r.refobjs[f]])  # applied in bulk below
 
                     dbobj.save()
                     r.status = Status.NO_CHANGE
+                    self.records[i] = r  # store may keep a copy
+                    db_updated += 1
                     logging.debug(f' {nm(self.model)}: {"created" if created else "updated"} object: {dbobj}')
                 else:
                     err_records.append(r)
@@ -475,15 +642,202 @@ class ImportableSheet:
                 # We need to update DB with XL values.
                 #  Insert missing FKEYs in referenced table.
                 pass
+        m2m.flush()
+        return db_updated
+
+
+class M2MSynchronizer(object):
+    """
+    Collects desired many to many relations of a sheet's records and applies them in bulk. Per field, existing through
+    rows are read once, missing rows are bulk created and stale rows are deleted with a single filtered delete. Replaces
+    `getattr(dbobj, f).set()` per record, which costs several queries per record. Note that m2m_changed signals aren't
+    sent for bulk changes.
+    """
+    BATCH_SIZE = 500  # keeps `IN` clause below DB parameter limits (e.g. sqlite)
+
+    def __init__(self, model):
+        self.model = model
+        self._desired = {}  # field name -> dict(owner pk -> set(related pks))
+
+    def set(self, dbobj, field_nm, related_objs):
+        """ Same as `getattr(dbobj, field_nm).set(related_objs)` but deferred till flush() """
+        if not self.model._meta.get_field(field_nm).remote_field.through._meta.auto_created:
+            getattr(dbobj, field_nm).set(related_objs)  # custom through model may need values for its extra fields
+            return
+        self._desired.setdefault(field_nm, {})[dbobj.pk] = {o.pk for o in related_objs}
+
+    def flush(self) -> int:
+        """ :return: number of through rows created and deleted """
+        changed = 0
+        for field_nm, desired in self._desired.items():
+            with transaction.atomic():
+                changed += self._sync(self.model._meta.get_field(field_nm), desired)
+        self._desired = {}
+        return changed
+
+    def _sync(self, field, desired: dict) -> int:
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+        owners = list(desired.keys())
+        existing, stale = set(), []
+        for i in range(0, len(owners), M2MSynchronizer.BATCH_SIZE):
+            rows = through._default_manager.filter(**{f'{source}__in': owners[i:i + M2MSynchronizer.BATCH_SIZE]}) \
+                .values_list('pk', source, target)
+            for pk, owner, related in rows:
+                if related in desired[owner]:
+                    existing.add((owner, related))
+                else:
+                    stale.append(pk)
+
+        new = [through(**{source: owner, target: related}) for owner, related_pks in desired.items()
+               for related in related_pks if (owner, related) not in existing]
+        if new:
+            through._default_manager.bulk_create(new, batch_size=M2MSynchronizer.BATCH_SIZE)
+        for i in range(0, len(stale), M2MSynchronizer.BATCH_SIZE):
+            through._default_manager.filter(pk__in=stale[i:i + M2MSynchronizer.BATCH_SIZE]).delete()
+        logging.debug(f'{nm(self.model)}.{field.name}: [{len(new)}] relations added, [{len(stale)}] removed for '
+                      f'[{len(owners)}] records')
+        return len(new) + len(stale)
+
+
+class IndexLabels(dict):
+    """ label -> index key of records of a sheet, size is number of records it was built from """
+
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+
+class ReferenceResolver(object):
+    """
+    Finds referenced records by their excel label (e.g. `category - name`) for all sheets of an import.
+    * Models imported as sheets -- resolved to the sheet's Record, as its DB record may be created only once that
+      sheet is updated in DB.
+    * Other models (not in config or not exported) -- label -> pk map of the whole table is loaded with a single
+      projected query on first use.
+    """
+
+    def __init__(self):
+        self._records = {}  # (sheet name, ref fields, label) -> Record
+        self._index_labels_cache = {}  # (sheet name, ref fields) -> IndexLabels
+        self._labels = {}  # (model label, ref fields) -> dict(label -> pk)
+        self._lock = threading.Lock()
+
+    def record(self, ref_sheet, ref_fields: tuple, label: str) -> Union[Record, None]:
+        """
+        :param ref_sheet: ImportableSheet of referenced model
+        :param ref_fields: reference fields as per config e.g. ('category.name', 'name')
+        :param label: reference value as in excel e.g. 'Databases - SQL'
+        :return: Record if found
+        """
+        key = (ref_sheet.name, ref_fields, label)
+        ref_obj = self._records.get(key)
+        if ref_obj is None:
+            labels = self._index_labels(ref_sheet, ref_fields)
+            if labels is not None:
+                idx = labels.get(label)
+                if idx is None and labels.size != len(ref_sheet.records):  # records loaded since, e.g. cyclic refs
+                    idx = self._index_labels(ref_sheet, ref_fields, reload=True).get(label)
+                ref_obj = ref_sheet.get_record_idx(idx) if idx is not None else None
+            else:
+                ref_obj = ref_sheet.get_record_from_dict(
+                    Box(zip(ref_fields, label.split(INDEX_SEPARATOR, len(ref_fields) - 1))))
+            # referenced sheet may not be loaded yet in case of cyclic references. Spilled records are copies, which
+            # go stale once referenced sheet updates them, hence aren't cached.
+            if ref_obj is not None and ref_sheet.records.in_memory:
+                self._records[key] = ref_obj
+        return ref_obj
+
+    def _index_labels(self, ref_sheet, ref_fields: tuple, reload=False) -> Union['IndexLabels', None]:
+        """
+        Label -> index key of all records of referenced sheet. Labels aren't split into field values, as values may
+        contain INDEX_SEPARATOR as well e.g. category 'A - B'.
+        :return: None if reference fields don't make up index of referenced sheet
+        """
+        fields = list(dict.fromkeys(ref_field.split('.')[0] for ref_field in ref_fields))  # see get_record_from_dict
+        if set(fields) != set(ref_sheet.index_keys):
+            return None
+        key = (ref_sheet.name, ref_fields)
+        with self._lock:
+            if reload or key not in self._index_labels_cache:
+                positions = [ref_sheet.index_keys.index(f) for f in fields]
+                labels = IndexLabels(size=len(ref_sheet.records))
+                for idx in ref_sheet.records.keys():
+                    labels.setdefault(index_label(idx[p] for p in positions), idx)
+                self._index_labels_cache[key] = labels
+            return self._index_labels_cache[key]
+
+    def db_record(self, model, ref_fields: tuple, label: str) -> Union[Record, None]:
+        """
+        :return: Record with DB record having only pk loaded, if found
+        """
+        pk = self.db_labels(model, ref_fields).get(label)
+        if pk is None:
+            return None
+        return Record(db_record=model.from_db(model._default_manager.db, [model._meta.pk.attname], [pk]),
+                      status=Status.NO_CHANGE)
+
+    def db_labels(self, model, ref_fields: tuple) -> dict:
+        """ label -> pk of all DB records of model """
+        return self._get_labels(model, ref_fields)[0]
+
+    def db_pk_labels(self, model, ref_fields: tuple) -> dict:
+        """ pk -> label of all DB records of model """
+        return self._get_labels(model, ref_fields)[1]
+
+    def _get_labels(self, model, ref_fields: tuple) -> tuple:
+        key = (model._meta.label, ref_fields)
+        with self._lock:
+            if key not in self._labels:
+                pk_labels = self._load_labels(model, ref_fields)
+                labels = {}
+                for pk, label in pk_labels.items():
+                    labels.setdefault(label, pk)
+                self._labels[key] = (labels, pk_labels)
+            return self._labels[key]
+
+    @staticmethod
+    def _load_labels(model, ref_fields: tuple) -> dict:
+        pk_labels = {}
+        lookups = [ref_field.replace('.', '__') for ref_field in ref_fields]
+        try:
+            rows = list(model._default_manager.values_list('pk', *lookups))
+        except FieldError:  # e.g. reference to property, render it from objects
+            rows = []
+            for obj in model._default_manager.all():
+                row = [obj.pk]
+                for ref_field in ref_fields:
+                    value = obj
+                    for i in ref_field.split('.'):
+                        value = getattr(value, i)
+                    row.append(value)
+                rows.append(row)
+        for pk, *values in rows:
+            pk_labels[pk] = index_label(values)
+        logging.debug(f'Loaded [{len(pk_labels)}] reference labels of model [{nm(model)}] for {ref_fields}')
+        return pk_labels
 
 
 @attr.s(auto_attribs=True)
 class Importer:
-    importablemodels: Box
     options: Box
+    context: Context = attr.ib(repr=False, eq=False)
+    sheets: SheetIndex = attr.ib(factory=SheetIndex, repr=False, eq=False)  # importable sheets
+    references: ReferenceResolver = attr.ib(factory=ReferenceResolver, repr=False, eq=False)
+    metadata: dict = attr.ib(default=None, repr=False, eq=False)  # export metadata of excel, see XlsReader
 
     @classmethod
-    def from_registry(cls, xls_file, lod, report_nm, dry_run, db_update, db_force_update):
+    def from_context(cls, context: Context, xls_file, lod, report_nm, dry_run, db_update, db_force_update, workers=1,
+                     spill_dir=None, merge_join=False):
+        """
+        Creates Importer and registers it as context.importer
+        :param context: job Context providing parser and xlreader
+        :param spill_dir: if provided, records of every sheet are spilled to a temporary SQLite file in this directory
+            instead of being kept in memory. Meant for sheets too large to fit in memory.
+        :param merge_join: compare excel and DB records by merging both sorted by index in a single pass instead of
+            looking up each DB record by index
+        """
         def validate_options_type(opts: Box, t):
             for o in opts.values():
                 if not isinstance(o, t):
@@ -492,15 +846,43 @@ class Importer:
         def validate_options_conflict(opts: Box):
             if opts.dry_run and (db_force_update or db_update):
                 raise Exception(f'dry_run isnt supported with db_update or db_force_update')
+            if not isinstance(opts.workers, int) or opts.workers < 1:
+                raise Exception(f' [{opts.workers}] workers should be a positive integer')
 
-        options = Box(dry_run=dry_run, db_force_update=db_force_update, db_update=db_update)
+        options = Box(dry_run=dry_run, db_force_update=db_force_update, db_update=db_update, merge_join=merge_join)
         validate_options_type(options, bool)
-        options.update(dict(lod=lod, xls_file=xls_file, report_nm=report_nm))
+        options.update(dict(lod=lod, xls_file=xls_file, report_nm=report_nm, workers=workers, spill_dir=spill_dir))
         validate_options_conflict(options)
-        return Importer(importablemodels=Box(default_box=True), options=options)
+        context.importer = Importer(options=options, context=context)
+        return context.importer
+
+    def create_record_store(self, sheet_nm) -> Union[MemoryRecordStore, SpillRecordStore]:
+        if self.options.spill_dir:
+            return SpillRecordStore(self.options.spill_dir, sheet_nm)
+        return MemoryRecordStore()
+
+    def get_sheet(self, sheet_nm) -> Union[ImportableSheet, None]:
+        return self.sheets.get(sheet_nm)
+
+    def get_sheet_by_model(self, model_nm, sheet_nm=None) -> Union[ImportableSheet, None]:
+        """ see SheetIndex.get_by_model """
+        return self.sheets.get_by_model(model_nm, sheet_nm)
 
-    def get_sheet(self, name):
-        return self.importablemodels[name]
+    def _load_metadata(self):
+        metadata = self.context.xlreader.get_metadata()
+        if not metadata:
+            return None
+        if metadata.get('config_hash') != self.context.parser.config_hash:
+            logging.warning(f'[{self.options.xls_file}] was exported with a different config. Ignoring its metadata.')
+            return None
+        logging.info(f'[{self.options.xls_file}] was exported at [{metadata.get("exported_at")}]')
+        return metadata
+
+    def get_export_hashes(self, sheet_nm) -> Union[dict, None]:
+        """ Row hashes (index key -> row hash) of sheet at export time, None if excel has no metadata """
+        if not self.metadata:
+            return None
+        return self.metadata['row_hashes'].get(sheet_nm, {})
 
     def import_sheets(self):
         datetime_str = datetime.now().strftime("%d-%m-%y %Ih.%Mm.%Ss%p")
@@ -510,24 +892,48 @@ class Importer:
                     f'<p>Excel file: {self.options.xls_file}</p><p>Database: {db_connection}</p>' \
                     f'<p>Command line option: {self.options}</p><p> '
 
-        for sheet_nm in Registry.parser.get_sheet_names(export_sequence=True):
-            config = Registry.parser.get_sheet(sheet_nm)
-            model_nm = config.dataset.model_name.rsplit('.')[-1]
-            importable_sheet = self.import_sheet(sheet_nm, model_nm, config)
-            html_text += f'<br></p><hr><h3>{model_nm}</h3><p>Excel tab: {sheet_nm}</p><p>DB Table: ' \
-                         f'{nm(importable_sheet.model)}</p><p>'
-            html_text += importable_sheet.get_html_report(int(self.options.lod))
-            html_text += '</p>'
+        parser = self.context.parser
+        self.metadata = self._load_metadata()
+        sheet_names = parser.get_sheet_names(export_sequence=True)
+        imported = {}
+
+        def on_done(sheet_nm, importable_sheet):
+            imported[sheet_nm] = importable_sheet
+            self.context.report_progress('import', sheet_nm, len(imported), len(sheet_names))
+
+        with span('import', context=self.context):
+            if self.options.workers > 1:
+                # Sheets are scheduled once all their dependent_sheets are imported, so references always resolve
+                # against already loaded sheets.
+                DagExecutor(parser.get_sheet_dependencies(), sheet_names, self.options.workers) \
+                    .run(self._import_sheet_by_name, on_done)
+            else:
+                for sheet_nm in sheet_names:
+                    on_done(sheet_nm, self._import_sheet_by_name(sheet_nm))
 
         self.options.report_nm = f'{self.options.report_nm}-report_{datetime_str}.html'
-        html_file = open(self.options.report_nm, 'w')
-        html_text += f'<hr><p><em>This report is generated by&nbsp;</em>' \
-                     f'<a href="https://github.com/hitengajjar/django-excel-transformer">' \
-                     f'<em>django-excel-transformer</em></a></p>'
-        html_file.write(html_text)
-        html_file.close()
+        with open(self.options.report_nm, 'w') as html_file:
+            html_file.write(html_text)
+            for sheet_nm in sheet_names:  # Report follows export sequence irrespective of the completion order
+                model_nm = parser.get_sheet(sheet_nm).dataset.model_name.rsplit('.')[-1]
+                importable_sheet = imported[sheet_nm]
+                # written sheet by sheet, so that html of only one sheet is in memory at a time
+                html_file.write(f'<br></p><hr><h3>{model_nm}</h3><p>Excel tab: {sheet_nm}</p><p>DB Table: '
+                                f'{nm(importable_sheet.model)}</p><p>')
+                html_file.write(importable_sheet.get_html_report(int(self.options.lod)))
+                html_file.write('</p>')
+            html_file.write(f'<hr><p><em>This report is generated by&nbsp;</em>'
+                            f'<a href="https://github.com/hitengajjar/django-excel-transformer">'
+                            f'<em>django-excel-transformer</em></a></p>')
+        for importable_sheet in imported.values():
+            if importable_sheet is not None:
+                importable_sheet.records.close()
         logging.info(f'{self.options.report_nm} report generated.')
 
+    def _import_sheet_by_name(self, sheet_nm) -> Union[ImportableSheet, None]:
+        config = self.context.parser.get_sheet(sheet_nm)
+        return self.import_sheet(sheet_nm, config.dataset.model_name.rsplit('.')[-1], config)
+
     def import_sheet(self, sheet_nm, model_nm, config) -> Union[ImportableSheet, None]:
         """
         Loads and compares the sheet against DB contents
@@ -537,15 +943,18 @@ class Importer:
         :return: ImportableSheet
         """
         try:
-            self.importablemodels[model_nm] = importable_sheet = ImportableSheet.from_sheetdata(config)
+            importable_sheet = ImportableSheet.from_sheetdata(config, self.context)
+            self.sheets.register(sheet_nm, importable_sheet.model, importable_sheet,
+                                 preferred=bool(config.get('reference_sheet')))
         except KeyError as ke:
             logging.critical(f'Cannot import sheetnm: {sheet_nm}, modelnm: {model_nm}. Exception: {ke}')
             return None
-        logging.info(f'Validating sheet [{sheet_nm}]')
-        importable_sheet.load_n_compare()
-        if importable_sheet.status != Status.NO_CHANGE and (self.options.db_update or self.options.db_force_update):
-            if not importable_sheet.read_only:
-                importable_sheet.update_db(force_update=self.options.db_force_update)
-            else:
-                logging.info(f'Import skipped for sheet [{sheet_nm}] since its marked read_only in config.yml but it has mismatch.')
+        with span('import_sheet', sheet_nm, self.context):
+            logging.info(f'Validating sheet [{sheet_nm}]')
+            importable_sheet.load_n_compare()
+            if importable_sheet.status != Status.NO_CHANGE and (self.options.db_update or self.options.db_force_update):
+                if not importable_sheet.read_only:
+                    importable_sheet.update_db(force_update=self.options.db_force_update)
+                else:
+                    logging.info(f'Import skipped for sheet [{sheet_nm}] since its marked read_only in config.yml but it has mismatch.')
         return importable_sheet
@@ -0,0 +1,42 @@
+_END = object()
+
+
+class UnsortedInputError(ValueError):
+    """
+    Raised by merge_join when an input isn't sorted by key or has duplicate keys. `item` is the offending
+    (key, value) which is already consumed from its input.
+    """
+    def __init__(self, side, item):
+        super().__init__(f'{side} input of merge join is not sorted (or has duplicates) at key [{item[0]}]')
+        self.side = side
+        self.item = item
+
+
+def merge_join(left, right):
+    """
+    Full outer join of two (key, value) streams sorted by unique keys in a single pass, holding just one item of each
+    input in memory.
+    :param left: iterable of (key, value) e.g. excel records
+    :param right: iterable of (key, value) e.g. DB records
+    :return: generator of (key, left value or None, right value or None) in key order
+    :raises: UnsortedInputError
+    """
+    left, right = iter(left), iter(right)
+
+    def advance(it, side, prev_key):
+        item = next(it, _END)
+        if item is not _END and prev_key is not _END and not prev_key < item[0]:
+            raise UnsortedInputError(side, item)
+        return item
+
+    l_item, r_item = advance(left, 'left', _END), advance(right, 'right', _END)
+    while l_item is not _END or r_item is not _END:
+        if r_item is _END or (l_item is not _END and l_item[0] < r_item[0]):
+            yield l_item[0], l_item[1], None
+            l_item = advance(left, 'left', l_item[0])
+        elif l_item is _END or r_item[0] < l_item[0]:
+            yield r_item[0], None, r_item[1]
+            r_item = advance(right, 'right', r_item[0])
+        else:
+            yield l_item[0], l_item[1], r_item[1]
+            l_item, r_item = advance(left, 'left', l_item[0]), advance(right, 'right', r_item[0])
@@ -0,0 +1,69 @@
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.db import connections
+
+
+class DagExecutor(object):
+    """
+    Runs nodes of a dependency graph in a worker pool. A node is submitted only once all its dependencies have
+    completed, so anything a node publishes before returning is visible to its dependents.
+    """
+
+    def __init__(self, graph: dict, order: list, workers: int = 1):
+        """
+        :param graph: dict(node -> [dependency nodes]). Dependencies not part of graph are ignored.
+        :param order: sequential order (e.g. Parser.get_sheet_names) used to pick nodes and to break cycles.
+        :param workers: worker pool size
+        """
+        self._order = [n for n in order if n in graph]
+        self._deps = {n: {d for d in graph[n] if d in graph and d != n} for n in self._order}
+        self._workers = max(1, workers)
+
+    @staticmethod
+    def _run_node(fn, node):
+        try:
+            return fn(node)
+        finally:
+            # Every worker thread gets its own DB connection from Django, release it once node is processed.
+            connections.close_all()
+
+    def run(self, fn, on_done=None) -> dict:
+        """
+        Executes fn(node) for all nodes.
+        :param fn: callable invoked with node name inside worker thread
+        :param on_done: optional callable(node, result) invoked in caller thread before dependents are scheduled.
+        :return: dict(node -> result)
+        """
+        pending = {n: set(deps) for n, deps in self._deps.items()}
+        results = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='det-worker') as pool:
+            while pending or running:
+                ready = [n for n in self._order if n in pending and not pending[n]]
+                if not ready and not running:
+                    # Cycle in the graph, release the first node as per sequential order.
+                    ready = [next(n for n in self._order if n in pending)]
+                    logging.warning(f'Cyclic dependency found for [{ready[0]}] with [{pending[ready[0]]}]. '
+                                    f'Scheduling it without waiting for its dependencies.')
+                for n in ready:
+                    del pending[n]
+                    # workers run within caller's context so that they see resources of the same job
+                    running[pool.submit(contextvars.copy_context().run, self._run_node, fn, n)] = n
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        results[node] = future.result()
+                    except Exception:
+                        for f in running:
+                            f.cancel()
+                        raise
+                    if on_done:
+                        on_done(node, results[node])
+                    for deps in pending.values():
+                        deps.discard(node)
+        return results
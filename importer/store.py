@@ -0,0 +1,147 @@
+import os
+import pickle
+import re
+import sqlite3
+import tempfile
+import threading
+
+from ..common import index_key
+
+
+class MemoryRecordStore(dict):
+    """
+    Default record store of ImportableSheet, keeps all records in memory
+    """
+    in_memory = True
+
+    def sorted_items(self):
+        """ (idx, record) ordered by idx. Sorting is linear if records were inserted in order. """
+        return iter(sorted(self.items(), key=lambda item: item[0]))
+
+    def close(self):
+        pass
+
+
+# Index key tuple is stored as text whose (binary) order is the tuple order: components are joined by KEY_SEPARATOR
+# which sorts below any other character, characters up to KEY_ESCAPE are escaped to 2 characters sorting in between.
+KEY_SEPARATOR = '\x01'
+KEY_ESCAPE = '\x02'
+_ESCAPES = str.maketrans({chr(c): KEY_ESCAPE + chr(c + 2) for c in range(ord(KEY_ESCAPE) + 1)})
+_UNESCAPE = re.compile(f'{KEY_ESCAPE}(.)', re.DOTALL)
+
+
+def encode_key(idx: tuple) -> str:
+    return KEY_SEPARATOR.join(i.translate(_ESCAPES) for i in idx)
+
+
+def decode_key(key: str) -> tuple:
+    return index_key(_UNESCAPE.sub(lambda m: chr(ord(m[1]) - 2), i) for i in key.split(KEY_SEPARATOR)) \
+        if key else ()
+
+
+class SpillRecordStore(object):
+    """
+    Records of ImportableSheet kept in a temporary SQLite file keyed by index (index key tuple encoded as text), so that memory usage doesn't grow with
+    sheet size. Records are pickled on every write, hence callers must store a record again after modifying it.
+    Iteration follows insertion order and fetches records in batches. Compare report rows are spilled as well.
+    """
+    in_memory = False
+    BATCH_SIZE = 1000
+
+    def __init__(self, directory=None, name='records'):
+        """
+        :param directory: directory for temporary file, defaults to system temp directory
+        :param name: used as temporary file name prefix e.g. sheet name
+        """
+        fd, self.filename = tempfile.mkstemp(prefix=f'det-{name}-', suffix='.sqlite3', dir=directory)
+        os.close(fd)
+        self._lock = threading.Lock()  # dependent sheets may read records from other worker threads
+        # Store is private and temporary, hence no journal & fsync. Changes are never committed, reads happen on the
+        # same connection.
+        self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = OFF')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.execute('CREATE TABLE records (seq INTEGER PRIMARY KEY AUTOINCREMENT, idx TEXT UNIQUE NOT NULL, '
+                           'record BLOB NOT NULL)')
+        self._conn.execute('CREATE TABLE report (seq INTEGER PRIMARY KEY AUTOINCREMENT, idx TEXT, status TEXT, '
+                           'mismatches TEXT, xl_record TEXT, db_record TEXT)')
+
+    def __setitem__(self, idx, record):
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute('INSERT INTO records (idx, record) VALUES (?, ?) '
+                               'ON CONFLICT(idx) DO UPDATE SET record = excluded.record', (encode_key(idx), data))
+
+    def get(self, idx, default=None):
+        with self._lock:
+            row = self._conn.execute('SELECT record FROM records WHERE idx = ?', (encode_key(idx),)).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def __getitem__(self, idx):
+        record = self.get(idx)
+        if record is None:
+            raise KeyError(idx)
+        return record
+
+    def __contains__(self, idx):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM records WHERE idx = ?', (encode_key(idx),)).fetchone() is not None
+
+    def setdefault(self, idx, default):
+        record = self.get(idx)
+        if record is None:
+            self[idx] = record = default
+        return record
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def _iter_rows(self, sql, start=0):
+        """ Keyset paginated query, sql must select the key column first """
+        key = start
+        while True:
+            with self._lock:
+                rows = self._conn.execute(sql, (key, SpillRecordStore.BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            key = rows[-1][0]
+
+    def items(self):
+        """ (idx, record) in insertion order. Records can be stored again while iterating. """
+        for _, idx, data in self._iter_rows('SELECT seq, idx, record FROM records WHERE seq > ? ORDER BY seq LIMIT ?'):
+            yield decode_key(idx), pickle.loads(data)
+
+    def sorted_items(self):
+        """ (idx, record) ordered by idx, read through unique index of idx """
+        if () in self:  # pagination below starts after ''
+            yield (), self[()]
+        for idx, data in self._iter_rows('SELECT idx, record FROM records WHERE idx > ? ORDER BY idx LIMIT ?', ''):
+            yield decode_key(idx), pickle.loads(data)
+
+    def keys(self):
+        for _, idx in self._iter_rows('SELECT seq, idx FROM records WHERE seq > ? ORDER BY seq LIMIT ?'):
+            yield decode_key(idx)
+
+    def values(self):
+        for _, record in self.items():
+            yield record
+
+    def add_report_row(self, idx, status, mismatches, xl_record, db_record):
+        with self._lock:
+            self._conn.execute('INSERT INTO report (idx, status, mismatches, xl_record, db_record) '
+                               'VALUES (?, ?, ?, ?, ?)', (idx, status, mismatches, xl_record, db_record))
+
+    def report_rows(self):
+        """ (idx, status, mismatches, xl_record, db_record) in insertion order """
+        for row in self._iter_rows('SELECT seq, idx, status, mismatches, xl_record, db_record FROM report '
+                                   'WHERE seq > ? ORDER BY seq LIMIT ?'):
+            yield row[1:]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -1,3 +1,5 @@
+import logging
+
 
 class Records1:  # Table level records
     def __init__(self):
@@ -6,22 +8,58 @@ class Records1:  # Table level records
         self.status = {}  # dict(index=[RowResult]) so each row represents either db table row or xls table row
 
 
+class XlSheetError(ValueError):
+    """
+    Raised when excel sheet can't be imported as per config e.g. missing index column or empty index value
+    """
+    def __init__(self, sheet_nm, msg):
+        super().__init__(f'Sheet [{sheet_nm}]: {msg}')
+        self.sheet_nm = sheet_nm
+
+
 class Validator:
-    def validate_all(self):
-        # TODO
-        pass
+    def validate_all(self, sheet_nm, headers, index_keys, fields=None):
+        """ Validates header row of sheet, see xl_sheet and xl_index_keys """
+        self.xl_sheet(sheet_nm, headers, fields)
+        self.xl_index_keys(sheet_nm, headers, index_keys)
 
-    def xl_index_keys(self, headers, index_keys):
-        # TODO
-        pass
+    def xl_index_keys(self, sheet_nm, headers, index_keys):
+        """
+        :param headers: column titles
+        :raises: XlSheetError if any index column is missing
+        """
+        missing = [k for k in index_keys if k not in headers]
+        if missing:
+            raise XlSheetError(sheet_nm, f'index column(s) {missing} missing. Columns: {list(headers)}')
 
-    def xl_record(self, xlrecord, config_schema):
-        # TODO
-        pass
+    def xl_record(self, sheet_nm, row_num, index_values: dict):
+        """
+        :param row_num: excel row number, used in error message
+        :param index_values: dict(index column -> cell value)
+        :raises: XlSheetError if an index value is empty or isn't text
+        """
+        for k, v in index_values.items():
+            if v is None or not isinstance(v, str) or not v.strip():
+                raise XlSheetError(sheet_nm, f'row [{row_num}] index column [{k}] has invalid value [{v}]. Index '
+                                             f'values must be non-empty text.')
 
-    def xl_sheet(self, sheet):
-        # TODO
-        pass
+    def xl_sheet(self, sheet_nm, headers, fields=None):
+        """
+        :param headers: column titles
+        :param fields: config fields of sheet, columns not part of it are reported
+        :raises: XlSheetError if a column title is empty, isn't text or is duplicate
+        """
+        seen = set()
+        for col_num, title in enumerate(headers, 1):
+            if not isinstance(title, str) or not title:
+                raise XlSheetError(sheet_nm, f'column [{col_num}] has invalid title [{title}]')
+            if title in seen:
+                raise XlSheetError(sheet_nm, f'duplicate column [{title}]')
+            seen.add(title)
+        if fields is not None:
+            unknown = [t for t in headers if t != 'id' and t not in fields]
+            if unknown:
+                logging.warning(f'Sheet [{sheet_nm}]: columns {unknown} are not part of config')
 
     def dbrecord_exists(self, xlrecord):
         # TODO
@@ -0,0 +1,195 @@
+import posixpath
+import zipfile
+from xml.etree.ElementTree import iterparse, fromstring
+
+import openpyxl
+from openpyxl.styles.stylesheet import Stylesheet
+from openpyxl.utils.cell import column_index_from_string, range_boundaries
+from openpyxl.utils.datetime import from_excel, from_ISO8601, CALENDAR_WINDOWS_1900, CALENDAR_MAC_1904
+
+SHEET_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_M = '{%s}' % SHEET_MAIN_NS
+_ROW, _DIMENSION, _V, _IS, _SI, _T, _R = (f'{_M}{tag}' for tag in ('row', 'dimension', 'v', 'is', 'si', 't', 'r'))
+
+
+class OpenpyxlEngine(object):
+    """
+    Default engine, reads workbook with openpyxl (cached formula values only)
+    """
+
+    def __init__(self, filename, read_only=False):
+        self._wb = openpyxl.load_workbook(filename, data_only=True, read_only=read_only)
+        self.read_only = read_only
+
+    @property
+    def sheetnames(self) -> list:
+        return self._wb.sheetnames
+
+    def iter_rows(self, sheet_nm):
+        """ tuples of cell values, row by row starting from first row """
+        return self._wb[sheet_nm].iter_rows(values_only=True)
+
+    def close(self):
+        if self.read_only:
+            self._wb.close()
+
+
+class SpreadsheetMLEngine(object):
+    """
+    Reads sheet XML (SpreadsheetML) of xlsx package directly, rows are streamed with iterparse and cells are converted
+    to the same values as openpyxl would provide i.e. shared/inline strings, numbers, booleans, errors and dates as per
+    cell number format. Formatting, merged cells etc. aren't read at all, which makes it several times faster than
+    openpyxl for big sheets. Always streams, hence `read_only` is ignored.
+    """
+
+    def __init__(self, filename, read_only=True):
+        self._zip = zipfile.ZipFile(filename)
+        self.read_only = True
+        workbook_path = self._main_part()
+        rels = self._relationships(workbook_path)
+        workbook = fromstring(self._zip.read(workbook_path))
+        pr = workbook.find(f'{_M}workbookPr')
+        date1904 = pr is not None and pr.get('date1904') in ('1', 'true')
+        self._epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+        self._sheets = {s.get('name'): rels[s.get(f'{{{REL_NS}}}id')]
+                        for s in workbook.iter(f'{_M}sheet')}  # sheet name -> part path, in workbook order
+        parts = {t: p for p, t in self._relationship_types(workbook_path)}
+        self._strings_part = parts.get('sharedStrings')
+        self._shared_strings = None
+        self._date_formats, self._timedelta_formats = self._number_formats(parts.get('styles'))
+
+    def _main_part(self) -> str:
+        for path, rel_type in self._relationship_types(''):
+            if rel_type == 'officeDocument':
+                return path
+        return 'xl/workbook.xml'
+
+    def _relationship_types(self, part):
+        """ (target part path, relationship type e.g. styles) of part """
+        for target, rel_type in self._iter_relationships(part):
+            yield target, rel_type.rsplit('/', 1)[-1]
+
+    def _relationships(self, part) -> dict:
+        """ relationship id -> target part path """
+        return {rel_id: target for target, rel_id in self._iter_relationships(part, 'Id')}
+
+    def _iter_relationships(self, part, attribute='Type'):
+        folder, name = posixpath.split(part)
+        rels_path = posixpath.join(folder, '_rels', f'{name}.rels')
+        if rels_path not in self._zip.namelist():
+            return
+        for rel in fromstring(self._zip.read(rels_path)).iter(f'{{{PKG_REL_NS}}}Relationship'):
+            target = rel.get('Target')
+            target = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(folder,
+                                                                                                        target))
+            yield target, rel.get(attribute)
+
+    def _number_formats(self, styles_part) -> tuple:
+        """ style ids having date and timedelta number format, computed by openpyxl """
+        if not styles_part:
+            return set(), set()
+        stylesheet = Stylesheet.from_tree(fromstring(self._zip.read(styles_part)))
+        return stylesheet.date_formats, stylesheet.timedelta_formats
+
+    @property
+    def shared_strings(self) -> list:
+        if self._shared_strings is None:
+            self._shared_strings = []
+            if self._strings_part:
+                with self._zip.open(self._strings_part) as src:
+                    for _, node in iterparse(src):
+                        if node.tag == _SI:
+                            self._shared_strings.append(self._text(node).replace('x005F_', ''))
+                            node.clear()
+        return self._shared_strings
+
+    @staticmethod
+    def _text(node) -> str:
+        """ text of string item without formatting i.e. plain text followed by rich text runs """
+        snippets = []
+        for child in node:
+            if child.tag == _T:
+                snippets.insert(0, child.text or '')
+            elif child.tag == _R:
+                t = child.find(_T)
+                if t is not None and t.text is not None:
+                    snippets.append(t.text)
+        return ''.join(snippets)
+
+    @property
+    def sheetnames(self) -> list:
+        return list(self._sheets)
+
+    def iter_rows(self, sheet_nm):
+        """ tuples of cell values, row by row starting from first row. Rows are padded to sheet dimension. """
+        if sheet_nm not in self._sheets:
+            raise KeyError(f'Worksheet {sheet_nm} does not exist.')
+        return self._iter_rows(self._sheets[sheet_nm])
+
+    def _iter_rows(self, part):
+        cast = self._cast
+        shared_strings = self.shared_strings
+        columns = {}  # column letters -> column number
+        width = 0
+        row_num = 0
+        with self._zip.open(part) as src:
+            for _, node in iterparse(src):  # only 'end' events, same as openpyxl
+                tag = node.tag
+                if tag == _ROW:
+                    r = node.get('r')
+                    num = int(r) if r else row_num + 1
+                    for _ in range(row_num + 1, num):  # missing rows
+                        yield (None,) * width
+                    row_num = num
+                    values = []
+                    for c in node:
+                        ref = c.get('r')
+                        if ref:
+                            letters = ref[:-len(r)] if r and ref.endswith(r) else ref.rstrip('0123456789')
+                            col = columns.get(letters)
+                            if col is None:
+                                col = columns[letters] = column_index_from_string(letters)
+                            if col > len(values) + 1:  # missing cells
+                                values.extend([None] * (col - len(values) - 1))
+                        values.append(cast(c, shared_strings))
+                    if len(values) < width:
+                        values.extend([None] * (width - len(values)))
+                    node.clear()  # row is processed once
+                    yield tuple(values)
+                elif tag == _DIMENSION:
+                    ref = node.get('ref')
+                    width = (range_boundaries(ref)[2] or 0) if ref and ':' in ref else 0
+
+    def _cast(self, c, shared_strings):
+        """ cell value same as openpyxl WorkSheetParser.parse_cell (data_only) """
+        data_type = c.get('t', 'n')
+        if data_type == 'inlineStr':
+            child = c.find(_IS)
+            return self._text(child) if child is not None else None
+        value = c.findtext(_V) or None
+        if value is None:
+            return None
+        if data_type == 'n':
+            value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+            style_id = c.get('s')
+            if style_id and int(style_id) in self._date_formats:
+                try:
+                    return from_excel(value, self._epoch, timedelta=int(style_id) in self._timedelta_formats)
+                except (OverflowError, ValueError):
+                    return '#VALUE!'
+            return value
+        elif data_type == 's':
+            return shared_strings[int(value)]
+        elif data_type == 'b':
+            return bool(int(value))
+        elif data_type == 'd':
+            return from_ISO8601(value)
+        return value  # str (formula result), e (error)
+
+    def close(self):
+        self._zip.close()
+
+
+ENGINES = dict(openpyxl=OpenpyxlEngine, spreadsheetml=SpreadsheetMLEngine)
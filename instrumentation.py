@@ -0,0 +1,190 @@
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, ExitStack
+
+import attr
+from django.db import connection
+
+from .common import current_context
+
+
+@attr.s
+class Span(object):
+    """
+    Single measured stage. `rows` is filled in by the instrumented code.
+    """
+    name = attr.ib(validator=attr.validators.instance_of(str))
+    sheet = attr.ib(default=None)
+    parent = attr.ib(default=None)
+    thread = attr.ib(default=None)
+    wall_time = attr.ib(default=0.0)
+    rows = attr.ib(default=0)
+    queries = attr.ib(default=0)
+    peak_mem = attr.ib(default=0)  # bytes, only filled when memory tracing is enabled
+
+    def to_dict(self):
+        return attr.asdict(self)
+
+
+class Instrumentation(object):
+    """
+    Collects per stage wall time, processed rows, DB query count and peak memory.
+    Spans can be nested and opened from multiple threads. Query count is per thread as Django keeps one connection
+    per thread, whereas peak memory is process wide (tracemalloc) and hence includes work of parallel workers.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = []  # all open spans across threads, used for peak memory accounting
+        self._trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _fold_peak(self):
+        """ Pushes current peak into every open span and starts a new peak window """
+        if not self._trace_memory:
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        for s in self._open:
+            s.peak_mem = max(s.peak_mem, peak)
+        if hasattr(tracemalloc, 'reset_peak'):  # python3.9+, otherwise peak is since start of tracing
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def span(self, name, sheet=None):
+        stack = self._stack()
+        s = Span(name=name, sheet=sheet, parent=stack[-1].name if stack else None,
+                 thread=threading.current_thread().name)
+
+        def count_queries(execute, sql, params, many, context):
+            s.queries += 1
+            return execute(sql, params, many, context)
+
+        with self._lock:
+            self._fold_peak()
+            self._open.append(s)
+        stack.append(s)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_queries):
+                yield s
+        finally:
+            s.wall_time = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self._fold_peak()
+                self._open.remove(s)
+                self.spans.append(s)
+
+    def aggregate(self) -> list:
+        """
+        Sums up spans by (name, sheet) in order of first occurrence.
+        :return: list of dict
+        """
+        agg = {}
+        for s in self.spans:
+            a = agg.setdefault((s.name, s.sheet), dict(name=s.name, sheet=s.sheet, calls=0, wall_time=0.0, rows=0,
+                                                       queries=0, peak_mem=0))
+            a['calls'] += 1
+            a['wall_time'] += s.wall_time
+            a['rows'] += s.rows or 0
+            a['queries'] += s.queries
+            a['peak_mem'] = max(a['peak_mem'], s.peak_mem)
+        return list(agg.values())
+
+    def summary(self) -> str:
+        """ Printable summary table """
+        headers = ['stage', 'sheet', 'calls', 'wall(s)', 'rows', 'queries', 'peak_mem(MB)']
+        rows = [[a['name'], a['sheet'] or '-', str(a['calls']), f"{a['wall_time']:.3f}", str(a['rows']),
+                 str(a['queries']), f"{a['peak_mem'] / (1024 * 1024):.1f}" if self._trace_memory else '-']
+                for a in self.aggregate()]
+        widths = [max(len(r[i]) for r in [headers, *rows]) for i in range(len(headers))]
+        lines = ['  '.join(v.ljust(widths[i]) for i, v in enumerate(r)) for r in [headers, *rows]]
+        lines.insert(1, '  '.join('-' * w for w in widths))
+        return '\n'.join(lines)
+
+    def to_json(self) -> str:
+        return json.dumps(dict(summary=self.aggregate(), spans=[s.to_dict() for s in self.spans]),
+                          sort_keys=True, default=str)
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.to_json())
+        logging.info(f'{filename} instrumentation data generated.')
+
+
+@contextmanager
+def span(name, sheet=None, context=None):
+    """
+    Measures enclosed block if instrumentation is enabled (i.e. context.instrumentation is set) and profiles it if
+    context.profiler selects this stage.
+    :param name: stage name e.g. parse, fetch, write
+    :param sheet: sheet name if stage is sheet specific
+    :param context: job Context, defaults to activated context
+    :return: Span, callers can update its `rows`
+    """
+    context = context or current_context()
+    with ExitStack() as stack:
+        if context.instrumentation is None:
+            s = Span(name=name, sheet=sheet)
+        else:
+            s = stack.enter_context(context.instrumentation.span(name, sheet))
+        if context.profiler is not None:
+            stack.enter_context(context.profiler.profile(name, sheet))
+        yield s
+
+
+# Stages expected to issue constant number of queries per sheet. update_db isn't part of it as it writes every created or
+# updated record with update_or_create(), nor are fetch/render of paginated exports (see Exporter page_size) which
+# query once per page by design.
+QUERY_STAGES = ('fetch', 'render', 'read', 'db_fetch', 'row_hash', 'load_n_compare')
+
+
+class QueryCountError(AssertionError):
+    """
+    Raised when DB query count of a sheet grows with number of rows
+    """
+    def __init__(self, violations: list):
+        self.violations = violations
+
+    def __str__(self):
+        return "Query count grows with row count! " + "; ".join(self.violations)
+
+
+def query_counts(stats, stages=QUERY_STAGES) -> dict:
+    """
+    Provides DB query count per (stage, sheet)
+    :param stats: Instrumentation instance or its to_json() output
+    :param stages: stages to consider
+    :return: dict((stage, sheet) -> queries)
+    """
+    summary = stats.aggregate() if isinstance(stats, Instrumentation) else json.loads(stats)['summary']
+    return {(a['name'], a['sheet']): a['queries'] for a in summary if a['name'] in stages and a['sheet']}
+
+
+def assert_query_scaling(small, large, stages=QUERY_STAGES, tolerance=0):
+    """
+    Compares two runs of same export/import over datasets of different sizes and raises QueryCountError if any sheet
+    issues more queries for larger dataset i.e. query count isn't O(1) per sheet. Useful as N+1 regression guard
+    in test suites of Django projects using this library. Compare exports without page_size, see QUERY_STAGES.
+    :param small: stats (see query_counts) of run with smaller dataset
+    :param large: stats of run with larger dataset
+    :param stages: stages to check
+    :param tolerance: allowed extra queries per stage and sheet
+    """
+    small_counts = query_counts(small, stages)
+    violations = [f'[{sheet}] stage [{stage}] queries {small_counts[(stage, sheet)]} -> {queries}'
+                  for (stage, sheet), queries in query_counts(large, stages).items()
+                  if (stage, sheet) in small_counts and queries > small_counts[(stage, sheet)] + tolerance]
+    if violations:
+        raise QueryCountError(violations)
@@ -1,5 +1,6 @@
 import builtins
 import copy
+import hashlib
 import logging
 import os
 import re
@@ -7,7 +8,9 @@ import traceback
 from itertools import chain
 from box import Box, BoxList
 
-from .common import get_attr_from_dict, lower, get_model_fields, val, get_model, getdictvalue, get_references
+from .common import get_attr_from_dict, lower, get_model_fields, val, get_model, getdictvalue, get_references, \
+    MAX_SHEET_ROWS
+from .instrumentation import span
 
 
 ## Documentation part
@@ -27,6 +30,7 @@ def get_defaults(defaults):
     f.read_only = getdictvalue(config_f, 'read_only', False)
     f.tab_color = "D9D9D9"
     f.position = config_f.get('position', -1)
+    f.max_rows = getdictvalue(config_f, 'max_rows', MAX_SHEET_ROWS)
 
     # Table level
     f.table_style.name = getdictvalue(config_f.table_style, 'name', 'TableStyleMedium2')
@@ -87,6 +91,7 @@ class Parser(object):
             raise FileNotFoundError(f'[{file_name}]')
         stream = builtins.open(file_name, "r").read()
         self._file_name = file_name
+        self.config_hash = hashlib.blake2b(stream.encode('utf-8'), digest_size=16).hexdigest()
         _c = Box.from_yaml(stream, default_box=True)
         _c._box_config['default_box'] = True
         _c.__name__ = 'config.yml'
@@ -97,6 +102,8 @@ class Parser(object):
         self.defaults = get_defaults(_c.defaults)
         self._graph = Box()
         self._errors = Box(default_box=True)
+        self._sheet_levels = []  # topological levels of sheets, see get_sheet_levels()
+        self._sheet_deps = {}  # sheet -> dependencies in earlier levels, see get_sheet_dependencies()
 
     def _get_tbl_formatting(self, ow):
         """default is considered if overwrite doesn't have value"""
@@ -108,6 +115,7 @@ class Parser(object):
             formatting.read_only = getdictvalue(ow, 'read_only', default.read_only)
             formatting.position = getdictvalue(ow, 'position', default.position)
             formatting.tab_color = getdictvalue(ow, 'tab_color', default.tab_color)
+            formatting.max_rows = getdictvalue(ow, 'max_rows', default.max_rows)
             formatting.table_style.name = getdictvalue(ow.table_style, 'name', default.table_style.name)
             # formatting.table_style.show_first_column = defval_dict(ow.table_style, 'show_first_column', default.table_style.show_first_column)
             formatting.table_style.show_last_column = getdictvalue(ow.table_style, 'show_last_column',
@@ -165,7 +173,12 @@ class Parser(object):
         Links sheets with datasets and eventually to respective Django model.
         returns list of errors. If empty then no errors
         """
+        with span('parse') as s:
+            errors = self._parse()
+            s.rows = len(self.parsed_sheets)
+        return errors
 
+    def _parse(self) -> Box:
         # TODO: HG: For better error reporting YAML line numbers are useful. Consider
         #  https://stackoverflow.com/questions/13319067/parsing-yaml-return-with-line-number
         # if self._status:  # we have already completed parsing.
@@ -270,7 +283,8 @@ class Parser(object):
 
         field_types = Box(chars_wrap=int, text=str, author=str, height_len=int, width_len=int,
                           name=str, show_first_column=bool, show_last_column=bool, show_row_stripes=bool,
-                          show_column_stripes=bool, read_only=bool, attributes=list, references=list, default_box=True)
+                          show_column_stripes=bool, read_only=bool, attributes=list, references=list, max_rows=int,
+                          default_box=True)
 
         # TODO: HG: Used supported_fields and remove usage of field_types.
         # required_fields = Box(sheets=Box(sheet_name=str, dataset=object, default_box=True),
@@ -332,6 +346,10 @@ class Parser(object):
                         sheet.filters = self._filters[sheet.filter]
                         del sheet.filter
 
+                if not isinstance(sheet.get('reference_sheet', False), bool):
+                    error(sheet_name, f'{base_field}.reference_sheet', 'Unsupported type. Expected bool',
+                          reference_sheet=sheet.reference_sheet)
+
                 # Validate dataset existence
                 if not sheet.dataset or sheet.dataset not in self._datasets:
                     error(sheet_name, f'{base_field}.dataset',
@@ -369,12 +387,27 @@ class Parser(object):
                         # Validate and update table formatting
                         _validate_type(sheet_name, 'formatting', dup_sheet.formatting, 'mapper.sheets')
                         dup_sheet.formatting = self._get_tbl_formatting(dup_sheet.formatting)
+                        max_rows = dup_sheet.formatting.max_rows
+                        if isinstance(max_rows, int) and not 0 < max_rows <= MAX_SHEET_ROWS:
+                            error(sheet_name, f'{base_field}.formatting.max_rows',
+                                  f'Out of range. Expected 1 to {MAX_SHEET_ROWS}', max_rows=max_rows)
                         self.parsed_sheets[dup_sheet.sheet_name] = dup_sheet
 
             except Exception as e:
                 logging.error(f'Sheet [{sheet_name}], exception: [{e}]')
                 print(traceback.format_exc())
 
+        referenced = {dep_model.lower() for sheet in self.parsed_sheets.values()
+                      for dep_model in sheet.dataset.dependent_models}
+        for model_name, sheet_names in sheet_model_map.items():  # model exported as multiple sheets
+            preferred = [s for s in sheet_names if self.parsed_sheets[s].get('reference_sheet') is True]
+            if len(preferred) > 1:
+                error(preferred[1], 'reference_sheet', f'only one sheet of model [{model_name}] can be reference_sheet',
+                      sheets=preferred)
+            elif not preferred and len(sheet_names) > 1 and model_name in referenced:  # see SheetIndex.get_by_model
+                error(sheet_names[1], 'reference_sheet', f'model [{model_name}] is referenced and exported as multiple '
+                      f'sheets. Mark one of them with `reference_sheet: true`', sheets=list(sheet_names))
+
         for sheet_name, sheet in self.parsed_sheets.items():  # We have case where model is referred but not exported or imported
             sheet.dependent_sheets = list(
                 chain(*[sheet_model_map[dep_model.lower()] for dep_model in sheet.dataset.dependent_models if
@@ -382,6 +415,8 @@ class Parser(object):
 
         if not self._errors:
             self._status = True
+        # Cyclic dependencies are reported as errors after status is set, sheets remain usable as cycles are broken.
+        self._sort_sheets(error)
         return self._errors
         # TODO: Test cases -
         #   * missing filters -- (a) referenced -- error case, (b) none referenced in sheets
@@ -395,36 +430,93 @@ class Parser(object):
         #       - configure field more than 1 times using either by defining it part of 'fieldpart_*', '*', or explicitly configure for 2 times.
         #           * latest configuration should take effect.
 
+    @staticmethod
+    def _find_cycle(start, deps: dict, pending: set) -> list:
+        """ Path of pending sheets from start back to start following dependencies, empty if start isn't in a cycle """
+        parents = {}
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for dep in deps[node]:
+                if dep == start:
+                    path = [node]
+                    while path[-1] != start:
+                        path.append(parents[path[-1]])
+                    return path[::-1]
+                if dep in pending and dep not in parents:
+                    parents[dep] = node
+                    stack.append(dep)
+        return []
+
+    def _sort_sheets(self, error):
+        """
+        Kahn's topological sort of parsed sheets by dependent_sheets, grouped into levels. Sheets of a level depend only
+        on sheets of earlier levels, hence sheets of the same level can be processed in parallel. Sheets keep config
+        order within level. Cycle is reported via error() and broken by placing its first sheet (config order) in a
+        level of its own.
+        """
+        order = {s: i for i, s in enumerate(self.parsed_sheets.keys())}
+        deps = {s: {d for d in self.parsed_sheets[s].dependent_sheets if d in order and d != s} for s in order}
+        dependents = {s: [] for s in order}
+        for s, ds in deps.items():
+            for d in ds:
+                dependents[d].append(s)
+        remaining = {s: len(ds) for s, ds in deps.items()}
+        pending = set(order)
+        levels = []
+        ready = [s for s in order if not remaining[s]]
+        while pending:
+            if not ready:
+                cycle = []
+                for s in sorted(pending, key=order.get):
+                    cycle = self._find_cycle(s, deps, pending)
+                    if cycle:
+                        break
+                error(cycle[0], 'dependent_sheets', 'cyclic dependency between sheets. First sheet is processed '
+                                                    'before its dependencies', cycle=cycle)
+                ready = [cycle[0]]
+            levels.append(ready)
+            pending.difference_update(ready)
+            released = set()
+            for s in ready:
+                for t in dependents[s]:
+                    remaining[t] -= 1
+                    if remaining[t] <= 0 and t in pending:
+                        released.add(t)
+            ready = sorted(released, key=order.get)
+
+        level_of = {s: i for i, level in enumerate(levels) for s in level}
+        self._sheet_levels = levels
+        self._sheet_deps = {s: [d for d in deps[s] if level_of[d] < level_of[s]] for s in order}
+        logging.info(f'Sheet levels: {levels}')
+
+    def get_sheet_levels(self) -> list:
+        """
+        Sheets grouped into dependency levels (computed once by parse). Sheets of a level depend only on sheets of
+        earlier levels.
+        :return: list of lists of sheet names
+        """
+        return [list(level) for level in self._sheet_levels]
+
+    def get_sheet_dependencies(self) -> dict:
+        """
+        dependent_sheets of each sheet without self references and dependencies dropped to break cycles, i.e. an
+        acyclic graph consistent with get_sheet_levels()
+        :return: dict(sheet name -> [sheet names])
+        """
+        return {s: list(deps) for s, deps in self._sheet_deps.items()}
+
     def get_sheet_names(self, export_sequence=True) -> list:
         """
         Provides all the sheets. Ordering is dependent on export_sequence flag.
-        :param export_sequence: if True then sheets are provided in order that can be easily exported - uses DFS.
+        :param export_sequence: if True then sheets are provided in order that can be easily exported i.e. sheets
+                                after the sheets they depend on (see get_sheet_levels).
                                 if False, provides sheet names as they appear in mapper yml configuration file.
         :return: list of sheet names.
         """
         if not export_sequence:
             return list(self.parsed_sheets.keys())
-        visited = set()
-        graph = self.parsed_sheets.keys()
-        dfs_nodes = BoxList()
-
-        def dfs(node):
-            nonlocal visited, graph
-            if node not in visited:
-                visited.add(node)
-                dependents = self.parsed_sheets[node].dependent_sheets
-                for neighbour in dependents:
-                    dfs(neighbour)
-                dfs_nodes.append(node)
-
-        while 1:
-            starting_node = set(graph) - set(visited)
-            if not starting_node:
-                break
-            dfs(starting_node.pop())
-
-        logging.info(dfs_nodes)
-        return dfs_nodes
+        return [s for level in self._sheet_levels for s in level]
 
     def get_sheet(self, sheet_name: str) -> Box:
         """Sheet object if name exists else None"""
@@ -0,0 +1,82 @@
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class Profiler(object):
+    """
+    Wraps selected stages (see instrumentation.span names e.g. export_sheet, import_sheet, fetch, load_n_compare)
+    in a profiler and writes one output file per stage and sheet.
+    Supported engines -
+      * cprofile -- deterministic, writes `.prof` (pstats) usable with snakeviz, flameprof, gprof2dot etc.
+      * pyinstrument -- sampling, writes `.speedscope.json` flamegraph. Requires pyinstrument to be installed.
+    Nested stages are ignored while a stage is being profiled.
+    """
+    ENGINES = ('cprofile', 'pyinstrument')
+
+    def __init__(self, output_prefix, engine='cprofile', stages=None, sheets=None):
+        """
+        :param output_prefix: output file prefix e.g. report name prefix. Files are created as
+                              <output_prefix>-profile_<datetime>_<stage>[_<sheet>].<ext>
+        :param engine: one of Profiler.ENGINES
+        :param stages: stage names to profile
+        :param sheets: sheet names to profile. None means all sheets.
+        """
+        if engine not in Profiler.ENGINES:
+            raise ValueError(f'profiler [{engine}] not supported. Supported profilers are {Profiler.ENGINES}')
+        if engine == 'pyinstrument':
+            try:
+                import pyinstrument  # noqa: F401
+            except ImportError:
+                raise ValueError('pyinstrument profiler requires `pip install pyinstrument`')
+        self.engine = engine
+        self.stages = set(stages or [])
+        self.sheets = set(sheets) if sheets else None
+        self.output_prefix = output_prefix
+        self.files = []
+        self._datetime_str = datetime.now().strftime("%d-%m-%y %Ih.%Mm.%Ss%p")
+        self._active = threading.local()
+
+    def matches(self, stage, sheet=None) -> bool:
+        if stage not in self.stages:
+            return False
+        return self.sheets is None or sheet in self.sheets
+
+    def _filename(self, stage, sheet, ext):
+        return f'{self.output_prefix}-profile_{self._datetime_str}_{stage}{"_" + sheet if sheet else ""}.{ext}'
+
+    @contextmanager
+    def profile(self, stage, sheet=None):
+        if not self.matches(stage, sheet) or getattr(self._active, 'stage', None):
+            yield
+            return
+
+        self._active.stage = stage
+        try:
+            if self.engine == 'cprofile':
+                prof = cProfile.Profile()
+                prof.enable()
+                try:
+                    yield
+                finally:
+                    prof.disable()
+                    filename = self._filename(stage, sheet, 'prof')
+                    prof.dump_stats(filename)
+            else:
+                from pyinstrument import Profiler as SamplingProfiler
+                from pyinstrument.renderers import SpeedscopeRenderer
+                prof = SamplingProfiler()
+                prof.start()
+                try:
+                    yield
+                finally:
+                    prof.stop()
+                    filename = self._filename(stage, sheet, 'speedscope.json')
+                    with open(filename, 'w') as f:
+                        f.write(prof.output(renderer=SpeedscopeRenderer()))
+        finally:
+            self._active.stage = None
+        self.files.append(filename)
+        logging.info(f'{filename} profile generated.')
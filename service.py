@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future
+from enum import Enum
+
+import attr
+from django.db import connections
+
+from .common import Context
+from .export.excel_writter import create_writer
+from .export.exporter import Exporter
+from .importer.excel_reader import XlsReader
+from .importer.importer import Importer
+from .instrumentation import Instrumentation
+from .parser import Parser
+
+
+class JobStatus(str, Enum):
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+
+
+@attr.s
+class Progress(object):
+    stage = attr.ib()  # export or import
+    sheet_name = attr.ib()  # last completed sheet
+    done = attr.ib()
+    total = attr.ib()
+
+
+@attr.s
+class Job(object):
+    """
+    Single export or import run. All resources (xlwriter, exporter, importer etc.) live in its own Context so jobs
+    don't interfere with each other.
+    """
+    kind = attr.ib(validator=attr.validators.instance_of(str))
+    context = attr.ib(validator=attr.validators.instance_of(Context))
+    target = attr.ib(repr=False)  # callable(context) doing the work, executed within activated context
+    id = attr.ib(factory=lambda: uuid.uuid4().hex)
+    status = attr.ib(default=JobStatus.PENDING)
+    progress = attr.ib(default=None)
+    result = attr.ib(default=None)
+    error = attr.ib(default=None)
+    on_progress = attr.ib(default=None, repr=False)  # callable(Progress)
+
+    def __attrs_post_init__(self):
+        self.context.progress = self._update_progress
+
+    def _update_progress(self, stage, sheet_nm, done, total):
+        self.progress = Progress(stage=stage, sheet_name=sheet_nm, done=done, total=total)
+        if self.on_progress:
+            self.on_progress(self.progress)
+
+    def run(self):
+        """ Runs job in calling thread """
+        self.status = JobStatus.RUNNING
+        try:
+            with self.context.activate():
+                self.result = self.target(self.context)
+        except Exception as e:
+            self.status = JobStatus.FAILED
+            self.error = e
+            logging.error(f'{self.kind} job [{self.id}] failed. Exception: {e}')
+            raise
+        self.status = JobStatus.DONE
+        return self.result
+
+
+class TransformerService(object):
+    """
+    Re-entrant export/import API. Config is parsed once and shared by all jobs, every job gets its own Context.
+    DB and openpyxl work runs in a thread pool, so async (ASGI) views can await jobs without blocking the event loop.
+    e.g.
+        service = TransformerService('config/config.yml')
+        job = await service.export('export.xlsx', overwrite=True, on_progress=print)
+    """
+
+    def __init__(self, config_file=None, parser=None, max_workers=4, stats=False):
+        """
+        :param config_file: config yml, ignored if parser is provided
+        :param parser: already parsed Parser
+        :param max_workers: max concurrent jobs
+        :param stats: enables per job Instrumentation, available as job.context.instrumentation
+        """
+        if parser is None:
+            parser = Parser(config_file)
+            errors = parser.parse()
+            if errors:
+                logging.error(f'[{config_file}] has errors: {errors}')
+        self.parser = parser
+        self.stats = stats
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='det-job')
+
+    def _context(self) -> Context:
+        return Context(parser=self.parser, instrumentation=Instrumentation() if self.stats else None)
+
+    def export_job(self, xls_file, overwrite=False, write_only=False, metadata=False, xl_engine='openpyxl',
+                   page_size=0, page_by='pk') -> Job:
+        """
+        :param xls_file: excel file path or binary file-like object
+        :param overwrite: overwrite excel file if exists
+        :param write_only: see BaseXlsWriter
+        :param metadata: see BaseXlsWriter
+        :param xl_engine: writer engine, see create_writer
+        :param page_size: see Exporter
+        :param page_by: see Exporter
+        :return: Job, its result is xls_file
+        """
+        def target(context):
+            context.xlwriter = create_writer(xls_file, overwrite, write_only, metadata, engine=xl_engine)
+            Exporter(context, page_size=page_size, page_by=page_by).export()
+            return xls_file
+
+        return Job(kind='export', context=self._context(), target=target)
+
+    def import_job(self, xls_file, lod=0, report_nm='DET', dry_run=False, db_update=False, db_force_update=False,
+                   workers=1, spill_dir=None, merge_join=False, xl_engine='openpyxl') -> Job:
+        """
+        See Importer.from_context for options, xl_engine is XlsReader engine. Job id is appended to report_nm so that concurrent jobs don't
+        overwrite each others report.
+        :return: Job, its result is html report file name
+        """
+        job = Job(kind='import', context=self._context(), target=None)
+
+        def target(context):
+            context.xlreader = XlsReader(xls_file, read_only=bool(spill_dir), engine=xl_engine)
+            importer = Importer.from_context(context, xls_file=xls_file, lod=lod, report_nm=f'{report_nm}-{job.id}',
+                                             dry_run=dry_run, db_update=db_update, db_force_update=db_force_update,
+                                             workers=workers, spill_dir=spill_dir, merge_join=merge_join)
+            try:
+                importer.import_sheets()
+            finally:
+                context.xlreader.close()
+            return importer.options.report_nm
+
+        job.target = target
+        return job
+
+    @staticmethod
+    def _run_in_worker(job: Job):
+        try:
+            return job.run()
+        finally:
+            connections.close_all()  # worker threads are reused, don't keep job's DB connection around
+
+    def submit(self, job: Job) -> Future:
+        """ Runs job in service thread pool """
+        return self._executor.submit(self._run_in_worker, job)
+
+    async def run_async(self, job: Job, on_progress=None) -> Job:
+        """
+        Awaits job running in service thread pool.
+        :param job: Job
+        :param on_progress: callable(Progress), invoked in event loop thread
+        :return: Job
+        """
+        loop = asyncio.get_running_loop()
+        if on_progress:
+            job.on_progress = lambda p: loop.call_soon_threadsafe(on_progress, p)
+        await asyncio.wrap_future(self.submit(job))
+        return job
+
+    async def export(self, xls_file, overwrite=False, write_only=False, metadata=False, xl_engine='openpyxl',
+                     page_size=0, page_by='pk', on_progress=None) -> Job:
+        return await self.run_async(self.export_job(xls_file, overwrite, write_only, metadata, xl_engine, page_size,
+                                                    page_by), on_progress)
+
+    async def import_sheets(self, xls_file, lod=0, report_nm='DET', dry_run=False, db_update=False,
+                            db_force_update=False, workers=1, spill_dir=None, merge_join=False, xl_engine='openpyxl',
+                            on_progress=None) -> Job:
+        return await self.run_async(self.import_job(xls_file, lod, report_nm, dry_run, db_update, db_force_update,
+                                                    workers, spill_dir, merge_join, xl_engine), on_progress)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,83 @@
+"""
+Test setup: repo root is loaded as `django_excel_transformer` package (as it's placed under an app's
+management/commands folder in projects), `testapp` provides models and config, SQLite DB is created per session.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+
+import django
+import pytest
+from django.conf import settings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'django_excel_transformer'
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testapp', 'config.yml')
+
+
+def _load_package():
+    spec = importlib.util.spec_from_file_location(PACKAGE, os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE] = module
+    spec.loader.exec_module(module)
+
+
+def pytest_configure(config):
+    settings.configure(
+        SECRET_KEY='tests',
+        INSTALLED_APPS=['testapp'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': os.path.join(tempfile.mkdtemp(prefix='det-tests-'), 'db.sqlite3')}},
+        USE_TZ=False,
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+    )
+    django.setup()
+    _load_package()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+@pytest.fixture
+def db():
+    """ Empty DB, tables are flushed after test """
+    from django.core.management import call_command
+    yield
+    call_command('flush', interactive=False, verbosity=0)
+
+
+@pytest.fixture
+def seed(db):
+    """ seed(n) -- n components (and versions) spread over 2 categories, with 2 of 3 languages each """
+    from testapp import models
+
+    def seed(n):
+        langs = [models.ProgrammingLanguageModel.objects.create(name=f'lang{i}') for i in range(3)]
+        vendor = models.SoftwareVendorModel.objects.create(name='Acme')
+        cats = [models.ComponentCategoryModel.objects.create(name=f'cat{i}', description='d') for i in range(2)]
+        subs = [models.ComponentSubcategoryModel.objects.create(category=c, name=f'sub{i}') for i, c in enumerate(cats)]
+        for i in range(n):
+            c = models.ComponentModel.objects.create(name=f'comp{i}', description='x', category=cats[i % 2],
+                                                     subcategory=subs[i % 2], vendor=vendor)
+            c.languages.set(langs[:2])
+            models.ComponentVersionModel.objects.create(component=c, version='1.0', dev_repo='r')
+        return models
+    return seed
+
+
+@pytest.fixture
+def service():
+    from django_excel_transformer.service import TransformerService
+    return TransformerService(CONFIG, stats=True)
+
+
+@pytest.fixture
+def run_import(service, tmp_path):
+    """ run_import(xls_file, **import_job options) -- runs import job in test thread, returns Job """
+    def run_import(xls_file, **options):
+        options.setdefault('report_nm', str(tmp_path / 'DET'))
+        job = service.import_job(xls_file, **options)
+        job.run()
+        return job
+    return run_import
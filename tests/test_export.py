@@ -0,0 +1,207 @@
+import datetime
+import io
+from decimal import Decimal
+
+import openpyxl
+import pytest
+from box import Box
+from django.db import connection, OperationalError
+from django.db.models.query import QuerySet
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from django_excel_transformer.common import Context, METADATA_SHEET, shard_name
+from django_excel_transformer.export.excel_writter import create_writer, BaseXlsWriter
+from django_excel_transformer.export.exporter import Exporter, ExportableSheet, filter_q, PAGE_RETRIES
+from django_excel_transformer.export.parity import assert_workbooks_equivalent
+from django_excel_transformer.export.streaming import iter_export
+from django_excel_transformer.importer.excel_reader import XlsReader
+from django_excel_transformer.importer.xl_engine import OpenpyxlEngine, SpreadsheetMLEngine
+
+ENGINES = [('openpyxl', True), ('spreadsheetml', True), ('xlsxwriter', False), ('xlsxwriter', True)]
+ENGINE_IDS = ['openpyxl-write_only', 'spreadsheetml', 'xlsxwriter', 'xlsxwriter-write_only']
+
+
+def requires(engine):
+    if engine == 'xlsxwriter':
+        pytest.importorskip('xlsxwriter')
+
+
+@pytest.mark.parametrize('engine, write_only', ENGINES, ids=ENGINE_IDS)
+def test_engines_write_equivalent_exports(seed, service, tmp_path, engine, write_only):
+    requires(engine)
+    seed(4)
+    expected, actual = str(tmp_path / 'expected.xlsx'), str(tmp_path / 'actual.xlsx')
+    service.export_job(expected, metadata=True).run()
+
+    service.export_job(actual, write_only=write_only, metadata=True, xl_engine=engine).run()
+
+    assert_workbooks_equivalent(expected, actual, ignore_sheets=(METADATA_SHEET,))
+
+
+@pytest.mark.parametrize('engine, write_only', ENGINES, ids=ENGINE_IDS)
+def test_engines_write_equivalent_cells(service, tmp_path, engine, write_only):
+    requires(engine)
+    context = Context(parser=service.parser)
+    Exporter(context)
+    tf = ExportableSheet.from_sheetdata(service.parser.get_sheet('CompCategories'), context).formatting
+    rows = [[datetime.datetime(2024, 1, 2, 3, 4, 5), datetime.date(2024, 1, 2), datetime.time(1, 2, 3)],
+            [datetime.timedelta(hours=30), True, Decimal('1.5')], [None, 3.25, ' a & <b> '], ['', 7, '=1+1']]
+
+    def write(xls_file, engine, write_only):
+        writer = create_writer(xls_file, write_only=write_only, engine=engine)
+        writer.update_sheet('Values', ['id', 'name', 'description'], rows, tf)
+        writer.update_sheet('Empty', ['id', 'name'], [], tf)
+        writer.final()
+    write(str(tmp_path / 'expected.xlsx'), 'openpyxl', False)
+
+    write(str(tmp_path / 'actual.xlsx'), engine, write_only)
+
+    assert_workbooks_equivalent(str(tmp_path / 'expected.xlsx'), str(tmp_path / 'actual.xlsx'))
+
+
+def test_streamed_export_sends_bytes_before_export_completes(seed, service, tmp_path):
+    seed(4)
+    exported = []  # sheets exported, see Context.progress
+    context = Context(parser=service.parser, progress=lambda stage, sheet_nm, done, total: exported.append(sheet_nm))
+    sheet_names = service.parser.get_sheet_names(export_sequence=True)
+
+    chunks = iter_export(context, chunk_size=1)  # producer blocks once consumer is a few chunks behind
+    first = next(chunks)
+
+    assert len(exported) < len(sheet_names)
+    xls_file = str(tmp_path / 'expected.xlsx')
+    service.export_job(xls_file).run()
+    assert_workbooks_equivalent(xls_file, io.BytesIO(first + b''.join(chunks)))
+
+
+@pytest.mark.parametrize('engine', ['openpyxl', 'spreadsheetml', 'xlsxwriter'])
+def test_metadata_beyond_sheet_limit_is_split(seed, service, run_import, tmp_path, monkeypatch, engine):
+    requires(engine)
+    seed(4)
+    expected, actual = str(tmp_path / 'expected.xlsx'), str(tmp_path / 'actual.xlsx')
+    service.export_job(expected, metadata=True).run()
+    monkeypatch.setattr(BaseXlsWriter, 'METADATA_MAX_ROWS', 5)
+
+    service.export_job(actual, metadata=True, xl_engine=engine).run()
+
+    reader, wb = XlsReader(actual), openpyxl.load_workbook(actual)
+    shards = reader.shard_names(METADATA_SHEET)
+    assert len(shards) > 2
+    for sheet_nm in shards:
+        assert wb[sheet_nm].sheet_state == 'hidden'
+        assert 1 < wb[sheet_nm].max_row <= 6  # header and up to METADATA_MAX_ROWS rows
+    expected_metadata, metadata = XlsReader(expected).get_metadata(), reader.get_metadata()
+    for key in ('config_hash', 'row_counts', 'row_hashes'):
+        assert metadata[key] == expected_metadata[key]
+    job = run_import(actual, dry_run=True)
+    assert job.context.importer.get_sheet('Components').untouched_records == 4
+
+
+@pytest.mark.parametrize('page_by', ['pk', 'index_key'])
+@pytest.mark.parametrize('page_size', [1, 3, 4], ids=['1', 'N-1', 'N'])
+def test_paged_export_matches_single_query_export(seed, service, tmp_path, page_size, page_by):
+    seed(4)  # N rows in biggest sheets
+    expected, actual = str(tmp_path / 'expected.xlsx'), str(tmp_path / 'actual.xlsx')
+    service.export_job(expected, metadata=True).run()
+
+    service.export_job(actual, metadata=True, page_size=page_size, page_by=page_by).run()
+
+    assert_workbooks_equivalent(expected, actual, ignore_sheets=(METADATA_SHEET,))
+    expected_metadata, metadata = XlsReader(expected).get_metadata(), XlsReader(actual).get_metadata()
+    assert metadata['row_hashes'] == expected_metadata['row_hashes']
+
+
+@pytest.mark.parametrize('failures', [1, PAGE_RETRIES], ids=['retried', 'raised'])
+def test_failing_page_is_read_again(seed, monkeypatch, failures):
+    models = seed(4)
+    sheet = ExportableSheet(name='Components', model=models.ComponentModel, data=Box(name={}), filters=None,
+                            formatting=None, index_keys=['name'], columns=['name'], page_size=2)
+    reads = []
+    fetch_all = QuerySet._fetch_all
+
+    def failing_fetch_all(self):
+        if self._result_cache is None:  # rows are read from DB
+            reads.append(self)
+            if 1 < len(reads) <= 1 + failures:  # second page fails
+                raise OperationalError('connection lost')
+        fetch_all(self)
+    monkeypatch.setattr(QuerySet, '_fetch_all', failing_fetch_all)
+
+    if failures == PAGE_RETRIES:
+        with pytest.raises(OperationalError, match='connection lost'):
+            list(sheet.pages())
+        assert len(reads) == 1 + PAGE_RETRIES
+    else:
+        assert [[c.name for c in dbobjs] for _, dbobjs in sheet.pages()] == [['comp0', 'comp1'], ['comp2', 'comp3']]
+        assert len(reads) == 3 + failures  # full second page is followed by an empty one
+        assert sheet.last_key == (models.ComponentModel.objects.get(name='comp3').pk,)
+
+
+# openpyxl and xlsxwriter write shared strings, spreadsheetml writes inline strings
+@pytest.mark.parametrize('engine, write_only', [('openpyxl', False), ('spreadsheetml', True), ('xlsxwriter', False)],
+                         ids=['openpyxl', 'spreadsheetml', 'xlsxwriter'])
+def test_spreadsheetml_reader_matches_openpyxl(service, tmp_path, engine, write_only):
+    requires(engine)
+    context = Context(parser=service.parser)
+    Exporter(context)
+    tf = ExportableSheet.from_sheetdata(service.parser.get_sheet('CompCategories'), context).formatting
+    header = ['name', 'description', 'id']
+    shards = [[['a', datetime.datetime(2024, 1, 2, 3, 4, 5), 1], ['b', datetime.date(2024, 1, 2), 2.5],
+               ['c', datetime.time(1, 2, 3), True], ['d', 'x', None], ['e', None, None]],  # blank trailing cells
+              [['f', datetime.timedelta(hours=30), Decimal('1.5')], ['g', ' a & <b> ', False], ['h', None, -3]]]
+    xls_file = str(tmp_path / 'export.xlsx')
+    writer = create_writer(xls_file, write_only=write_only, engine=engine)
+    for n, rows in enumerate(shards, 1):
+        writer.update_sheet(shard_name('Values', n), header, rows, tf)
+    writer.final()
+
+    expected, actual = OpenpyxlEngine(xls_file), SpreadsheetMLEngine(xls_file)
+    assert actual.sheetnames == expected.sheetnames == ['Values', 'Values_2']
+    for sheet_nm in expected.sheetnames:
+        assert list(actual.iter_rows(sheet_nm)) == list(expected.iter_rows(sheet_nm))
+    expected, actual = XlsReader(xls_file), XlsReader(xls_file, engine='spreadsheetml')
+    assert actual.shard_names('Values') == expected.shard_names('Values') == ['Values', 'Values_2']
+    rows = list(actual.iter_xldata('Values', ['name'], header))
+    assert rows == list(expected.iter_xldata('Values', ['name'], header))
+    assert [idx for idx, _ in rows] == [(c,) for c in 'abcdefgh']
+
+
+@pytest.fixture
+def filtered_names(seed):
+    """ filtered_names(filters) -- names of components exported with given sheet filters, read in a single query """
+    models = seed(4)  # comp0, comp2 are in cat0
+
+    def filtered_names(filters):
+        sheet = ExportableSheet(name='Components', model=models.ComponentModel, data=Box(name={}), filters=filters,
+                                formatting=None, index_keys=['name'], columns=['name'])
+        with CaptureQueriesContext(connection) as queries:
+            names = sorted(c.name for c in sheet.queryset())
+        assert len(queries) == 1
+        return names
+    return filtered_names
+
+
+def test_filter_items_are_combined(filtered_names):
+    criteria = Box({'or': [dict(name='name', values=['comp0', 'comp1']), dict(name='name', values=['comp3'])],
+                    'and': [dict(name='category__name', values=['cat0'])]})
+
+    assert filtered_names(Box(INCLUDE=criteria)) == ['comp0']
+    assert filtered_names(Box(EXCLUDE=criteria)) == ['comp1', 'comp2', 'comp3']
+
+
+@pytest.mark.parametrize('criteria', [{}, {'or': [], 'and': None}], ids=['no_items', 'empty_items'])
+def test_empty_filter_exports_all_rows(filtered_names, criteria):
+    assert filter_q(Box(criteria)) is None
+    for filters in (Box(INCLUDE=criteria), Box(EXCLUDE=criteria)):
+        assert filtered_names(filters) == ['comp0', 'comp1', 'comp2', 'comp3']
+
+
+def test_collection_lookup_gets_all_values(filtered_names):
+    from testapp.models import ComponentModel
+    pks = sorted(ComponentModel.objects.values_list('pk', flat=True))
+
+    assert filter_q(Box({'or': [dict(name='name__in', values=['comp0', 'comp2'])]})) == Q(name__in=['comp0', 'comp2'])
+    assert filtered_names(Box(INCLUDE={'or': [dict(name='name__in', values=['comp0', 'comp2'])]})) == ['comp0', 'comp2']
+    assert filtered_names(Box(INCLUDE={'or': [dict(name='pk__range', values=pks[1:3])]})) == ['comp1', 'comp2']
+    assert filtered_names(Box(EXCLUDE={'and': [dict(name='pk__range', values=pks[1:3])]})) == ['comp0', 'comp3']
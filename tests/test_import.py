@@ -0,0 +1,194 @@
+import json
+
+import openpyxl
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from django_excel_transformer.importer.importer import ImportableSheet, LOD, M2MSynchronizer, Record, Status
+from django_excel_transformer.importer.scheduler import DagExecutor
+from django_excel_transformer.importer.store import MemoryRecordStore, SpillRecordStore
+
+
+def sheet_rows(xls_file, sheet_nm):
+    """ (workbook, sheet, {column title: column number}) of exported sheet """
+    wb = openpyxl.load_workbook(xls_file)
+    ws = wb[sheet_nm]
+    return wb, ws, {c.value: c.column for c in ws[1]}
+
+
+def issues(job, sheet_nm) -> int:
+    return job.context.importer.get_sheet(sheet_nm).report.issue_cnt
+
+
+@pytest.mark.parametrize('row_hash', [True, False], ids=['row_hash', 'compare'])
+def test_empty_string_matches_empty_cell(seed, service, run_import, tmp_path, monkeypatch, row_hash):
+    models = seed(2)
+    models.ComponentCategoryModel.objects.update(description='')
+    xls_file = str(tmp_path / 'export.xlsx')
+    service.export_job(xls_file).run()
+    wb, ws, cols = sheet_rows(xls_file, 'CompCategories')
+    for row in range(2, ws.max_row + 1):
+        ws.cell(row, cols['description']).value = None
+    wb.save(xls_file)
+    if not row_hash:  # unchanged rows aren't skipped by hash, all are compared field by field
+        monkeypatch.setattr(ImportableSheet, 'db_row_hasher', lambda self: None)
+
+    job = run_import(xls_file, dry_run=True)
+
+    assert issues(job, 'CompCategories') == 0
+
+
+def test_many_to_many_column_is_imported(seed, service, run_import, tmp_path, monkeypatch):
+    models = seed(3)
+    through = models.ComponentModel.languages.through
+    xls_file = str(tmp_path / 'export.xlsx')
+    service.export_job(xls_file).run()
+    wb, ws, cols = sheet_rows(xls_file, 'Components')
+    comp0 = next(r for r in range(2, ws.max_row + 1) if ws.cell(r, cols['name']).value == 'comp0')
+    ws.cell(comp0, cols['description']).value = 'changed'
+    ws.cell(comp0, cols['languages']).value = '* lang2'
+    new = [ws.cell(comp0, c).value for c in range(1, ws.max_column + 1)]
+    new[cols['name'] - 1], new[cols['languages'] - 1] = 'compNEW', '* lang0\n* lang2'
+    ws.append(new)
+    wb.save(xls_file)
+    flushes = []
+    flush = M2MSynchronizer.flush
+
+    def captured_flush(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = flush(self)
+        flushes.append([q['sql'].split()[0] for q in queries if q['sql'] not in ('BEGIN', 'COMMIT')])
+        return result
+    monkeypatch.setattr(M2MSynchronizer, 'flush', captured_flush)
+
+    def relations():
+        return sorted(through.objects.values_list('componentmodel__name', 'programminglanguagemodel__name'))
+    assert relations() == [(f'comp{i}', f'lang{j}') for i in range(3) for j in range(2)]
+
+    job = run_import(xls_file, db_update=True)
+
+    assert issues(job, 'Components') == 2
+    assert models.ComponentModel.objects.get(name='comp0').description == 'changed'
+    assert relations() == [('comp0', 'lang2'), ('comp1', 'lang0'), ('comp1', 'lang1'), ('comp2', 'lang0'),
+                           ('comp2', 'lang1'), ('compNEW', 'lang0'), ('compNEW', 'lang2')]
+    # existing relations are read once, missing ones bulk created and stale ones deleted at once
+    assert flushes == [['SELECT', 'INSERT', 'DELETE']]
+
+
+@pytest.mark.parametrize('import_options', [{}, {'spill_dir': 'tmp'}], ids=['default', 'spill'])
+def test_reference_value_with_index_separator(seed, service, run_import, tmp_path, monkeypatch, import_options):
+    monkeypatch.setattr(ImportableSheet, 'db_row_hasher', lambda self: None)  # all rows are compared
+    models = seed(2)
+    models.ComponentCategoryModel.objects.filter(name='cat0').update(name='A - B')
+    xls_file = str(tmp_path / 'export.xlsx')
+    service.export_job(xls_file).run()
+    if 'spill_dir' in import_options:
+        import_options['spill_dir'] = str(tmp_path)
+
+    job = run_import(xls_file, dry_run=True, **import_options)
+
+    # e.g. Components.subcategory 'A - B - sub0' refers to subcategory ('A - B', 'sub0')
+    for sheet_nm in ('Components', 'CompSubCategories'):
+        assert issues(job, sheet_nm) == 0
+
+
+def test_parallel_import_matches_serial_import(seed, service, run_import, tmp_path):
+    seed(4)
+    xls_file = str(tmp_path / 'export.xlsx')
+    service.export_job(xls_file).run()
+    wb, ws, cols = sheet_rows(xls_file, 'Components')
+    ws.cell(2, cols['description']).value = 'changed'
+    wb.save(xls_file)
+
+    def results(job):
+        """ {sheet: (records, report)} of import job """
+        importer = job.context.importer
+        return {nm: ({str(i): r.to_json('self') for i, r in importer.get_sheet(nm).records.items()},
+                     importer.get_sheet(nm).get_html_report(LOD.ALL_FULL))
+                for nm in service.parser.get_sheet_names()}
+    serial = results(run_import(xls_file, dry_run=True))
+
+    parallel = results(run_import(xls_file, dry_run=True, workers=3))
+
+    assert parallel == serial
+    assert sum('"status": "XL"' in r for r in serial['Components'][0].values()) == 1  # changed row is compared
+
+
+def test_failing_node_stops_its_dependents():
+    graph = {'CompCategories': [], 'CompSubCategories': ['CompCategories'],
+             'Components': ['CompCategories', 'CompSubCategories'], 'CompVersions': []}
+    done = []
+
+    def import_sheet(sheet_nm):
+        if sheet_nm == 'CompCategories':
+            raise ValueError(sheet_nm)
+        done.append(sheet_nm)
+
+    with pytest.raises(ValueError, match='CompCategories'):
+        DagExecutor(graph, list(graph), workers=3).run(import_sheet)
+
+    assert 'CompSubCategories' not in done and 'Components' not in done
+
+
+def test_spilled_records_match_in_memory_records(seed, service, run_import, tmp_path, monkeypatch):
+    monkeypatch.setattr(ImportableSheet, 'db_row_hasher', lambda self: None)  # all rows are compared
+    seed(4)
+    xls_file = str(tmp_path / 'export.xlsx')
+    service.export_job(xls_file).run()
+    wb, ws, cols = sheet_rows(xls_file, 'Components')
+    ws.cell(2, cols['description']).value = 'changed'
+    ws.delete_rows(3)
+    wb.save(xls_file)
+    spilled = []
+    monkeypatch.setattr(SpillRecordStore, 'close', lambda self: spilled.append(self))  # records are read after job
+
+    def records(job):
+        importer = job.context.importer
+        return {nm: {i: r.to_json('self') for i, r in importer.get_sheet(nm).records.items()}
+                for nm in service.parser.get_sheet_names()}
+    in_memory = records(run_import(xls_file, dry_run=True))
+
+    try:
+        assert records(run_import(xls_file, dry_run=True, spill_dir=str(tmp_path))) == in_memory
+    finally:
+        monkeypatch.undo()
+        for store in spilled:
+            store.close()
+    statuses = [json.loads(r)['status'] for r in in_memory['Components'].values()]
+    assert sorted(statuses) == ['DB', 'EQUAL', 'EQUAL', 'XL']
+
+
+@pytest.mark.parametrize('store', [MemoryRecordStore, SpillRecordStore], ids=['memory', 'spill'])
+def test_records_can_be_stored_while_iterating(tmp_path, store):
+    store = store() if store is MemoryRecordStore else store(str(tmp_path))
+    for i in range(2 * SpillRecordStore.BATCH_SIZE + 1):
+        store[(f'{i}',)] = Record(status=Status.PENDING)
+
+    for idx, record in store.items():
+        assert record.status == Status.PENDING  # each record is visited once
+        record.status = Status.NO_CHANGE
+        store[idx] = record
+
+    assert len(store) == 2 * SpillRecordStore.BATCH_SIZE + 1
+    assert {r.status for r in store.values()} == {Status.NO_CHANGE}
+    store.close()
+
+
+@pytest.mark.parametrize('import_options', [{}, {'spill_dir': 'tmp'}], ids=['memory', 'spill'])
+def test_merge_join_index_with_control_characters(seed, service, run_import, tmp_path, monkeypatch, import_options):
+    monkeypatch.setattr(ImportableSheet, 'db_row_hasher', lambda self: None)  # all rows are compared
+    models = seed(2)
+    # subcategory index ('cat0', 'sub0') sorts before ('cat0\tb', 'sub1') though '\t' sorts before printable ones
+    models.ComponentCategoryModel.objects.filter(name='cat1').update(name='cat0\tb')
+    models.ComponentCategoryModel.objects.create(name='cat0\nc', description='d')
+    xls_file = str(tmp_path / 'export.xlsx')
+    service.export_job(xls_file).run()
+    if 'spill_dir' in import_options:
+        import_options['spill_dir'] = str(tmp_path)
+
+    job = run_import(xls_file, dry_run=True, merge_join=True, **import_options)
+
+    for sheet_nm in ('CompCategories', 'CompSubCategories', 'Components'):
+        assert issues(job, sheet_nm) == 0
+    assert job.context.importer.get_sheet('CompCategories').total_xl_records == 3
@@ -0,0 +1,61 @@
+import pytest
+from box import Box
+
+from conftest import CONFIG
+from django_excel_transformer.parser import Parser
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    """ config_file(extra sheet entries, **dataset changes) -- test config with given changes """
+    def config_file(*sheets, **datasets):
+        config = Box.from_yaml(filename=CONFIG)
+        config.sheets.extend(sheets)
+        for name, changes in datasets.items():
+            config.datasets[name].update(changes)
+        config_file = tmp_path / 'config.yml'
+        config.to_yaml(filename=str(config_file))
+        return str(config_file)
+    return config_file
+
+
+@pytest.fixture
+def parse(config_file):
+    """ parse(extra sheet entries) -- errors of test config with given sheets added """
+    def parse(*sheets):
+        return Parser(config_file(*sheets)).parse()
+    return parse
+
+
+def test_referenced_model_with_multiple_sheets_needs_reference_sheet(parse):
+    errors = parse(Box(sheet_name='MoreCategories', dataset='component_category'))
+
+    assert [e.field for e in errors.MoreCategories] == ['reference_sheet']
+    assert not parse(Box(sheet_name='MoreCategories', dataset='component_category', reference_sheet=True))
+
+
+def test_unreferenced_model_can_have_multiple_sheets(parse):
+    assert not parse(Box(sheet_name='MoreVersions', dataset='comp_version'))
+
+
+def test_sheets_are_grouped_by_dependency_level():
+    parser = Parser(CONFIG)
+    assert not parser.parse()
+
+    # sheets of a level keep config order and depend only on sheets of earlier levels
+    assert parser.get_sheet_levels() == [['CompCategories', 'softwarevendormodel', 'programminglanguagemodel'],
+                                         ['CompSubCategories'], ['Components'], ['CompVersions']]
+    assert parser.get_sheet_names(export_sequence=True) == [s for level in parser.get_sheet_levels() for s in level]
+
+
+def test_reference_cycle_is_reported_and_broken(config_file):
+    parser = Parser(config_file(component_category=dict(dependent_models=['componentmodel'])))
+
+    errors = parser.parse()
+
+    assert [e.field for e in errors.Components] == ['dependent_sheets']
+    assert errors.Components[0].cycle == ['Components', 'CompCategories']
+    assert parser.status  # cycle is broken by processing its first sheet (config order) before its dependencies
+    assert parser.get_sheet_levels() == [['softwarevendormodel', 'programminglanguagemodel'], ['Components'],
+                                         ['CompVersions', 'CompCategories'], ['CompSubCategories']]
+    assert sorted(parser.get_sheet_dependencies()['Components']) == ['programminglanguagemodel', 'softwarevendormodel']
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+from django.core.management import call_command
+
+from django_excel_transformer.instrumentation import assert_query_scaling, query_counts, QueryCountError
+
+SMALL, LARGE = 3, 30
+
+
+@pytest.fixture
+def roundtrip_stats(seed, service, run_import, tmp_path):
+    """ roundtrip_stats(**import options) -- (export, import) Instrumentation of SMALL and LARGE datasets """
+    def roundtrip_stats(**import_options):
+        stats = []
+        for rows in (SMALL, LARGE):
+            call_command('flush', interactive=False, verbosity=0)
+            seed(rows)
+            xls_file = str(tmp_path / f'export-{rows}.xlsx')
+            export = service.export_job(xls_file, overwrite=True)
+            export.run()
+            job = run_import(xls_file, dry_run=True, **import_options)
+            stats.append((export.context.instrumentation, job.context.instrumentation))
+        return stats
+    return roundtrip_stats
+
+
+def test_export_queries_dont_grow_with_rows(roundtrip_stats):
+    (small, _), (large, _) = roundtrip_stats()
+    assert ('fetch', 'Components') in query_counts(small)
+    assert_query_scaling(small, large)
+
+
+@pytest.mark.parametrize('import_options', [{}, {'merge_join': True}, {'spill_dir': 'tmp'}, {'workers': 3}],
+                         ids=['default', 'merge_join', 'spill', 'workers'])
+def test_import_queries_dont_grow_with_rows(roundtrip_stats, tmp_path, import_options):
+    if 'spill_dir' in import_options:
+        import_options['spill_dir'] = str(tmp_path)
+    (_, small), (_, large) = roundtrip_stats(**import_options)
+    assert ('load_n_compare', 'CompSubCategories') in query_counts(small)
+    assert_query_scaling(small, large)
+
+
+def test_growing_query_count_is_reported():
+    def stats(queries):
+        return json.dumps(dict(summary=[dict(name='load_n_compare', sheet='Components', queries=queries)]))
+
+    assert_query_scaling(stats(5), stats(5))
+    with pytest.raises(QueryCountError, match=r'\[Components\] stage \[load_n_compare\] queries 5 -> 32'):
+        assert_query_scaling(stats(5), stats(32))
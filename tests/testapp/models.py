@@ -0,0 +1,54 @@
+from django.db import models
+
+
+class ComponentCategoryModel(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+    description = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return self.name
+
+
+class ComponentSubcategoryModel(models.Model):
+    category = models.ForeignKey(ComponentCategoryModel, on_delete=models.CASCADE)
+    name = models.CharField(max_length=64)
+    description = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return self.name
+
+
+class SoftwareVendorModel(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ProgrammingLanguageModel(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ComponentModel(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+    description = models.TextField(blank=True, default='')
+    life_status = models.CharField(max_length=16, default='new')
+    category = models.ForeignKey(ComponentCategoryModel, on_delete=models.CASCADE)
+    subcategory = models.ForeignKey(ComponentSubcategoryModel, on_delete=models.CASCADE)
+    vendor = models.ForeignKey(SoftwareVendorModel, on_delete=models.CASCADE)
+    languages = models.ManyToManyField(ProgrammingLanguageModel, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ComponentVersionModel(models.Model):
+    component = models.ForeignKey(ComponentModel, on_delete=models.CASCADE)
+    version = models.CharField(max_length=16)
+    dev_repo = models.CharField(max_length=64, blank=True, default='')
+
+    def __str__(self):
+        return f'{self.component} {self.version}'
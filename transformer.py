@@ -1,11 +1,14 @@
 from django.core.management.base import BaseCommand
-from .django_excel_transformer.export.excel_writter import XlsWriter
-from .django_excel_transformer.export.exporter import Exporter
+from .django_excel_transformer.export import excel_writter
+from .django_excel_transformer.export.exporter import Exporter, PAGE_BY
 from .django_excel_transformer.importer.excel_reader import XlsReader
-from .django_excel_transformer.common import Registry
+from .django_excel_transformer.common import Context
 from .django_excel_transformer.parser import Parser
 from .django_excel_transformer.importer.importer import Importer
+from .django_excel_transformer.instrumentation import Instrumentation
+from .django_excel_transformer.profiling import Profiler
 import logging
+import os
 
 
 class Command(BaseCommand):
@@ -13,6 +16,20 @@ class Command(BaseCommand):
 
         # parser.add_argument('opt', help='import or export', nargs='?', choices=('import','export'))
         parser.add_argument('-c', '--' + 'config', help='Config mapper file (preferred absolute path)', required=True)
+        parser.add_argument('-s', '--' + 'stats', help='print per stage timing and query count summary',
+                            action='store_true', default=False)
+        parser.add_argument('--' + 'stats_json', help='export per stage timing and query count to json file',
+                            default=None)
+        parser.add_argument('--' + 'stats_memory', help='include peak memory in stats (slows down processing)',
+                            action='store_true', default=False)
+        parser.add_argument('--' + 'profile', help='profile the run. Output is written next to the report '
+                                                   '(import) or excel file (export)',
+                            choices=Profiler.ENGINES, default=None)
+        parser.add_argument('--' + 'profile_stage', help='comma separated stages to profile e.g. export, import, '
+                                                         'fetch, render, load_n_compare, update_db. Default is per '
+                                                         'sheet (export_sheet/import_sheet)', default=None)
+        parser.add_argument('--' + 'profile_sheets', help='comma separated sheet names to profile. Default is all '
+                                                          'sheets', default=None)
 
         subparsers = parser.add_subparsers(help='Select from importer or exporter parser', dest='opt')
 
@@ -22,6 +39,17 @@ class Command(BaseCommand):
                                    default=0)
         parser_import.add_argument('-r', '--' + 'report_name_prefix', help='report name prefix string e.g. DET',
                                    default='DET')
+        parser_import.add_argument('-w', '--' + 'workers', help='number of sheets to import in parallel',
+                                   type=int, default=1)
+        parser_import.add_argument('--' + 'spill_dir', help='low memory mode for huge sheets, excel is streamed and '
+                                                            'records are spilled to temporary files in this directory',
+                                   default=None)
+        parser_import.add_argument('--' + 'merge_join', help='compare excel and DB records sorted by index in a single '
+                                                             'merge pass instead of index lookups',
+                                   action='store_true', default=False)
+        parser_import.add_argument('--' + 'xl_engine', help='excel reader engine. spreadsheetml reads cell values '
+                                                            'straight from sheet XML, faster for huge sheets',
+                                   choices=XlsReader.ENGINES, default='openpyxl')
         group = parser_import.add_mutually_exclusive_group()
         group.add_argument('-d',
                            help='dry run. Dont import data in DB. Provides diff between DB and XLS data.',
@@ -37,31 +65,75 @@ class Command(BaseCommand):
         parser_export.add_argument('-x', '--' + 'xls_file', help='Export XLS file', required=True)
         parser_export.add_argument('-o', '--overwrite', help='Overwrite existing excel file if exists',
                                    action='store_true', default=False)
+        parser_export.add_argument('--' + 'write_only', help='low memory mode, rows are streamed to temporary files '
+                                                             'and workbook is written once at the end',
+                                   action='store_true', default=False)
+        parser_export.add_argument('-m', '--' + 'metadata', help='add hidden metadata sheet with row fingerprints, '
+                                                                 'import then reports rows untouched since export',
+                                   action='store_true', default=False)
+        parser_export.add_argument('--' + 'xl_engine', help='excel writer engine. spreadsheetml streams sheets '
+                                                            'with constant memory, xlsxwriter is faster than openpyxl '
+                                                            'but holds all cells, requires `pip install xlsxwriter`',
+                                   choices=excel_writter.ENGINES, default='openpyxl')
+        parser_export.add_argument('--' + 'page_size', help='read DB rows in pages of given size (keyset pagination) '
+                                                            'instead of single query per sheet',
+                                   type=int, default=0)
+        parser_export.add_argument('--' + 'page_by', help='keyset of pages, index_key orders rows by index columns',
+                                   choices=PAGE_BY, default='pk')
 
     def handle(self, *args, **options):
-        # Registry maintains common instance for parser, exporter, importer etc. Its used for internal processing.
+        # Context maintains instances of parser, exporter, importer etc. for this run. Its used for internal processing.
 
         debuglevel = {0: logging.CRITICAL, 1: logging.ERROR, 2:logging.INFO, 3:logging.DEBUG}
         logging.basicConfig(
             format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(funcName)s():%(lineno)d] %(message)s',
             datefmt='%Y-%m-%d:%H:%M:%S',
             level=debuglevel[options['verbosity']])
-        Registry.parser = Parser(options['config'])
-        Registry.parser.parse() # you can check for errors using parser.errors() and resolve errors in config.yml
+        context = Context(options=options)
+        if options['stats'] or options['stats_json'] or options['stats_memory']:
+            context.instrumentation = Instrumentation(trace_memory=options['stats_memory'])
+        if options['profile']:
+            context.profiler = Profiler(output_prefix=options['report_name_prefix'] if options['opt'] == 'import'
+                                        else os.path.splitext(options['xls_file'])[0],
+                                        engine=options['profile'],
+                                        stages=(options['profile_stage'] or f'{options["opt"]}_sheet').split(','),
+                                        sheets=options['profile_sheets'].split(',') if options['profile_sheets']
+                                        else None)
+            if options.get('workers', 1) > 1:
+                logging.warning('Profiling is supported only with single worker. Ignoring --workers option.')
+                options['workers'] = 1
+
+        with context.activate():
+            context.parser = Parser(options['config'])
+            context.parser.parse() # you can check for errors using parser.errors() and resolve errors in config.yml
 
-        Registry.options = options
+            if options['opt'] == 'import':
+                context.xlreader = XlsReader(options['xls_file'], read_only=bool(options['spill_dir']),
+                                             engine=options['xl_engine'])
+                importer = Importer.from_context(context,
+                                                 xls_file = options['xls_file'],
+                                                 lod = options['lod'],
+                                                 report_nm = options['report_name_prefix'],
+                                                 dry_run=options['dry_run'],
+                                                 db_update=options['db_update'],
+                                                 db_force_update=options['db_force_update'],
+                                                 workers=options['workers'],
+                                                 spill_dir=options['spill_dir'],
+                                                 merge_join=options['merge_join'])
+                try:
+                    importer.import_sheets()
+                finally:
+                    context.xlreader.close()
+            else:
+                # Now instantiate exporter by providing writer(path_to_export_xls_file, should_overwrite_yes_no)
+                context.xlwriter = excel_writter.create_writer(options['xls_file'], options['overwrite'],
+                                                               options['write_only'], options['metadata'],
+                                                               engine=options['xl_engine'])
+                Exporter(context, page_size=options['page_size'],
+                         page_by=options['page_by']).export()  # wrap this around try-except to handle any exceptions
 
-        if options['opt'] == 'import':
-            Registry.xlreader = XlsReader(options['xls_file'])
-            Registry.importer = Importer.from_registry(xls_file = options['xls_file'],
-                                                       lod = options['lod'],
-                                                       report_nm = options['report_name_prefix'],
-                                                       dry_run=options['dry_run'],
-                                                       db_update=options['db_update'],
-                                                       db_force_update=options['db_force_update'])
-            Registry.importer.import_sheets()
-        else:
-            # Now instantiate exporter by providing XlsWriter(path_to_export_xls_file, should_overwrite_yes_no)
-            Registry.xlwriter = XlsWriter(options['xls_file'], options['overwrite'])
-            Registry.exporter = Exporter()
-            Registry.exporter.export()  # wrap this around try-except to handle any exceptions
\ No newline at end of file
+        if context.instrumentation:
+            if options['stats'] or options['stats_memory']:
+                self.stdout.write(context.instrumentation.summary())
+            if options['stats_json']:
+                context.instrumentation.dump_json(options['stats_json'])